@@ -5,10 +5,35 @@ import streamlit as st
 from annotated_text import annotated_text
 from pydub import AudioSegment
 import os
+import base64
+import json
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+# Conversion server started with `python server.py`
+SERVER_URL = os.environ.get("MVC_SERVER_URL", "http://127.0.0.1:8502")
 
 def header(url):
      st.markdown(f'<p style="background-color:#0066cc;color:#33ff33;font-size:24px;border-radius:2%;">{url}</p>', unsafe_allow_html=True)
 
+def convert_remote(source_bytes, target_bytes, timeout=600):
+     payload = json.dumps({
+          "source": base64.b64encode(source_bytes).decode("ascii"),
+          "target": base64.b64encode(target_bytes).decode("ascii"),
+     }).encode("utf8")
+     req = Request(SERVER_URL + "/convert", data=payload,
+                   headers={"Content-Type": "application/json"})
+     with urlopen(req, timeout=timeout) as res:
+          return res.read()
+
+def server_error(e):
+     """Error message of a failed conversion request, from its JSON body."""
+     body = e.read().decode("utf8", "replace")
+     try:
+          return json.loads(body)["error"]
+     except (ValueError, KeyError, TypeError):
+          return body or e.reason
+
 if __name__ == "__main__":
 
      st.title("Music Voice Conversion")
@@ -93,25 +118,24 @@ if __name__ == "__main__":
 
      gen = st.button("Generate My Sing Voice")
      
-     if gen :#and source_music and target_speaker:
-          st.write("Currently, I am hosting in my local, I can't receive too much requeset, If available, you can ping for demo")
-
-          # st.write("Generating: ...")
-          # os.system("python vocal-remover/inference.py --input TMP/source.wav --gpu 0")
-          # os.system("bash ppg-vc/convert.sh TMP/source_singer.wav TMP/target.wav TMP/convert_speaker.wav")
-          # os.system("python mix.py TMP/convert_speaker.wav TMP/source_music.wav TMP/convert.wav")
-
-          st.write("Source Music")
-          st.audio("TMP/source.wav")
-          st.write("Speaker Target")
-          st.audio("TMP/target.wav")
-          st.write("Converted Sing Speaker")
-          st.audio("TMP/convert_speaker.wav")
-          st.write("Converted Sing Speaker with Music")
-          st.audio("TMP/convert.wav")
-
-          # source_music_audio = AudioSegment.from_ogg(source_music)
-          # target_speaker_audio = AudioSegment.from_ogg(target_speaker)
+     if gen and source_music and target_speaker:
+          st.write("Generating: ...")
+          try:
+               converted = convert_remote(source_music.getvalue(), target_speaker.getvalue())
+          except HTTPError as e:
+               if e.code == 503:
+                    st.write("Currently, I am hosting in my local, I can't receive too much requeset, If available, you can ping for demo")
+               else:
+                    st.write(f"Conversion failed ({e.code}): {server_error(e)}")
+          except (URLError, OSError) as e:
+               st.write(f"Can't reach the conversion server at {SERVER_URL}: {e}")
+          else:
+               st.write("Source Music")
+               st.audio(source_music)
+               st.write("Speaker Target")
+               st.audio(target_speaker)
+               st.write("Converted Sing Speaker with Music")
+               st.audio(converted, format="audio/wav")
 
      elif gen and source_music:
           st.write("Please Upload Target Speaker")
@@ -6,29 +6,18 @@ import soundfile as sf
 import argparse
 # target_file = "convert_speaker_aligned.wav"
 # noise_file = "source_music2.wav"
-def mix(target_file, noise_file, out_file):
-     SNR_dB = 0
+def mix_signals(target_signal, noise_signal, SNR_dB=0):
+     """Mix a 16 kHz vocal with its accompaniment, both given as 1-D numpy arrays."""
      FLT_EPSILON = 1.19209290e-7
 
-     sr = 16000
-     start_times = 0.0
-
-     target_signal, _ = librosa.load(target_file, sr=sr)
-     noise_signal, _ = librosa.load(noise_file, sr=sr)
-
      target_signal = torch.from_numpy(target_signal)
      noise_signal = torch.from_numpy(noise_signal)
 
      target_power = target_signal.norm(p=2)
      noise_power = noise_signal.norm(p=2) + FLT_EPSILON
 
-     print(f"NOISE before scaling: {noise_signal}")
      scale_factor = math.sqrt(10**(-SNR_dB / 10) * target_power / noise_power)
-     noise_signal *= scale_factor
-
-     print(f"TARGET: {target_signal}")
-     print(f"NOISE after scaling: {noise_signal}")
-
+     noise_signal = noise_signal * scale_factor
 
      # Not to use offset (start_times)
      mixed_signal = torch.zeros_like(target_signal)
@@ -43,7 +32,16 @@ def mix(target_file, noise_file, out_file):
      assert target_signal.size() == mixed_signal.size(), f"CAN'T ADD TWO UNEQUAL VECTORS: {target_signal.size} - {mixed_signal.size}"
      alpha = 1.0
      mixed_signal = target_signal + alpha * noise_signal
-     mixed_signal = mixed_signal.numpy()
+     return mixed_signal.numpy()
+
+
+def mix(target_file, noise_file, out_file):
+     sr = 16000
+
+     target_signal, _ = librosa.load(target_file, sr=sr)
+     noise_signal, _ = librosa.load(noise_file, sr=sr)
+
+     mixed_signal = mix_signals(target_signal, noise_signal)
 
      print(f"MIXED: {mixed_signal}")
 
@@ -0,0 +1,167 @@
+"""In-process music voice conversion.
+
+Runs vocal separation (vocal-remover), singing voice conversion (ppg-vc) and
+remixing in a single process. All models stay loaded on the pipeline object and
+audio is passed between the stages as numpy arrays, so converting another song
+with a warm pipeline does not touch the disk.
+
+Paths are relative to the repository root, like gen.py and ppg-vc/convert.sh.
+"""
+import io
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+for _sub_dir in ("vocal-remover", "ppg-vc"):
+    _path = os.path.join(ROOT_DIR, _sub_dir)
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+
+from lib import nets
+from lib import spec_utils
+from inference import Separator
+
+from convert_from_wav import load_conversion_models, compute_ref_features, convert_wav
+from speaker_encoder.voice_encoder import SpeakerEncoder
+from utils.ref_cache import RefFeatureCache
+
+from mix import mix_signals
+
+
+PPG2MEL_CONFIG = "ppg-vc/pretrain/bneSeq2seqMoL-vctk-libritts460-oneshot/seq2seq_mol_ppg2mel_vctk_libri_oneshotvc_r4_normMel_v2.yaml"
+PPG2MEL_MODEL_FILE = "ppg-vc/pretrain/bneSeq2seqMoL-vctk-libritts460-oneshot/best_loss_step_304000.pth"
+SEPARATOR_MODEL_FILE = "vocal-remover/models/baseline.pth"
+SPK_ENCODER_CKPT = "speaker_encoder/ckpt/pretrained_bak_5805000.pt"
+REF_CACHE_DIR = "ppg-vc/cache/ref_feats"
+
+SEPARATOR_SR = 44100
+CONVERT_SR = 16000
+VOCODER_SR = 24000
+
+
+class MusicVoiceConversionPipeline(object):
+
+    def __init__(
+        self,
+        ppg2mel_model_train_config=PPG2MEL_CONFIG,
+        ppg2mel_model_file=PPG2MEL_MODEL_FILE,
+        separator_model_file=SEPARATOR_MODEL_FILE,
+        spk_encoder_ckpt=SPK_ENCODER_CKPT,
+        ref_cache_dir=REF_CACHE_DIR,
+        ref_cache_size=64,
+        gpu=0,
+        n_fft=2048,
+        hop_length=1024,
+        batchsize=4,
+        cropsize=256,
+        postprocess=False,
+        tta=False,
+        stft_backend='librosa',
+    ):
+        if torch.cuda.is_available() and gpu >= 0:
+            self.device = torch.device('cuda:{}'.format(gpu))
+        else:
+            self.device = torch.device('cpu')
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.tta = tta
+        self.stft_backend = stft_backend
+
+        print('Load Separator, PPG-model, PPG2Mel-model, Vocoder-model...')
+        model = nets.CascadedNet(n_fft, 32, 128)
+        model.load_state_dict(torch.load(separator_model_file, map_location='cpu'))
+        model.to(self.device)
+        self.separator = Separator(model, self.device, batchsize, cropsize, postprocess)
+
+        self.ppg_model, self.ppg2mel_model, self.hifigan_model = load_conversion_models(
+            ppg2mel_model_train_config, ppg2mel_model_file, self.device)
+        # The speaker encoder is loaded on the first reference feature cache miss.
+        self.spk_encoder_ckpt = spk_encoder_ckpt
+        self.spk_encoder = None
+        self.ref_cache = RefFeatureCache(ref_cache_dir, spk_encoder_ckpt, ref_cache_size)
+
+    def get_spk_encoder(self):
+        if self.spk_encoder is None:
+            self.spk_encoder = SpeakerEncoder(self.spk_encoder_ckpt, device=self.device)
+        return self.spk_encoder
+
+    def separate(self, wave):
+        """Split a 44.1 kHz stereo song into 16 kHz mono (vocal, instruments)."""
+        if wave.ndim == 1:
+            # mono to stereo
+            wave = np.asarray([wave, wave])
+
+        X_spec = spec_utils.wave_to_spectrogram(
+            wave, self.hop_length, self.n_fft, backend=self.stft_backend, device=self.device)
+        if self.tta:
+            y_spec, v_spec = self.separator.separate_tta(X_spec)
+        else:
+            y_spec, v_spec = self.separator.separate(X_spec)
+
+        music = spec_utils.spectrogram_to_wave(
+            y_spec, hop_length=self.hop_length, backend=self.stft_backend, device=self.device)
+        vocal = spec_utils.spectrogram_to_wave(
+            v_spec, hop_length=self.hop_length, backend=self.stft_backend, device=self.device)
+
+        music = librosa.resample(
+            librosa.to_mono(music), orig_sr=SEPARATOR_SR, target_sr=CONVERT_SR)
+        vocal = librosa.resample(
+            librosa.to_mono(vocal), orig_sr=SEPARATOR_SR, target_sr=CONVERT_SR)
+
+        return vocal.astype(np.float32), music.astype(np.float32)
+
+    def get_target(self, ref_wav_path):
+        """Compute the d-vector and log-F0 mean/std of the target speaker.
+
+        `ref_wav_path` may be a path or the encoded audio file as bytes.
+        """
+        if isinstance(ref_wav_path, bytes):
+            ref_wav_path = io.BytesIO(ref_wav_path)
+        ref_spk_dvec, ref_lf0_mean, ref_lf0_std = compute_ref_features(
+            ref_wav_path, encoder=self.get_spk_encoder, cache=self.ref_cache)
+        ref_spk_dvec = torch.from_numpy(ref_spk_dvec).unsqueeze(0).to(self.device)
+        return ref_spk_dvec, ref_lf0_mean, ref_lf0_std
+
+    def convert_vocal(self, vocal, target):
+        """Convert a 16 kHz vocal to the target speaker, returned at 16 kHz."""
+        ref_spk_dvec, ref_lf0_mean, ref_lf0_std = target
+        converted, _ = convert_wav(
+            vocal, ref_spk_dvec, ref_lf0_mean, ref_lf0_std,
+            self.ppg_model, self.ppg2mel_model, self.hifigan_model, self.device,
+        )
+        converted = librosa.resample(converted, orig_sr=VOCODER_SR, target_sr=CONVERT_SR)
+        return converted.astype(np.float32)
+
+    def convert(self, source, target_wav_path):
+        """Convert a song to the voice of the target speaker.
+
+        Args:
+            source: path or encoded bytes of the source song, or a 44.1 kHz
+                waveform of shape (N,) or (2, N).
+            target_wav_path: path or encoded bytes of a recording of the target speaker.
+
+        Returns:
+            ndarray: the converted song at 16 kHz.
+        """
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        if not isinstance(source, np.ndarray):
+            source, _ = librosa.load(
+                source, SEPARATOR_SR, False, dtype=np.float32, res_type='kaiser_fast')
+
+        vocal, music = self.separate(source)
+        target = self.get_target(target_wav_path)
+        converted = self.convert_vocal(vocal, target)
+
+        return mix_signals(converted, music)
+
+    def __call__(self, source, target_wav_path, out_file=None):
+        mixed = self.convert(source, target_wav_path)
+        if out_file is not None:
+            sf.write(out_file, mixed, samplerate=CONVERT_SR)
+        return mixed
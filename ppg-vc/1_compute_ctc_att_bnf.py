@@ -17,36 +17,117 @@ from conformer_ppg_model.build_ppg_model import load_ppg_model
 SAMPLE_RATE=16000
 
 
+class WavDataset(torch.utils.data.Dataset):
+    """Decode and resample wav files in DataLoader workers."""
+    def __init__(self, wav_file_list):
+        self.wav_file_list = wav_file_list
+
+    def __len__(self):
+        return len(self.wav_file_list)
+
+    def __getitem__(self, index):
+        wav_file = self.wav_file_list[index]
+        audio, sr = soundfile.read(wav_file, always_2d=False)
+        if sr != SAMPLE_RATE:
+            audio = librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE)
+        return wav_file, audio.astype(np.float32)
+
+
+def collate_wavs(batch):
+    """Zero-pad a list of (wav_file, audio) into a (B, L) batch."""
+    wav_files = [x[0] for x in batch]
+    lengths = [x[1].shape[0] for x in batch]
+    audio_padded = np.zeros((len(batch), max(lengths)), dtype=np.float32)
+    for i, (_, audio) in enumerate(batch):
+        audio_padded[i, :audio.shape[0]] = audio
+    return wav_files, torch.from_numpy(audio_padded), torch.LongTensor(lengths)
+
+
+def make_length_buckets(wav_file_list, batch_size, max_batch_seconds):
+    """Group utterances of similar duration into batches.
+
+    Utterances are sorted by duration, so padding within a batch is small.
+    A batch is closed when it has `batch_size` utterances or when its padded
+    duration would exceed `max_batch_seconds`.
+    """
+    durations = [soundfile.info(wav_file).duration for wav_file in wav_file_list]
+    batches = []
+    cur_batch = []
+    for index in np.argsort(durations):
+        padded_seconds = (len(cur_batch) + 1) * durations[index]
+        if cur_batch and (len(cur_batch) == batch_size or padded_seconds > max_batch_seconds):
+            batches.append(cur_batch)
+            cur_batch = []
+        cur_batch.append(int(index))
+    if cur_batch:
+        batches.append(cur_batch)
+    return batches
+
+
+def max_batched_bnf_diff(ppg_model, wav_tensor, wav_lengths, bnf, bnf_lengths):
+    """Largest absolute difference between padded batch BNFs and the BNFs
+    of each utterance computed alone."""
+    max_diff = 0.0
+    for i, wav_length in enumerate(wav_lengths.tolist()):
+        single_bnf = ppg_model(wav_tensor[i:i+1, :wav_length], wav_lengths[i:i+1])
+        diff = (bnf[i, :bnf_lengths[i]] - single_bnf[0]).abs().max().item()
+        max_diff = max(max_diff, diff)
+    return max_diff
+
+
 def compute_bnf(
     output_dir: str,
     wav_dir: str,
     train_config: str,
     model_file: str,
+    device: str = None,
+    batch_size: int = 1,
+    max_batch_seconds: float = 300.0,
+    num_workers: int = 4,
+    check_batched: bool = False,
 ):
-    device = "cuda"
-    
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
     # 1. Build PPG model
     ppg_model_local = load_ppg_model(train_config, model_file, device)
 
     # 2. Glob wav files
     wav_file_list = glob2.glob(f"{wav_dir}/**/*.wav")
     print(f"Globbing {len(wav_file_list)} wav files.")
-    
-    # 3. start to compute ppgs
+
+    # 3. Sort into length buckets; decode and resample in background workers
+    if batch_size > 1:
+        batches = make_length_buckets(wav_file_list, batch_size, max_batch_seconds)
+    else:
+        batches = [[i] for i in range(len(wav_file_list))]
+    dataloader = torch.utils.data.DataLoader(
+        WavDataset(wav_file_list),
+        batch_sampler=batches,
+        num_workers=num_workers,
+        collate_fn=collate_wavs,
+    )
+
+    # 4. start to compute ppgs
     os.makedirs(output_dir, exist_ok=True)
-    for wav_file in tqdm(wav_file_list):
-        audio, sr = soundfile.read(wav_file, always_2d=False)
-        if sr != SAMPLE_RATE:
-            audio = librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE)
-        wav_tensor = torch.from_numpy(audio).float().to(device).unsqueeze(0)
-        wav_length = torch.LongTensor([audio.shape[0]]).to(device)
+    for wav_files, wav_tensor, wav_lengths in tqdm(dataloader):
+        wav_tensor = wav_tensor.to(device)
+        wav_lengths = wav_lengths.to(device)
         with torch.no_grad():
-            bnf = ppg_model_local(wav_tensor, wav_length) 
+            bnf, bnf_lengths = ppg_model_local(wav_tensor, wav_lengths, return_lengths=True)
             # bnf = torch.nn.functional.softmax(asr_model.ctc.ctc_lo(bnf), dim=2)
-        bnf_npy = bnf.squeeze(0).cpu().numpy()
-        fid = os.path.basename(wav_file).split(".")[0]
-        bnf_fname = f"{output_dir}/{fid}.ling_feat.npy"
-        np.save(bnf_fname, bnf_npy, allow_pickle=False)
+            if check_batched and len(wav_files) > 1:
+                max_diff = max_batched_bnf_diff(
+                    ppg_model_local, wav_tensor, wav_lengths, bnf, bnf_lengths)
+                print(f"Batched vs single BNFs of {len(wav_files)} utterances: "
+                      f"max abs diff {max_diff:.2e}")
+                check_batched = False
+        bnf = bnf.cpu().numpy()
+        bnf_lengths = bnf_lengths.cpu().numpy()
+        for wav_file, bnf_npy, bnf_length in zip(wav_files, bnf, bnf_lengths):
+            fid = os.path.basename(wav_file).split(".")[0]
+            bnf_fname = f"{output_dir}/{fid}.ling_feat.npy"
+            np.save(bnf_fname, bnf_npy[:bnf_length], allow_pickle=False)
 
 
 def get_parser():
@@ -74,6 +155,38 @@ def get_parser():
         type=str,
         default="./conformer_ppg_model/en_conformer_ctc_att/24epoch.pth",
     )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="Defaults to cuda if available, otherwise cpu.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Maximum number of utterances per length bucket. Padded batches "
+             "give the BNFs of one utterance at a time up to float rounding "
+             "(see --check_batched), the default of 1 keeps the exact outputs.",
+    )
+    parser.add_argument(
+        "--max_batch_seconds",
+        type=float,
+        default=300.0,
+        help="Maximum padded audio duration of a batch.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="DataLoader workers decoding and resampling wavs.",
+    )
+    parser.add_argument(
+        "--check_batched",
+        action="store_true",
+        help="Recompute the first batch one utterance at a time and print "
+             "the largest difference to the batched BNFs.",
+    )
 
     return parser
 
@@ -1,4 +1,5 @@
 import os, sys
+import time
 from speaker_encoder.voice_encoder import SpeakerEncoder
 from speaker_encoder.audio import preprocess_wav
 from pathlib import Path
@@ -12,30 +13,62 @@ import glob
 import argparse
 
 
-def build_from_path(in_dir, out_dir, weights_fpath, num_workers=1):
-    executor = ProcessPoolExecutor(max_workers=num_workers)
-    futures = []
+# Speaker encoder of the current worker process, see _init_worker().
+_encoder = None
+
+
+def _init_worker(weights_fpath, device=None):
+    global _encoder
+    _encoder = SpeakerEncoder(weights_fpath, device=device, verbose=False)
+
+
+def _utt_id(wav_path):
+    return os.path.basename(wav_path).rstrip(".wav")
+
+
+def build_from_path(in_dir, out_dir, weights_fpath, num_workers=1, batch_size=32, device=None):
     wavfile_paths = glob.glob(os.path.join(in_dir, '*/*/*.wav'))
     wavfile_paths= sorted(wavfile_paths)
-    for wav_path in wavfile_paths:
-        futures.append(executor.submit(
-            partial(_compute_spkEmbed, out_dir, wav_path, weights_fpath)))
-    return [future.result() for future in tqdm(futures)]
-
-def _compute_spkEmbed(out_dir, wav_path, weights_fpath):
-    utt_id = os.path.basename(wav_path).rstrip(".wav")
-    fpath = Path(wav_path)
-    wav = preprocess_wav(fpath)
-
-    encoder = SpeakerEncoder(weights_fpath)
-    embed = encoder.embed_utterance(wav)
-    fname_save = os.path.join(out_dir, f"{utt_id}.npy")
-    np.save(fname_save, embed, allow_pickle=False)
-    return os.path.basename(fname_save)
-
-def preprocess(in_dir, out_dir, weights_fpath, num_workers):
+    # Resume: skip utterances whose embedding was already written
+    todo_paths = [
+        wav_path for wav_path in wavfile_paths
+        if not os.path.isfile(os.path.join(out_dir, f"{_utt_id(wav_path)}.npy"))
+    ]
+    print(f"[INFO] {len(wavfile_paths) - len(todo_paths)} of {len(wavfile_paths)} files already done.")
+    batches = [todo_paths[i:i + batch_size] for i in range(0, len(todo_paths), batch_size)]
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                             initargs=(weights_fpath, device)) as executor:
+        futures = [
+            executor.submit(partial(_compute_spkEmbed, out_dir, wav_paths))
+            for wav_paths in batches
+        ]
+        metadata = []
+        for future in tqdm(futures):
+            metadata.extend(future.result())
+    elapsed = time.time() - start
+    print(f"[INFO] Embedded {len(metadata)} files in {elapsed:.1f}s "
+          f"({len(metadata) / max(elapsed, 1e-8):.2f} files/sec).")
+    return metadata
+
+def _compute_spkEmbed(out_dir, wav_paths):
+    wavs = [preprocess_wav(Path(wav_path)) for wav_path in wav_paths]
+    embeds = _encoder.embed_utterances_batch(wavs)
+
+    fnames = []
+    for wav_path, embed in zip(wav_paths, embeds):
+        fname_save = os.path.join(out_dir, f"{_utt_id(wav_path)}.npy")
+        # Write to a temporary file first so an interrupted run never leaves a partial .npy
+        with open(f"{fname_save}.tmp", "wb") as f:
+            np.save(f, embed, allow_pickle=False)
+        os.replace(f"{fname_save}.tmp", fname_save)
+        fnames.append(os.path.basename(fname_save))
+    return fnames
+
+def preprocess(in_dir, out_dir, weights_fpath, num_workers, batch_size=32, device=None):
     os.makedirs(out_dir, exist_ok=True)
-    metadata = build_from_path(in_dir, out_dir, weights_fpath, num_workers)
+    metadata = build_from_path(in_dir, out_dir, weights_fpath, num_workers, batch_size, device)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -46,6 +79,10 @@ if __name__ == "__main__":
         default='/home/shaunxliu/data/datasets/LibriTTS')
     parser.add_argument('--spk_encoder_ckpt', type=str, \
         default='speaker_encoder/ckpt/pretrained_bak_5805000.pt')
+    parser.add_argument('--batch_size', type=int, default=32,
+        help='Number of files embedded together by a worker.')
+    parser.add_argument('--device', type=str, default=None,
+        help='Speaker encoder device, defaults to cuda if available.')
 
     args = parser.parse_args()
     
@@ -72,7 +109,8 @@ if __name__ == "__main__":
             # preprocess(in_dir, spk_embed_out_dir, args.spk_encoder_ckpt, args.num_workers)
     for data_split in split_list:
         in_dir = os.path.join(args.in_dir, data_split)
-        preprocess(in_dir, spk_embed_out_dir, args.spk_encoder_ckpt, args.num_workers)
+        preprocess(in_dir, spk_embed_out_dir, args.spk_encoder_ckpt, args.num_workers,
+                   args.batch_size, args.device)
 
     print("DONE!")
     sys.exit(0)
@@ -0,0 +1,78 @@
+"""
+Pack per-utterance feature files (PPG / F0 / d-vector) into a sharded,
+memory-mapped feature store, see src/feature_store.py.
+
+Run once per feature, e.g.
+    python 4_pack_features.py --name ppg --file_ext ling_feat.npy \
+        --feature_dirs vctk/conformer_bnf10ms LibriTTS/conformer_bnf10ms --output_dir feature_store
+    python 4_pack_features.py --name f0 --file_ext f0.npy \
+        --feature_dirs vctk/merged_f0s LibriTTS/f0s --output_dir feature_store
+    python 4_pack_features.py --name spk_dvec --file_ext npy \
+        --feature_dirs vctk/GE2E_spkEmbed_step_5805000_perSpk \
+        LibriTTS/GE2E_spkEmbed_step_5805000_perSpk --output_dir feature_store
+"""
+import os
+import glob
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+from src.feature_store import FeatureStoreWriter
+
+
+def pack_features(
+    name: str,
+    feature_dirs: list,
+    file_ext: str,
+    output_dir: str,
+    shard_size_mb: int = 1024,
+):
+    feature_files = []
+    for feature_dir in feature_dirs:
+        feature_files.extend(sorted(glob.glob(f"{feature_dir}/*.{file_ext}")))
+    print(f"Globbed {len(feature_files)} {name} files.")
+
+    with FeatureStoreWriter(output_dir, name, shard_size_mb) as writer:
+        for feature_file in tqdm(feature_files):
+            key = os.path.basename(feature_file)[:-len(file_ext) - 1]
+            writer.add(key, np.load(feature_file))
+    print(f"Packed {len(writer.index)} {name} entries into {writer.num_shards} shards.")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Pack features into a sharded feature store")
+    parser.add_argument(
+        "--name",
+        type=str,
+        required=True,
+        help="Feature name used by the datasets: ppg, f0, spk_dvec or mel.",
+    )
+    parser.add_argument(
+        "--feature_dirs",
+        type=str,
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "--file_ext",
+        type=str,
+        required=True,
+        help="Feature file extension, e.g. ling_feat.npy",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--shard_size_mb",
+        type=int,
+        default=1024,
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    pack_features(**vars(args))
@@ -0,0 +1,107 @@
+"""
+Precompute the mel cache used by OneshotVcDataset (data.mel_cache_dir).
+"""
+import os
+import numpy as np
+from tqdm import tqdm
+
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from utils.load_yaml import HpsYaml
+from src.data_load import (
+    read_fids, compute_mel, bin_level_min_max_norm, get_mel_cache_dir, save_cached_mel,
+)
+
+
+def process_one(
+    fid,
+    wav_path,
+    cache_dir,
+    mel_min=None,
+    mel_max=None,
+):
+    mel_fname = f"{cache_dir}/{fid}.mel.npy"
+    if os.path.isfile(mel_fname):
+        return
+    mel = compute_mel(wav_path)
+    if mel_min is not None:
+        mel = bin_level_min_max_norm(mel, mel_min, mel_max)
+    save_cached_mel(mel_fname, mel)
+
+
+def run(args):
+    config = HpsYaml(args.config)
+    data = config.data
+    if args.mel_cache_dir is not None:
+        data.mel_cache_dir = args.mel_cache_dir
+    assert data.get("mel_cache_dir") is not None, "Set data.mel_cache_dir or --mel_cache_dir."
+
+    # Must match the cache directory chosen by OneshotVcDataset
+    mel_min = mel_max = None
+    if data.get("mel_cache_norm", False) and data.min_max_norm_mel:
+        mel_min, mel_max = data.mel_min, data.mel_max
+    cache_dir = get_mel_cache_dir(data.mel_cache_dir, mel_min, mel_max)
+    os.makedirs(cache_dir, exist_ok=True)
+    print(f"Mel cache: {cache_dir}")
+
+    fids = []
+    for fid_list in [data.train_fid_list, data.dev_fid_list]:
+        fids.extend(read_fids(fid_list))
+    fids = sorted(set(fids))
+    print(f"Got {len(fids)} utterances.")
+
+    jobs = []
+    for fid in fids:
+        wav_dir = data.vctk_wav_dir if fid.startswith("p") else data.libri_wav_dir
+        jobs.append((fid, f"{wav_dir}/{fid}.{data.wav_file_ext}"))
+
+    # Multi-process worker
+    if args.num_workers < 2:
+        for fid, wav_path in tqdm(jobs):
+            process_one(fid, wav_path, cache_dir, mel_min, mel_max)
+    else:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = []
+            for fid, wav_path in jobs:
+                futures.append(executor.submit(
+                    partial(
+                        process_one, fid, wav_path, cache_dir, mel_min, mel_max,
+                    )
+                ))
+            results = [future.result() for future in tqdm(futures)]
+
+
+def get_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description="Precompute mel-spectrogram cache")
+    parser.add_argument(
+        "--config",
+        required=True,
+        type=str,
+        help="Training config file (yaml file)",
+    )
+    parser.add_argument(
+        "--mel_cache_dir",
+        default=None,
+        type=str,
+        help="Overrides data.mel_cache_dir of the config.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=cpu_count(),
+        type=int
+    )
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    print(args)
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark MoL decoder steps/sec on CPU: the eager Decoder.inference loop
+against the functional DecoderStep, eager, scripted and compiled.
+
+    python bench_decoder_step.py --config conf/seq2seq_mol_ppg2mel_vctk_libri_oneshotvc_r4_normMel_v2.yaml
+"""
+import time
+import argparse
+import torch
+
+from utils.load_yaml import HpsYaml
+from src import build_model
+
+
+def time_decoder(run, n_runs):
+    """Best wall time of `n_runs` calls of run(), after one warm-up call."""
+    out = run()
+    best = float("inf")
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    config = HpsYaml(args.config)
+    model = build_model(config["model_name"])(**config["model"])
+    if args.model_file is not None:
+        model.load_state_dict(torch.load(args.model_file, map_location="cpu")["model"])
+    model.eval()
+    decoder = model.decoder
+
+    # Random encoder outputs; stop_threshold > 1 decodes max_decoder_step steps.
+    torch.manual_seed(0)
+    n_frames = int(args.seconds * 100) // decoder.encoder_down_factor
+    memory = torch.randn(1, n_frames, decoder.enc_dim)
+    stop_threshold = 1.1
+    n_steps = n_frames * decoder.encoder_down_factor // decoder.frames_per_step
+    print(f"[INFO] {n_steps} decoder steps, {torch.get_num_threads()} threads")
+
+    modes = {
+        "eager": lambda: decoder.inference(memory, stop_threshold)[0],
+        "functional": lambda: decoder.inference_functional(
+            memory, decoder.make_step(), stop_threshold),
+    }
+    scripted_step = torch.jit.script(decoder.make_step())
+    modes["script"] = lambda: decoder.inference_functional(
+        memory, scripted_step, stop_threshold)
+    if args.compile and hasattr(torch, "compile"):
+        compiled_step = torch.compile(decoder.make_step(), dynamic=False)
+        modes["compile"] = lambda: decoder.inference_functional(
+            memory, compiled_step, stop_threshold)
+
+    reference = None
+    with torch.no_grad():
+        for name, run in modes.items():
+            # The prenet dropout is always on, reseed for identical outputs.
+            # Compiled kernels draw their own random numbers, so only
+            # "compile" differs from eager.
+            def seeded_run():
+                torch.manual_seed(1)
+                return run()
+            mel, elapsed = time_decoder(seeded_run, args.n_runs)
+            if reference is None:
+                reference = mel
+            err = (mel - reference).abs().max().item()
+            print(f"{name:>10}: {n_steps / elapsed:8.1f} steps/sec, max abs diff to eager {err:.2e}")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="MoL decoder step benchmark")
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="conf/seq2seq_mol_ppg2mel_vctk_libri_oneshotvc_r4_normMel_v2.yaml",
+        help="ppg2mel training config (yaml file)",
+    )
+    parser.add_argument(
+        "--model_file",
+        type=str,
+        default=None,
+        help="Optional checkpoint, random weights otherwise.",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=10.0,
+        help="Length of the decoded audio.",
+    )
+    parser.add_argument("--n_runs", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument(
+        "--no_compile",
+        dest="compile",
+        action="store_false",
+        help="Skip torch.compile, e.g. without a C++ compiler.",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    main(args)
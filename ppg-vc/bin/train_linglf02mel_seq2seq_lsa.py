@@ -36,6 +36,7 @@ class Solver(BaseSolver):
             f0_dir=self.config.data.f0_dir,
             mel_dir=self.config.data.mel_dir,
             ppg_file_ext=self.config.data.ppg_file_ext,
+            feature_store_dir=self.config.data.get("feature_store_dir"),
         )
         dev_dataset = MultiSpkVcDataset(
             meta_file=self.config.data.dev_fid_list,
@@ -43,6 +44,7 @@ class Solver(BaseSolver):
             f0_dir=self.config.data.f0_dir,
             mel_dir=self.config.data.mel_dir,
             ppg_file_ext=self.config.data.ppg_file_ext,
+            feature_store_dir=self.config.data.get("feature_store_dir"),
         )
         self.train_dataloader = DataLoader(
             train_dataset,
@@ -47,6 +47,9 @@ class Solver(BaseSolver):
             min_max_norm_mel=self.config.data.min_max_norm_mel,
             mel_min=self.config.data.mel_min,
             mel_max=self.config.data.mel_max,
+            feature_store_dir=self.config.data.get("feature_store_dir"),
+            mel_cache_dir=self.config.data.get("mel_cache_dir"),
+            mel_cache_norm=self.config.data.get("mel_cache_norm", False),
         )
         dev_dataset = OneshotVcDataset(
             meta_file=self.config.data.dev_fid_list,
@@ -62,6 +65,9 @@ class Solver(BaseSolver):
             min_max_norm_mel=self.config.data.min_max_norm_mel,
             mel_min=self.config.data.mel_min,
             mel_max=self.config.data.mel_max,
+            feature_store_dir=self.config.data.get("feature_store_dir"),
+            mel_cache_dir=self.config.data.get("mel_cache_dir"),
+            mel_cache_norm=self.config.data.get("mel_cache_norm", False),
         )
         self.train_dataloader = DataLoader(
             train_dataset,
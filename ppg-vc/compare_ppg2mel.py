@@ -0,0 +1,216 @@
+"""
+Speed / quality comparison of ppg2mel models on the same inputs, e.g. the
+autoregressive MoL seq2seq model against the non-autoregressive BiRNN one:
+
+    python compare_ppg2mel.py --src_wav_dir <wav_dir> --ref_wav_path <ref.wav> \
+        --configs conf/seq2seq_mol_ppg2mel_vctk_libri_oneshotvc_r4_normMel_v2.yaml \
+                  conf/bilstm_ppg2mel_vctk_libri_oneshotvc.yaml \
+        --model_files <mol_ckpt.pth> <bilstm_ckpt.pth>
+
+PPGs, converted F0s and the vocoder are shared, only the ppg2mel step is
+timed, row by row ("seq", as convert_wav) and as padded batches ("batch").
+The batched PPGs are checked against per-row ones on the longest batch.
+Quality is reported without ground truth:
+    mel_l1: mean L1 distance to the mels of the first model in "seq" mode.
+    f0_rmse: F0 RMSE (cents) of the vocoded output against the converted
+        input F0, on frames voiced in both; vuv_err: V/UV mismatch rate.
+    spk_sim: cosine similarity of the output d-vector to the reference one.
+"""
+import os
+import glob
+import time
+import argparse
+import torch
+import numpy as np
+import librosa
+import resampy
+import soundfile as sf
+
+from utils.load_yaml import HpsYaml
+from src.rnn_ppg2mel import BiRnnPpg2MelModel
+from conformer_ppg_model.build_ppg_model import load_ppg_model
+from vocoders.hifigan_model import load_hifigan_generator
+from speaker_encoder.voice_encoder import SpeakerEncoder
+from speaker_encoder.audio import preprocess_wav
+from convert_from_wav import (
+    build_ppg2mel_model, compute_ref_features, compute_batched_features,
+    ppg2mel_batched, compute_f0,
+)
+
+
+def ppg2mel_sequential(ppg2mel_model, ppg, logf0_uv, spembs, ppg_lengths):
+    """Convert row by row, as convert_wav does."""
+    mels = []
+    for i, l in enumerate(ppg_lengths.tolist()):
+        if isinstance(ppg2mel_model, BiRnnPpg2MelModel):
+            mel = ppg2mel_model(
+                ppg[i:i+1, :l], ppg_lengths[i:i+1], logf0_uv[i:i+1, :l], spembs[i:i+1])[0]
+        else:
+            _, mel, _ = ppg2mel_model.inference(
+                ppg[i:i+1, :l], logf0_uv=logf0_uv[i:i+1, :l], spembs=spembs[i:i+1])
+        mels.append(mel)
+    return mels
+
+
+def max_ppg_diff(src_wavs, ppg, ppg_lengths, ppg_model, device):
+    """Largest difference between batched PPGs and the PPGs of each wave alone."""
+    max_diff = 0.0
+    for i, (wav, l) in enumerate(zip(src_wavs, ppg_lengths.tolist())):
+        single_ppg = ppg_model(
+            torch.from_numpy(wav).unsqueeze(0).to(device), torch.LongTensor([len(wav)]).to(device))
+        max_diff = max(max_diff, (ppg[i, :l] - single_ppg[0, :l]).abs().max().item())
+    return max_diff
+
+
+def timed(fn, device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def f0_errors(y, logf0_uv):
+    """F0 RMSE in cents and V/UV error rate of a 24 kHz output."""
+    f0 = compute_f0(resampy.resample(y, 24000, 16000))
+    n = min(len(f0), len(logf0_uv))
+    f0, lf0_trg, uv_trg = f0[:n], logf0_uv[:n, 0], logf0_uv[:n, 1] > 0.5
+    voiced = (f0 > 0) & uv_trg
+    vuv_err = np.mean((f0 > 0) != uv_trg)
+    if not np.any(voiced):
+        return np.nan, vuv_err
+    cents = 1200 * (np.log(f0[voiced]) - lf0_trg[voiced]) / np.log(2)
+    return np.sqrt(np.mean(cents ** 2)), vuv_err
+
+
+@torch.no_grad()
+def main(args):
+    device = args.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    assert len(args.configs) == len(args.model_files)
+
+    ppg_model = load_ppg_model(
+        './conformer_ppg_model/en_conformer_ctc_att/config.yaml',
+        './conformer_ppg_model/en_conformer_ctc_att/24epoch.pth',
+        device,
+    )
+    hifigan_model = load_hifigan_generator(device)
+    encoder = SpeakerEncoder(args.spk_encoder_file)
+    ref_spk_dvec, ref_lf0_mean, ref_lf0_std = compute_ref_features(
+        args.ref_wav_path, encoder=encoder)
+    ref_spk_dvec = torch.from_numpy(ref_spk_dvec).unsqueeze(0).to(device)
+
+    source_file_list = sorted(glob.glob(f"{args.src_wav_dir}/*.wav"))[:args.max_utts]
+    src_wavs = [librosa.load(path, sr=16000)[0] for path in source_file_list]
+    total_seconds = sum(len(wav) for wav in src_wavs) / 16000
+    print(f"[INFO] {len(src_wavs)} utterances, {total_seconds:.1f} s of audio on {device}.")
+
+    # Shared inputs, batches of similar length
+    order = np.argsort([len(wav) for wav in src_wavs])
+    batches = []
+    for i in range(0, len(order), args.batch_size):
+        batch = order[i:i + args.batch_size]
+        batches.append((batch, compute_batched_features(
+            [src_wavs[j] for j in batch], ref_lf0_mean, ref_lf0_std, ppg_model, device)))
+    batch, (ppg, _, ppg_lengths) = batches[-1]
+    ppg_diff = max_ppg_diff([src_wavs[j] for j in batch], ppg, ppg_lengths, ppg_model, device)
+    print(f"[INFO] Batched vs per-row PPGs: max abs diff {ppg_diff:.2e}")
+
+    reference_mels = None
+    for config_file, model_file in zip(args.configs, args.model_files):
+        config = HpsYaml(config_file)
+        ppg2mel_model = build_ppg2mel_model(config, model_file, device)
+        for mode in ["seq", "batch"]:
+            name = f"{config['model_name']}/{mode}"
+            mels = [None] * len(src_wavs)
+            logf0_uvs = [None] * len(src_wavs)
+            elapsed = 0.0
+            for batch, (ppg, logf0_uv, ppg_lengths) in batches:
+                spembs = ref_spk_dvec.expand(len(batch), -1)
+                if mode == "seq":
+                    batch_mels, t = timed(lambda: ppg2mel_sequential(
+                        ppg2mel_model, ppg, logf0_uv, spembs, ppg_lengths), device)
+                else:
+                    (mel_outputs, mel_lengths), t = timed(lambda: ppg2mel_batched(
+                        ppg2mel_model, ppg, logf0_uv, spembs, ppg_lengths), device)
+                    batch_mels = [mel[:l] for mel, l in zip(mel_outputs, mel_lengths.tolist())]
+                elapsed += t
+                for j, mel, lf0_uv, l in zip(batch, batch_mels, logf0_uv, ppg_lengths.tolist()):
+                    mels[j] = mel
+                    logf0_uvs[j] = lf0_uv[:l].cpu().numpy()
+            if reference_mels is None:
+                reference_mels = mels
+
+            mel_l1, f0_rmse, vuv_err, spk_sim = [], [], [], []
+            for j, (mel, ref_mel) in enumerate(zip(mels, reference_mels)):
+                n = min(len(mel), len(ref_mel))
+                mel_l1.append((mel[:n] - ref_mel[:n]).abs().mean().item())
+                y = hifigan_model(mel.view(1, -1, 80).transpose(1, 2)).squeeze().cpu().numpy()
+                rmse, err = f0_errors(y, logf0_uvs[j])
+                f0_rmse.append(rmse)
+                vuv_err.append(err)
+                dvec = encoder.embed_utterance(preprocess_wav(y, source_sr=24000))
+                spk_sim.append(float(np.dot(dvec, ref_spk_dvec[0].cpu().numpy())
+                                     / np.linalg.norm(dvec) / np.linalg.norm(ref_spk_dvec[0].cpu().numpy())))
+                if args.output_dir is not None:
+                    out_dir = f"{args.output_dir}/{name.replace('/', '_')}"
+                    os.makedirs(out_dir, exist_ok=True)
+                    src_fid = os.path.basename(source_file_list[j])[:-4]
+                    sf.write(f"{out_dir}/{src_fid}.wav", y, 24000, "PCM_16")
+            print(f"{name:>20}: ppg2mel {elapsed:7.2f} s ({total_seconds / elapsed:7.1f}x real time)"
+                  f" | mel_l1 {np.mean(mel_l1):.4f} | f0_rmse {np.nanmean(f0_rmse):6.1f} cents"
+                  f" | vuv_err {np.mean(vuv_err):.3f} | spk_sim {np.mean(spk_sim):.3f}")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Compare ppg2mel models")
+    parser.add_argument(
+        "--src_wav_dir",
+        type=str,
+        required=True,
+        help="Directory of source wave files.",
+    )
+    parser.add_argument(
+        "--ref_wav_path",
+        type=str,
+        required=True,
+        help="Reference wave file path.",
+    )
+    parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        required=True,
+        help="ppg2mel training configs (yaml files), the first one is the reference.",
+    )
+    parser.add_argument(
+        "--model_files",
+        type=str,
+        nargs="+",
+        required=True,
+        help="ppg2mel checkpoints, one per config.",
+    )
+    parser.add_argument(
+        "--spk_encoder_file",
+        type=str,
+        default="speaker_encoder/ckpt/pretrained_bak_5805000.pt",
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_utts", type=int, default=None)
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="Also save the converted waves for listening.",
+    )
+    parser.add_argument("--device", type=str, default=None)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    main(args)
@@ -21,20 +21,24 @@ class PPGModel(torch.nn.Module):
         self.normalize = normalizer
         self.encoder = encoder
 
-    def forward(self, speech, speech_lengths):
+    def forward(self, speech, speech_lengths, return_lengths=False):
         """
 
         Args:
             speech (tensor): (B, L)
             speech_lengths (tensor): (B, )
+            return_lengths (bool): also return the valid length of each output.
 
         Returns:
             bottle_neck_feats (tensor): (B, L//hop_size, 144)
+            bottle_neck_feat_lengths (tensor): (B, ), only if return_lengths is True.
 
         """
         feats, feats_lengths = self._extract_feats(speech, speech_lengths)
         feats, feats_lengths = self.normalize(feats, feats_lengths)
         encoder_out, encoder_out_lens, _ = self.encoder(feats, feats_lengths)
+        if return_lengths:
+            return encoder_out, encoder_out_lens
         return encoder_out
 
     def _extract_feats(
@@ -174,7 +174,20 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # compute matrix b and matrix d
         # (batch, head, time1, time2)
         matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
-        matrix_bd = self.rel_shift(matrix_bd)
+        lengths = None
+        if mask is not None and mask.size(1) == 1 and query.size(1) == key.size(1):
+            lengths = mask[:, 0].sum(-1).tolist()
+        if lengths is None or min(lengths) == matrix_bd.size(-1):
+            matrix_bd = self.rel_shift(matrix_bd)
+        else:
+            # rel_shift depends on the padded length, shift each utterance of
+            # a padded batch on its own, as if it was not batched
+            shifted = torch.zeros_like(matrix_bd)
+            for i, length in enumerate(lengths):
+                shifted[i, :, :length, :length] = self.rel_shift(
+                    matrix_bd[i : i + 1, :, :length, :length]
+                )[0]
+            matrix_bd = shifted
 
         scores = (matrix_ac + matrix_bd) / math.sqrt(
             self.d_k
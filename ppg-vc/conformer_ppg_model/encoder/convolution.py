@@ -52,10 +52,11 @@ class ConvolutionModule(nn.Module):
         )
         self.activation = activation
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         """Compute convolution module.
 
         :param torch.Tensor x: (batch, time, size)
+        :param torch.Tensor mask: optional (batch, 1, time), False on padded frames
         :return torch.Tensor: convoluted `value` (batch, time, d_model)
         """
         # exchange the temporal dimension and the feature dimension
@@ -65,7 +66,9 @@ class ConvolutionModule(nn.Module):
         x = self.pointwise_conv1(x)  # (batch, 2*channel, dim)
         x = nn.functional.glu(x, dim=1)  # (batch, channel, dim)
 
-        # 1D Depthwise Conv
+        # 1D Depthwise Conv, padded frames must not leak into the valid ones
+        if mask is not None:
+            x = x.masked_fill(~mask, 0.0)
         x = self.depthwise_conv(x)
         x = self.activation(self.norm(x))
 
@@ -128,7 +128,9 @@ class EncoderLayer(nn.Module):
             residual = x
             if self.normalize_before:
                 x = self.norm_conv(x)
-            x = residual + self.dropout(self.conv_module(x))
+            # with a cache x is the last frame only, there is nothing to mask
+            conv_mask = mask if cache is None else None
+            x = residual + self.dropout(self.conv_module(x, conv_mask))
             if not self.normalize_before:
                 x = self.norm_conv(x)
 
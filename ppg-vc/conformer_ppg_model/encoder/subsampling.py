@@ -117,7 +117,14 @@ class Conv2dNoSubsampling(torch.nn.Module):
 
         """
         x = x.unsqueeze(1)  # (b, c, t, f)
-        x = self.conv(x)
+        if x_mask is None:
+            x = self.conv(x)
+        else:
+            # zero the padded frames before each conv, so that they do not
+            # leak into the valid ones
+            time_mask = ~x_mask.unsqueeze(-1)  # (b, 1, t, 1)
+            x = self.conv[:2](x.masked_fill(time_mask, 0.0))
+            x = self.conv[2:](x.masked_fill(time_mask, 0.0))
         b, c, t, f = x.size()
         x = self.out(x.transpose(1, 2).contiguous().view(b, t, c * f))
         if x_mask is None:
@@ -45,6 +45,24 @@ class Stft(torch.nn.Module):
             f"onesided={self.onesided}"
         )
 
+    def _reflect_pad(self, input: torch.Tensor, ilens: torch.Tensor) -> torch.Tensor:
+        """Center padding of a zero-padded batch, as torch.stft(center=True).
+
+        Each row is reflected at its own end rather than at the end of the
+        batch, so that the frames of a short utterance do not depend on the
+        zero padding, i.e. on the other utterances of the batch.
+        """
+        pad = self.n_fft // 2
+        output = torch.nn.functional.pad(
+            input.unsqueeze(1), (pad, pad), mode="reflect"
+        ).squeeze(1)
+        for i, length in enumerate(ilens.tolist()):
+            if length < input.size(1):
+                output[i, pad + length : 2 * pad + length] = input[
+                    i, length - pad - 1 : length - 1
+                ].flip(0)
+        return output
+
     def forward(
         self, input: torch.Tensor, ilens: torch.Tensor = None
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
@@ -68,12 +86,20 @@ class Stft(torch.nn.Module):
         # output: (Batch, Freq, Frames, 2=real_imag)
         # or (Batch, Channel, Freq, Frames, 2=real_imag)
         if not self.kaldi_padding_mode:
+            center = self.center
+            if center and ilens is not None and self.pad_mode == "reflect":
+                if multi_channel:
+                    ilens_ = ilens.repeat_interleave(input.size(0) // bs)
+                else:
+                    ilens_ = ilens
+                input = self._reflect_pad(input, ilens_)
+                center = False
             output = torch.stft(
                 input,
                 n_fft=self.n_fft,
                 win_length=self.win_length,
                 hop_length=self.hop_length,
-                center=self.center,
+                center=center,
                 pad_mode=self.pad_mode,
                 normalized=self.normalized,
                 onesided=self.onesided,
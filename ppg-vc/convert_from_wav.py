@@ -1,3 +1,4 @@
+import io
 import time
 import sys
 import os
@@ -11,12 +12,14 @@ from conformer_ppg_model.build_ppg_model import load_ppg_model
 from src.mel_decoder_mol_encAddlf0 import MelDecoderMOL
 from src.mel_decoder_lsa import MelDecoderLSA
 from src.rnn_ppg2mel import BiRnnPpg2MelModel
+from src.mol_attention import MOLAttention
 import pyworld
 import librosa
 import resampy
 import soundfile as sf
 from utils.f0_utils import get_cont_lf0
 from utils.load_yaml import HpsYaml
+from utils.ref_cache import RefFeatureCache
 
 from vocoders.hifigan_model import load_hifigan_generator
 
@@ -27,10 +30,12 @@ from src import build_model
 
 def compute_spk_dvec(
     wav_path, weights_fpath="speaker_encoder/ckpt/pretrained_bak_5805000.pt",
+    encoder=None,
 ):
     fpath = Path(wav_path)
     wav = preprocess_wav(fpath)
-    encoder = SpeakerEncoder(weights_fpath)
+    if encoder is None:
+        encoder = SpeakerEncoder(weights_fpath)
     spk_dvec = encoder.embed_utterance(wav)
     return spk_dvec
 
@@ -61,15 +66,20 @@ def get_converted_lf0uv(
     lf0_mean_trg, 
     lf0_std_trg,
     convert=True,
+    f0_src=None,
+    lf0_mean_src=None,
+    lf0_std_src=None,
 ):
-    f0_src = compute_f0(wav)
+    if f0_src is None:
+        f0_src = compute_f0(wav)
     if not convert:
         uv, cont_lf0 = get_cont_lf0(f0_src)
         lf0_uv = np.concatenate([cont_lf0[:, np.newaxis], uv[:, np.newaxis]], axis=1)
         return lf0_uv
 
     lf0_src = f02lf0(f0_src)
-    lf0_mean_src, lf0_std_src = compute_mean_std(lf0_src)
+    if lf0_mean_src is None:
+        lf0_mean_src, lf0_std_src = compute_mean_std(lf0_src)
     
     lf0_vc = lf0_src.copy()
     lf0_vc[lf0_src > 0.0] = (lf0_src[lf0_src > 0.0] - lf0_mean_src) / lf0_std_src * lf0_std_trg + lf0_mean_trg
@@ -92,57 +102,106 @@ def build_ppg2mel_model(model_config, model_file, device):
     return ppg2mel_model
 
 
-@torch.no_grad()
-def convert(args):
-    wav_fname = args.wav_fname
-    device = 'cuda'
-    ppg2mel_config = HpsYaml(args.ppg2mel_model_train_config)
+def set_attention_window(ppg2mel_model, window_size):
+    """Use windowed MoL attention of `window_size` encoder frames, None for full width."""
+    attention_layer = getattr(getattr(ppg2mel_model, "decoder", None), "attention_layer", None)
+    if isinstance(attention_layer, MOLAttention):
+        attention_layer.window_size = window_size
+    else:
+        print(f"[INFO] {type(ppg2mel_model).__name__} has no MoL attention, ignoring the window.")
 
-    step = os.path.basename(args.ppg2mel_model_file)[:-4].split("_")[-1]
 
-    # Build models
-    print("Load PPG-model, PPG2Mel-model, Vocoder-model...")
+def load_conversion_models(ppg2mel_model_train_config, ppg2mel_model_file, device):
+    """Load the PPG model, the ppg2mel model and the HiFi-GAN vocoder."""
+    ppg2mel_config = HpsYaml(ppg2mel_model_train_config)
     ppg_model = load_ppg_model(
         './conformer_ppg_model/en_conformer_ctc_att/config.yaml', 
         './conformer_ppg_model/en_conformer_ctc_att/24epoch.pth',
         device,
     )
-    ppg2mel_model = build_ppg2mel_model(ppg2mel_config, args.ppg2mel_model_file, device) 
+    ppg2mel_model = build_ppg2mel_model(ppg2mel_config, ppg2mel_model_file, device) 
     hifigan_model = load_hifigan_generator(device)
-    
-    # Data related
-    ref_wav_path = args.ref_wav_path
-    ref_fid = os.path.basename(ref_wav_path)[:-4]
-    ref_spk_dvec = compute_spk_dvec(ref_wav_path)
-    ref_spk_dvec = torch.from_numpy(ref_spk_dvec).unsqueeze(0).to(device)
+    return ppg_model, ppg2mel_model, hifigan_model
+
+
+def compute_ref_features(
+    ref_wav_path, encoder=None,
+    weights_fpath="speaker_encoder/ckpt/pretrained_bak_5805000.pt",
+    cache=None,
+):
+    """Compute the d-vector and log-F0 statistics of a reference speaker.
+
+    `ref_wav_path` may also be a file-like object, e.g. an uploaded file.
+    `encoder` may be a SpeakerEncoder or a callable returning one, so that the
+    model is only loaded when `cache` (a RefFeatureCache) misses.
+    """
+    if cache is not None:
+        if isinstance(ref_wav_path, (str, Path)):
+            with open(ref_wav_path, "rb") as f:
+                audio_bytes = f.read()
+        else:
+            audio_bytes = ref_wav_path.read()
+        feats = cache.get(audio_bytes)
+        if feats is not None:
+            return feats
+        ref_wav_path = io.BytesIO(audio_bytes)
+
     ref_wav, _ = librosa.load(ref_wav_path, sr=16000)
+    if encoder is None:
+        encoder = SpeakerEncoder(weights_fpath)
+    elif not isinstance(encoder, SpeakerEncoder):
+        encoder = encoder()
+    ref_spk_dvec = encoder.embed_utterance(preprocess_wav(ref_wav))
     ref_lf0_mean, ref_lf0_std = compute_mean_std(f02lf0(compute_f0(ref_wav)))
-    
-    # source_file_list = sorted(glob.glob(f"{args.src_wav_dir}/*.wav"))
-    # print(f"Number of source utterances: {len(source_file_list)}.")
-    
-    total_rtf = 0.0
-    cnt = 0
 
-    src_wav_path = args.src_wav_dir
-        
-    # Load the audio to a numpy array:
-    src_wav, _ = librosa.load(src_wav_path, sr=16000)
+    if cache is not None:
+        cache.put(audio_bytes, (ref_spk_dvec, ref_lf0_mean, ref_lf0_std))
+    return ref_spk_dvec, ref_lf0_mean, ref_lf0_std
+
+
+@torch.no_grad()
+def convert_wav(
+    src_wav,
+    ref_spk_dvec,
+    ref_lf0_mean,
+    ref_lf0_std,
+    ppg_model,
+    ppg2mel_model,
+    hifigan_model,
+    device,
+    src_f0=None,
+    src_lf0_stats=None,
+):
+    """Convert a 16 kHz source waveform to the reference speaker.
+
+    `src_f0` and `src_lf0_stats` (mean, std) override the source F0 and its
+    log-F0 statistics, which are otherwise computed from `src_wav`.
+
+    Returns:
+        y (ndarray): converted waveform at 24 kHz.
+        mel_len (int): number of generated mel frames.
+    """
+    if isinstance(ref_spk_dvec, np.ndarray):
+        ref_spk_dvec = torch.from_numpy(ref_spk_dvec).unsqueeze(0).to(device)
+
     src_wav_tensor = torch.from_numpy(src_wav).unsqueeze(0).float().to(device)
     src_wav_lengths = torch.LongTensor([len(src_wav)]).to(device)
     ppg = ppg_model(src_wav_tensor, src_wav_lengths)
 
-    lf0_uv = get_converted_lf0uv(src_wav, ref_lf0_mean, ref_lf0_std, convert=True)
+    lf0_mean_src, lf0_std_src = src_lf0_stats if src_lf0_stats is not None else (None, None)
+    lf0_uv = get_converted_lf0uv(
+        src_wav, ref_lf0_mean, ref_lf0_std, convert=True,
+        f0_src=src_f0, lf0_mean_src=lf0_mean_src, lf0_std_src=lf0_std_src,
+    )
     min_len = min(ppg.shape[1], len(lf0_uv))
 
     ppg = ppg[:, :min_len]
     lf0_uv = lf0_uv[:min_len]
     
-    start = time.time()
     if isinstance(ppg2mel_model, BiRnnPpg2MelModel):
         ppg_length = torch.LongTensor([ppg.shape[1]]).to(device)
         logf0_uv=torch.from_numpy(lf0_uv).unsqueeze(0).float().to(device)
-        mel_pred = ppg2mel_model(ppg, ppg_length, logf0_uv, ref_spk_dvec)
+        mel_pred = ppg2mel_model(ppg, ppg_length, logf0_uv, ref_spk_dvec)[0]
     else:
         _, mel_pred, att_ws = ppg2mel_model.inference(
             ppg,
@@ -154,14 +213,291 @@ def convert(args):
         # mel_min = ppg2mel_config.data.mel_min
         # mel_max = ppg2mel_config.data.mel_max
         # mel_pred = (mel_pred + 4.0) / 8.0 * (mel_max - mel_min) + mel_min
-    src_fid = os.path.basename(src_wav_path)[:-4]
     mel_len = mel_pred.shape[0]
-    rtf = (time.time() - start) / (0.01 * mel_len)
+    y = hifigan_model(mel_pred.view(1, -1, 80).transpose(1, 2))
+    return y.squeeze().cpu().numpy(), mel_len
+
+
+def ppg2mel_batched(ppg2mel_model, ppg, logf0_uv, spembs, ppg_lengths):
+    """Run a ppg2mel model on a zero-padded batch.
+
+    BiRnnPpg2MelModel converts the whole batch in one non-autoregressive pass,
+    MelDecoderMOLv2 decodes it with per-row early stopping.
+
+    Returns:
+        mel_outputs (tensor): (B, T_max, 80), zero after each row's length.
+        mel_lengths (tensor): (B, )
+    """
+    if isinstance(ppg2mel_model, BiRnnPpg2MelModel):
+        return ppg2mel_model.inference_batched(ppg, logf0_uv, spembs, ppg_lengths)
+    if not hasattr(ppg2mel_model, "inference_batched"):
+        raise ValueError(f"{type(ppg2mel_model).__name__} has no batched inference.")
+    _, mel_outputs, mel_lengths = ppg2mel_model.inference_batched(
+        ppg, logf0_uv, spembs, ppg_lengths)
+    return mel_outputs, mel_lengths
+
+
+@torch.no_grad()
+def compute_batched_features(src_wavs, ref_lf0_mean, ref_lf0_std, ppg_model, device):
+    """Zero-padded PPGs and converted log-F0 / UV flags of 16 kHz waveforms.
+
+    The PPG model masks the padding, each row matches the PPGs of its
+    waveform computed alone up to float rounding.
+
+    Returns:
+        ppg (tensor): (B, T_max, 144)
+        logf0_uv (tensor): (B, T_max, 2)
+        ppg_lengths (tensor): (B, )
+    """
+    B = len(src_wavs)
+    wav_lengths = [len(wav) for wav in src_wavs]
+    wav_tensor = np.zeros((B, max(wav_lengths)), dtype=np.float32)
+    for i, wav in enumerate(src_wavs):
+        wav_tensor[i, :len(wav)] = wav
+    ppg, ppg_lengths = ppg_model(
+        torch.from_numpy(wav_tensor).to(device),
+        torch.LongTensor(wav_lengths).to(device),
+        return_lengths=True,
+    )
+
+    lengths = []
+    logf0_uv = torch.zeros(B, ppg.shape[1], 2, device=device)
+    for i, wav in enumerate(src_wavs):
+        lf0_uv = get_converted_lf0uv(wav, ref_lf0_mean, ref_lf0_std, convert=True)
+        min_len = min(int(ppg_lengths[i]), len(lf0_uv))
+        logf0_uv[i, :min_len] = torch.from_numpy(lf0_uv[:min_len]).float()
+        lengths.append(min_len)
+    ppg_lengths = torch.LongTensor(lengths).to(device)
+    ppg = ppg[:, :max(lengths)].masked_fill(
+        (torch.arange(max(lengths), device=device).unsqueeze(0)
+         >= ppg_lengths.unsqueeze(1)).unsqueeze(-1), 0.0)
+    return ppg, logf0_uv[:, :max(lengths)], ppg_lengths
+
+
+@torch.no_grad()
+def convert_wavs_batched(
+    src_wavs,
+    ref_spk_dvec,
+    ref_lf0_mean,
+    ref_lf0_std,
+    ppg_model,
+    ppg2mel_model,
+    hifigan_model,
+    device,
+):
+    """Convert a list of 16 kHz source waveforms to the reference speaker.
+
+    PPGs and mels are computed for the whole zero-padded batch at once, so
+    sort long jobs by length to keep the padding small.
+
+    Returns:
+        A list of (y, mel_len) as returned by convert_wav.
+    """
+    if isinstance(ref_spk_dvec, np.ndarray):
+        ref_spk_dvec = torch.from_numpy(ref_spk_dvec).unsqueeze(0).to(device)
+    ppg, logf0_uv, ppg_lengths = compute_batched_features(
+        src_wavs, ref_lf0_mean, ref_lf0_std, ppg_model, device)
+
+    mel_preds, mel_lengths = ppg2mel_batched(
+        ppg2mel_model, ppg, logf0_uv, ref_spk_dvec.expand(len(src_wavs), -1), ppg_lengths)
+    outputs = []
+    for mel_pred, mel_len in zip(mel_preds, mel_lengths.tolist()):
+        y = hifigan_model(mel_pred[:mel_len].view(1, -1, 80).transpose(1, 2))
+        outputs.append((y.squeeze().cpu().numpy(), mel_len))
+    return outputs
+
+
+def get_chunk_bounds(
+    src_wav,
+    sr=16000,
+    chunk_seconds=10.0,
+    overlap_seconds=0.2,
+    split_on_silence=True,
+    top_db=40,
+):
+    """Split a waveform into overlapping (start, end) sample ranges.
+
+    Chunks are at most `chunk_seconds` long plus a short remainder. With
+    `split_on_silence`, a chunk ends at the middle of the latest silent gap in
+    the second half of its window, otherwise at the fixed window end.
+    Consecutive chunks overlap by `overlap_seconds` for cross-fading.
+    """
+    chunk_len = int(chunk_seconds * sr)
+    overlap = int(overlap_seconds * sr)
+    assert chunk_len // 2 > overlap, "chunk_seconds must be larger than 2 * overlap_seconds."
+
+    cut_points = np.zeros(0, dtype=np.int64)
+    if split_on_silence:
+        intervals = librosa.effects.split(src_wav, top_db=top_db)
+        if len(intervals) > 1:
+            cut_points = (intervals[:-1, 1] + intervals[1:, 0]) // 2
+
+    bounds = []
+    start = 0
+    while True:
+        end = start + chunk_len
+        # Do not leave a tiny last chunk
+        if end + chunk_len // 4 >= len(src_wav):
+            bounds.append((start, len(src_wav)))
+            break
+        candidates = cut_points[(cut_points > start + chunk_len // 2) & (cut_points <= end)]
+        if len(candidates) > 0:
+            end = int(candidates[-1])
+        bounds.append((start, end))
+        start = end - overlap
+    return bounds
+
+
+@torch.no_grad()
+def convert_wav_chunked(
+    src_wav,
+    ref_spk_dvec,
+    ref_lf0_mean,
+    ref_lf0_std,
+    ppg_model,
+    ppg2mel_model,
+    hifigan_model,
+    device,
+    chunk_seconds=10.0,
+    overlap_seconds=0.2,
+    split_on_silence=True,
+):
+    """Convert a long 16 kHz source waveform chunk by chunk.
+
+    Each chunk goes through the PPG model, ppg2mel and HiFi-GAN on its own, so
+    memory is bounded by the chunk length and the first audio is available
+    after one chunk. Chunk outputs are cross-faded linearly over the overlap.
+    The source log-F0 statistics are accumulated over the chunks seen so far,
+    so the pitch shift settles instead of jumping from chunk to chunk.
+
+    Yields:
+        ndarray: consecutive blocks of the converted waveform at 24 kHz.
+    """
+    if isinstance(ref_spk_dvec, np.ndarray):
+        ref_spk_dvec = torch.from_numpy(ref_spk_dvec).unsqueeze(0).to(device)
+
+    ratio = 24000 / 16000
+    bounds = get_chunk_bounds(
+        src_wav, chunk_seconds=chunk_seconds, overlap_seconds=overlap_seconds,
+        split_on_silence=split_on_silence,
+    )
+    voiced_lf0s = []
+    tail = None
+    for i, (start, end) in enumerate(bounds):
+        chunk = src_wav[start:end]
+        f0 = compute_f0(chunk)
+        lf0 = f02lf0(f0)
+        voiced_lf0s.append(lf0[lf0 > 0.0])
+        src_lf0_stats = None
+        if sum(len(x) for x in voiced_lf0s) > 0:
+            voiced_lf0 = np.concatenate(voiced_lf0s)
+            src_lf0_stats = (np.mean(voiced_lf0), np.std(voiced_lf0))
+
+        y, _ = convert_wav(
+            chunk, ref_spk_dvec, ref_lf0_mean, ref_lf0_std,
+            ppg_model, ppg2mel_model, hifigan_model, device,
+            src_f0=f0, src_lf0_stats=src_lf0_stats,
+        )
+
+        # The decoder may stop a few frames early or late; align the chunk to
+        # its position in the source before cross-fading.
+        out_start = int(round(start * ratio))
+        out_len = int(round(end * ratio)) - out_start
+        if len(y) < out_len:
+            y = np.pad(y, (0, out_len - len(y)))
+        y = y[:out_len]
+
+        if tail is not None:
+            fade_in = np.linspace(0.0, 1.0, len(tail), dtype=y.dtype)
+            y[:len(tail)] = tail * (1.0 - fade_in) + y[:len(tail)] * fade_in
+
+        if i == len(bounds) - 1:
+            yield y
+        else:
+            keep = int(round(bounds[i + 1][0] * ratio)) - out_start
+            tail = y[keep:].copy()
+            yield y[:keep]
+
+
+@torch.no_grad()
+def convert(args):
+    wav_fname = args.wav_fname
+    device = 'cuda'
+
+    step = os.path.basename(args.ppg2mel_model_file)[:-4].split("_")[-1]
+
+    # Build models
+    print("Load PPG-model, PPG2Mel-model, Vocoder-model...")
+    ppg_model, ppg2mel_model, hifigan_model = load_conversion_models(
+        args.ppg2mel_model_train_config, args.ppg2mel_model_file, device)
+    if args.attention_window > 0:
+        set_attention_window(ppg2mel_model, args.attention_window)
+    
+    # Data related
+    ref_wav_path = args.ref_wav_path
+    ref_fid = os.path.basename(ref_wav_path)[:-4]
+    cache = None
+    if args.ref_cache_dir:
+        cache = RefFeatureCache(args.ref_cache_dir)
+    ref_spk_dvec, ref_lf0_mean, ref_lf0_std = compute_ref_features(ref_wav_path, cache=cache)
+    
+    # source_file_list = sorted(glob.glob(f"{args.src_wav_dir}/*.wav"))
+    # print(f"Number of source utterances: {len(source_file_list)}.")
+    
+    total_rtf = 0.0
+    cnt = 0
+
+    src_wav_path = args.src_wav_dir
+    if os.path.isdir(src_wav_path):
+        # Batch job: convert every wav of the directory into the output folder
+        source_file_list = sorted(glob.glob(f"{src_wav_path}/*.wav"))
+        print(f"Number of source utterances: {len(source_file_list)}.")
+        src_wavs = [librosa.load(path, sr=16000)[0] for path in source_file_list]
+        # Batch utterances of similar length to keep the padding small
+        order = np.argsort([len(wav) for wav in src_wavs])
+        os.makedirs(wav_fname, exist_ok=True)
+        start = time.time()
+        total_mel_len = 0
+        for i in tqdm(range(0, len(order), args.batch_size)):
+            batch = order[i:i + args.batch_size]
+            outputs = convert_wavs_batched(
+                [src_wavs[j] for j in batch], ref_spk_dvec, ref_lf0_mean, ref_lf0_std,
+                ppg_model, ppg2mel_model, hifigan_model, device,
+            )
+            for j, (y, mel_len) in zip(batch, outputs):
+                src_fid = os.path.basename(source_file_list[j])[:-4]
+                sf.write(f"{wav_fname}/{src_fid}.wav", y, 24000, "PCM_16")
+                total_mel_len += mel_len
+        print("RTF:")
+        print((time.time() - start) / (0.01 * total_mel_len))
+        return
+        
+    # Load the audio to a numpy array:
+    src_wav, _ = librosa.load(src_wav_path, sr=16000)
+    
+    start = time.time()
+    src_fid = os.path.basename(src_wav_path)[:-4]
+    if args.chunk_seconds > 0:
+        # Write the converted chunks as soon as they are generated
+        with sf.SoundFile(wav_fname, "w", 24000, 1, "PCM_16") as f:
+            for block in convert_wav_chunked(
+                src_wav, ref_spk_dvec, ref_lf0_mean, ref_lf0_std,
+                ppg_model, ppg2mel_model, hifigan_model, device,
+                chunk_seconds=args.chunk_seconds,
+                overlap_seconds=args.overlap_seconds,
+                split_on_silence=not args.fixed_chunks,
+            ):
+                f.write(block)
+        rtf = (time.time() - start) / (len(src_wav) / 16000)
+    else:
+        y, mel_len = convert_wav(
+            src_wav, ref_spk_dvec, ref_lf0_mean, ref_lf0_std,
+            ppg_model, ppg2mel_model, hifigan_model, device,
+        )
+        rtf = (time.time() - start) / (0.01 * mel_len)
+        sf.write(wav_fname, y, 24000, "PCM_16")
     total_rtf += rtf
     cnt += 1
-    # continue
-    y = hifigan_model(mel_pred.view(1, -1, 80).transpose(1, 2))
-    sf.write(wav_fname, y.squeeze().cpu().numpy(), 24000, "PCM_16")
     
     print("RTF:")
     print(total_rtf)
@@ -174,7 +510,7 @@ def get_parser():
         type=str,
         default=None,
         required=True,
-        help="Source wave directory.",
+        help="Source wave file, or a directory of wave files to convert in batches.",
     )
     parser.add_argument(
         "--ref_wav_path",
@@ -200,7 +536,43 @@ def get_parser():
         "--wav_fname", "-o",
         type=str,
         default="vc_gens_vctk_oneshot",
-        help="Output folder to save the converted wave."
+        help="Output wave file, or output folder in directory mode."
+    )
+    parser.add_argument(
+        "--ref_cache_dir",
+        type=str,
+        default="ppg-vc/cache/ref_feats",
+        help="Cache directory for reference speaker features, empty to disable."
+    )
+    parser.add_argument(
+        "--chunk_seconds",
+        type=float,
+        default=0.0,
+        help="Convert in chunks of about this length and stream them to the output, 0 to disable."
+    )
+    parser.add_argument(
+        "--overlap_seconds",
+        type=float,
+        default=0.2,
+        help="Cross-fade length between consecutive chunks."
+    )
+    parser.add_argument(
+        "--fixed_chunks",
+        action="store_true",
+        help="Split at fixed windows instead of at silences."
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Utterances per batch when --src_wav_dir is a directory."
+    )
+    parser.add_argument(
+        "--attention_window",
+        type=int,
+        default=0,
+        help="Evaluate the MoL attention over this many encoder frames around its "
+             "current position (e.g. 64), 0 for the full width."
     )
 
     
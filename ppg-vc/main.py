@@ -37,7 +37,7 @@ parser.add_argument('--test', action='store_true', help='Test the model.')
 parser.add_argument('--no-msg', action='store_true', help='Hide all messages.')
 parser.add_argument('--finetune', action='store_true', help='Finetune model')
 parser.add_argument('--oneshotvc', action='store_true', help='Oneshot VC model')
-parser.add_argument('--bilstm', action='store_true', help='BiLSTM VC model')
+parser.add_argument('--bilstm', action='store_true', help='BiLSTM VC model, implied by model_name: "bilstm"')
 parser.add_argument('--lsa', action='store_true', help='Use location-sensitive attention (LSA)')
 
 ###
@@ -63,7 +63,8 @@ if torch.cuda.is_available():
 
 if paras.oneshotvc:
     print(">>> OneShot VC training ...")
-    if paras.bilstm:
+    # The model_name of the config selects the recipe, as at conversion time
+    if paras.bilstm or config.get("model_name") == "bilstm":
         from bin.train_ppg2mel_oneshotvc import Solver
     else:
         from bin.train_linglf02mel_seq2seq_oneshotvc import Solver
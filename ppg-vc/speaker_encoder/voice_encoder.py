@@ -119,7 +119,7 @@ class SpeakerEncoder(nn.Module):
         utterances and an embedding is computed for each. The complete utterance embedding is the 
         L2-normed average embedding of the partial utterances.
         
-        TODO: independent batched version of this function
+        See embed_utterances_batch() for the batched version of this function.
     
         :param wav: a preprocessed utterance waveform as a numpy array of float32
         :param return_partials: if True, the partial embeddings will also be returned along with 
@@ -160,15 +160,58 @@ class SpeakerEncoder(nn.Module):
             return embed, partial_embeds, wav_slices
         return embed
     
+    def embed_utterances_batch(self, wavs: List[np.ndarray], rate=1.3, min_coverage=0.75,
+                               batch_size=256):
+        """
+        Computes the embeddings of many utterances at once. The partial utterances of all the 
+        wavs are packed together and forwarded in batches of up to <batch_size> partials, then 
+        the partial embeddings are averaged back per utterance. The result matches calling 
+        embed_utterance() on each wav.
+        
+        :param wavs: list of preprocessed utterance waveforms as numpy arrays of float32.
+        :param rate: see embed_utterance()
+        :param min_coverage: see embed_utterance()
+        :param batch_size: maximum number of partial utterances per forward pass.
+        :return: the embeddings as a numpy array of float32 of shape 
+        (len(wavs), model_embedding_size).
+        """
+        if len(wavs) == 0:
+            return np.empty((0, model_embedding_size), dtype=np.float32)
+        
+        # Compute the partial mels of every utterance, remembering how many each one produced
+        mels, n_partials = [], []
+        for wav in wavs:
+            wav_slices, mel_slices = self.compute_partial_slices(len(wav), rate, min_coverage)
+            max_wave_length = wav_slices[-1].stop
+            if max_wave_length >= len(wav):
+                wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
+            mel = audio.wav_to_mel_spectrogram(wav)
+            mels.extend(mel[s] for s in mel_slices)
+            n_partials.append(len(mel_slices))
+        mels = np.array(mels)
+        
+        # Forward all the partials in a few large batches
+        partial_embeds = []
+        with torch.no_grad():
+            for i in range(0, len(mels), batch_size):
+                batch = torch.from_numpy(mels[i:i + batch_size]).to(self.device)
+                partial_embeds.append(self(batch).cpu().numpy())
+        partial_embeds = np.concatenate(partial_embeds, axis=0)
+        
+        # Scatter the partial embeddings back and average them per utterance
+        n_partials = np.array(n_partials)
+        starts = np.concatenate([[0], np.cumsum(n_partials)[:-1]])
+        raw_embeds = np.add.reduceat(partial_embeds, starts, axis=0) / n_partials[:, None]
+        return raw_embeds / np.linalg.norm(raw_embeds, 2, axis=1, keepdims=True)
+    
     def embed_speaker(self, wavs: List[np.ndarray], **kwargs):
         """
         Compute the embedding of a collection of wavs (presumably from the same speaker) by 
         averaging their embedding and L2-normalizing it.
         
         :param wavs: list of wavs a numpy arrays of float32.
-        :param kwargs: extra arguments to embed_utterance()
+        :param kwargs: extra arguments to embed_utterances_batch()
         :return: the embedding as a numpy array of float32 of shape (model_embedding_size,).
         """
-        raw_embed = np.mean([self.embed_utterance(wav, return_partials=False, **kwargs) \
-                             for wav in wavs], axis=0)
+        raw_embed = np.mean(self.embed_utterances_batch(wavs, **kwargs), axis=0)
         return raw_embed / np.linalg.norm(raw_embed, 2)
\ No newline at end of file
@@ -2,10 +2,61 @@ import random
 import numpy as np
 import torch
 import os
+import json
+import hashlib
 from collections import OrderedDict
 from utils.f0_utils import get_cont_lf0, convert_continuous_f0
 import resampy
 from .audio_utils import MAX_WAV_VALUE, load_wav, mel_spectrogram, normalize
+from .feature_store import FeatureStore
+
+
+# Mel-spectrogram parameters of the 24 kHz HiFi-GAN vocoder.
+MEL_PARAMS = dict(
+    n_fft=1024,
+    num_mels=80,
+    sampling_rate=24000,
+    hop_size=240,
+    win_size=1024,
+    fmin=0,
+    fmax=8000,
+)
+
+
+def compute_mel(wav_path, mel_params=MEL_PARAMS):
+    audio, sr = load_wav(wav_path)
+    if sr != mel_params["sampling_rate"]:
+        audio = resampy.resample(audio, sr, mel_params["sampling_rate"])
+    audio = audio / MAX_WAV_VALUE
+    audio = normalize(audio) * 0.95
+    audio = torch.FloatTensor(audio).unsqueeze(0)
+    melspec = mel_spectrogram(audio, **mel_params)
+    return melspec.squeeze(0).numpy().T
+
+
+def bin_level_min_max_norm(melspec, mel_min, mel_max):
+    # frequency bin level min-max normalization to [-4, 4]
+    mel = (melspec - mel_min) / (mel_max - mel_min) * 8.0 - 4.0
+    return np.clip(mel, -4., 4.)
+
+
+def get_mel_cache_dir(mel_cache_root, mel_min=None, mel_max=None, mel_params=MEL_PARAMS):
+    """Cache directory addressed by the mel parameters.
+
+    `mel_min`/`mel_max` are given when min-max normalization is baked into the
+    cached mels, so normalized and raw mels never share a directory.
+    """
+    key = dict(mel_params, mel_min=mel_min, mel_max=mel_max)
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf8")).hexdigest()[:16]
+    return os.path.join(mel_cache_root, f"mel_{digest}")
+
+
+def save_cached_mel(mel_fname, mel):
+    # Write to a temporary file first so readers never load a partial .npy
+    tmp_fname = f"{mel_fname}.{os.getpid()}.tmp"
+    with open(tmp_fname, "wb") as f:
+        np.save(f, mel, allow_pickle=False)
+    os.replace(tmp_fname, mel_fname)
 
 
 def read_fids(fid_list_f):
@@ -79,6 +130,9 @@ class OneshotVcDataset(torch.utils.data.Dataset):
         ppg_file_ext: str = "ling_feat.npy",
         f0_file_ext: str = "f0.npy",
         wav_file_ext: str = "wav",
+        feature_store_dir: str = None,
+        mel_cache_dir: str = None,
+        mel_cache_norm: bool = False,
     ):
         self.fid_list = read_fids(meta_file)
         self.vctk_ppg_dir = vctk_ppg_dir
@@ -94,6 +148,15 @@ class OneshotVcDataset(torch.utils.data.Dataset):
         self.f0_file_ext = f0_file_ext
         self.wav_file_ext = wav_file_ext
 
+        # Read ppg, f0 and d-vectors from a packed store (see 4_pack_features.py)
+        # instead of per-utterance .npy files.
+        self.feature_store_dir = feature_store_dir
+        if feature_store_dir is not None:
+            print(f"[INFO] Load features from store {feature_store_dir}.")
+            self.ppg_store = FeatureStore(feature_store_dir, "ppg")
+            self.f0_store = FeatureStore(feature_store_dir, "f0")
+            self.spk_dvec_store = FeatureStore(feature_store_dir, "spk_dvec")
+
         self.min_max_norm_mel = min_max_norm_mel
         if min_max_norm_mel:
             print("[INFO] Min-Max normalize Melspec.")
@@ -101,6 +164,18 @@ class OneshotVcDataset(torch.utils.data.Dataset):
             assert mel_max is not None
             self.mel_max = mel_max
             self.mel_min = mel_min
+
+        # Serve mels from an on-disk cache (filled by 5_compute_mels.py or on the
+        # first miss) instead of computing them from the wav on every access.
+        self.mel_cache_dir = None
+        self.mel_cache_norm = mel_cache_norm and min_max_norm_mel
+        if mel_cache_dir is not None:
+            if self.mel_cache_norm:
+                self.mel_cache_dir = get_mel_cache_dir(mel_cache_dir, mel_min, mel_max)
+            else:
+                self.mel_cache_dir = get_mel_cache_dir(mel_cache_dir)
+            os.makedirs(self.mel_cache_dir, exist_ok=True)
+            print(f"[INFO] Mel cache: {self.mel_cache_dir}")
         
         random.seed(1234)
         random.shuffle(self.fid_list)
@@ -111,6 +186,8 @@ class OneshotVcDataset(torch.utils.data.Dataset):
     
     def get_spk_dvec(self, fid):
         spk_name = fid.split("_")[0]
+        if self.feature_store_dir is not None:
+            return torch.from_numpy(np.array(self.spk_dvec_store[spk_name]))
         if spk_name.startswith("p"):
             spk_dvec_path = f"{self.vctk_spk_dvec_dir}/{spk_name}.npy"
         else:
@@ -118,28 +195,29 @@ class OneshotVcDataset(torch.utils.data.Dataset):
         return torch.from_numpy(np.load(spk_dvec_path))
     
     def compute_mel(self, wav_path):
-        audio, sr = load_wav(wav_path)
-        if sr != 24000:
-            audio = resampy.resample(audio, sr, 24000)
-        audio = audio / MAX_WAV_VALUE
-        audio = normalize(audio) * 0.95
-        audio = torch.FloatTensor(audio).unsqueeze(0)
-        melspec = mel_spectrogram(
-            audio,
-            n_fft=1024,
-            num_mels=80,
-            sampling_rate=24000,
-            hop_size=240,
-            win_size=1024,
-            fmin=0,
-            fmax=8000,
-        )
-        return melspec.squeeze(0).numpy().T
+        return compute_mel(wav_path)
 
     def bin_level_min_max_norm(self, melspec):
-        # frequency bin level min-max normalization to [-4, 4]
-        mel = (melspec - self.mel_min) / (self.mel_max - self.mel_min) * 8.0 - 4.0
-        return np.clip(mel, -4., 4.)   
+        return bin_level_min_max_norm(melspec, self.mel_min, self.mel_max)
+
+    def load_mel(self, fid, wav_path):
+        """Return the (normalized if configured) mel of `fid`, using the mel cache if any."""
+        if self.mel_cache_dir is None:
+            mel = self.compute_mel(wav_path)
+        else:
+            mel_fname = f"{self.mel_cache_dir}/{fid}.mel.npy"
+            if os.path.isfile(mel_fname):
+                mel = np.load(mel_fname)
+            else:
+                mel = self.compute_mel(wav_path)
+                if self.mel_cache_norm:
+                    mel = self.bin_level_min_max_norm(mel)
+                save_cached_mel(mel_fname, mel)
+            if self.mel_cache_norm:
+                return mel
+        if self.min_max_norm_mel:
+            mel = self.bin_level_min_max_norm(mel)
+        return mel
 
     def __getitem__(self, index):
         fid = self.fid_list[index]
@@ -147,16 +225,19 @@ class OneshotVcDataset(torch.utils.data.Dataset):
         # 1. Load features
         if fid.startswith("p"):
             # vctk
-            ppg = np.load(f"{self.vctk_ppg_dir}/{fid}.{self.ppg_file_ext}")
-            f0 = np.load(f"{self.vctk_f0_dir}/{fid}.{self.f0_file_ext}")
-            mel = self.compute_mel(f"{self.vctk_wav_dir}/{fid}.{self.wav_file_ext}")
+            ppg_dir, f0_dir, wav_dir = self.vctk_ppg_dir, self.vctk_f0_dir, self.vctk_wav_dir
         else:
             # libritts
-            ppg = np.load(f"{self.libri_ppg_dir}/{fid}.{self.ppg_file_ext}")
-            f0 = np.load(f"{self.libri_f0_dir}/{fid}.{self.f0_file_ext}")
-            mel = self.compute_mel(f"{self.libri_wav_dir}/{fid}.{self.wav_file_ext}")
-        if self.min_max_norm_mel:
-            mel = self.bin_level_min_max_norm(mel)
+            ppg_dir, f0_dir, wav_dir = self.libri_ppg_dir, self.libri_f0_dir, self.libri_wav_dir
+        if self.feature_store_dir is not None:
+            # ppg stays a read-only view of the memory map, only f0 is
+            # modified in place below and needs a copy
+            ppg = np.asarray(self.ppg_store[fid])
+            f0 = np.array(self.f0_store[fid])
+        else:
+            ppg = np.load(f"{ppg_dir}/{fid}.{self.ppg_file_ext}")
+            f0 = np.load(f"{f0_dir}/{fid}.{self.f0_file_ext}")
+        mel = self.load_mel(fid, f"{wav_dir}/{fid}.{self.wav_file_ext}")
         
         f0, ppg, mel = self._adjust_lengths(f0, ppg, mel)
         spk_dvec = self.get_spk_dvec(fid)
@@ -208,7 +289,8 @@ class MultiSpkVcDataset(torch.utils.data.Dataset):
         ppg_file_ext: str = "bnf.npy",
         f0_file_ext: str = "f0.npy",
         mel_file_ext: str = "mel.npy",
-        scale_mel_to_4: bool = True
+        scale_mel_to_4: bool = True,
+        feature_store_dir: str = None,
     ):
         self.fid_list = read_fids(meta_file)
         self.ppg_dir = ppg_dir
@@ -218,6 +300,12 @@ class MultiSpkVcDataset(torch.utils.data.Dataset):
         self.f0_file_ext = f0_file_ext
         self.mel_file_ext = mel_file_ext
         self.scale_mel_to_4 = scale_mel_to_4
+        self.feature_store_dir = feature_store_dir
+        if feature_store_dir is not None:
+            print(f"[INFO] Load features from store {feature_store_dir}.")
+            self.ppg_store = FeatureStore(feature_store_dir, "ppg")
+            self.f0_store = FeatureStore(feature_store_dir, "f0")
+            self.mel_store = FeatureStore(feature_store_dir, "mel")
         self.spk2idx = self.get_spk2idx()
         random.seed(1234)
         random.shuffle(self.fid_list)
@@ -246,11 +334,18 @@ class MultiSpkVcDataset(torch.utils.data.Dataset):
         spk_id = int(self.spk2idx[spk_name])
 
         # 1. Load features
-        ppg = np.load(f"{self.ppg_dir}/{fid}.{self.ppg_file_ext}")
+        if self.feature_store_dir is not None:
+            # ppg and mel stay read-only views of the memory map, only f0 is
+            # modified in place below and needs a copy
+            ppg = np.asarray(self.ppg_store[fid])
+            f0 = np.array(self.f0_store[fid])
+            mel = np.asarray(self.mel_store[fid])
+        else:
+            ppg = np.load(f"{self.ppg_dir}/{fid}.{self.ppg_file_ext}")
+            f0 = np.load(f"{self.f0_dir}/{fid}.{self.f0_file_ext}")
+            mel = np.load(f"{self.mel_dir}/{fid}.{self.mel_file_ext}")
         if ppg.shape[-1] == 75:
             ppg = ppg[:, 2:-1]  # drop <blank>, <unk> and <sos/eos> dims
-        f0 = np.load(f"{self.f0_dir}/{fid}.{self.f0_file_ext}")
-        mel = np.load(f"{self.mel_dir}/{fid}.{self.mel_file_ext}")
         
         if len(ppg) < len(f0) // 2:
             if f0.shape[0] < 4 * ppg.shape[0]:
@@ -0,0 +1,109 @@
+import os
+import json
+import numpy as np
+
+
+def _index_path(store_dir, name):
+    return os.path.join(store_dir, f"{name}.index.json")
+
+
+def _shard_path(store_dir, name, shard_id):
+    return os.path.join(store_dir, f"{name}.{shard_id:04d}.npy")
+
+
+class FeatureStoreWriter(object):
+    """Packs many small per-utterance arrays of one feature into large shards.
+
+    Arrays are concatenated along their first axis into `{name}.NNNN.npy` shards
+    of about `shard_size_mb` each, and `{name}.index.json` maps every key (fid or
+    speaker name) to `[shard_id, start, stop]`. All arrays of one feature must
+    share the same dtype and trailing dimensions.
+    """
+    def __init__(self, store_dir, name, shard_size_mb=1024):
+        self.store_dir = store_dir
+        self.name = name
+        self.shard_size = shard_size_mb * 1024 * 1024
+        self.index = {}
+        self.num_shards = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_frames = 0
+        os.makedirs(store_dir, exist_ok=True)
+
+    def add(self, key, array):
+        if key in self.index:
+            raise ValueError(f"Duplicated key {key} in feature store {self.name}.")
+        start = self._buffer_frames
+        self._buffer.append(array)
+        self._buffer_frames += array.shape[0]
+        self._buffer_bytes += array.nbytes
+        self.index[key] = [self.num_shards, start, self._buffer_frames]
+        if self._buffer_bytes >= self.shard_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._buffer) == 0:
+            return
+        shard_path = _shard_path(self.store_dir, self.name, self.num_shards)
+        with open(f"{shard_path}.tmp", "wb") as f:
+            np.save(f, np.concatenate(self._buffer, axis=0), allow_pickle=False)
+        os.replace(f"{shard_path}.tmp", shard_path)
+        self.num_shards += 1
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_frames = 0
+
+    def close(self):
+        """Write the last shard and the index."""
+        self._flush()
+        index_path = _index_path(self.store_dir, self.name)
+        with open(f"{index_path}.tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(f"{index_path}.tmp", index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class FeatureStore(object):
+    """Read-only view of a feature packed by FeatureStoreWriter.
+
+    Shards are memory-mapped lazily, so each DataLoader worker maps its own
+    after fork, and `store[key]` is a zero-copy slice of the mapped shard.
+    Copy the slice (e.g. `np.array(store[key])`) before modifying it in place.
+    """
+    def __init__(self, store_dir, name):
+        self.store_dir = store_dir
+        self.name = name
+        with open(_index_path(store_dir, name), "r") as f:
+            self.index = json.load(f)
+        self._shards = {}
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.load(
+                _shard_path(self.store_dir, self.name, shard_id), mmap_mode="r")
+        return self._shards[shard_id]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        shard_id, start, stop = self.index[key]
+        return self._shard(shard_id)[start:stop]
+
+    def __getstate__(self):
+        # Do not pickle open memory maps into DataLoader workers.
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
@@ -162,7 +162,8 @@ class MelDecoderMOL(AbsMelDecoder):
         
         # (B, num_mels, T_dec)
         mel_outputs, predicted_stop, alignments = self.decoder(
-            decoder_inputs, speech, feature_lengths)
+            decoder_inputs, speech, feature_lengths,
+            record_alignments=output_att_ws)
         ## Post-processing
         mel_outputs_postnet = self.postnet(mel_outputs.transpose(1, 2)).transpose(1, 2)
         mel_outputs_postnet = mel_outputs + mel_outputs_postnet
@@ -181,7 +182,13 @@ class MelDecoderMOL(AbsMelDecoder):
         logf0_uv: torch.Tensor = None,
         spembs: torch.Tensor = None,
         use_stop_tokens: bool = True,
+        output_att_ws: bool = False,
+        decoder_step: torch.nn.Module = None,
     ):
+        """
+        decoder_step: optional (scripted / compiled) DecoderStep of self.decoder,
+            see Decoder.make_step. Alignments are not recorded when it is used.
+        """
         if self.use_bnf_prenet:
             bottle_neck_features, _ = self.bnf_prenet(bottle_neck_features)
             if self.use_instance_norm:
@@ -207,12 +214,22 @@ class MelDecoderMOL(AbsMelDecoder):
 
         ## Decoder
         if bottle_neck_features.size(0) > 1:
-            mel_outputs, alignments = self.decoder.inference_batched(bottle_neck_features)
+            # Rows are consecutive chunks, concatenate them
+            mel_outputs, mel_lengths = self.decoder.inference_batched(bottle_neck_features)
+            mel_outputs = torch.cat(
+                [mel[:l] for mel, l in zip(mel_outputs, mel_lengths.tolist())], dim=0).unsqueeze(0)
+            alignments = None
+        elif decoder_step is not None:
+            mel_outputs = self.decoder.inference_functional(bottle_neck_features, decoder_step)
+            alignments = None
         else:
-            mel_outputs, alignments = self.decoder.inference(bottle_neck_features,)
+            mel_outputs, alignments = self.decoder.inference(
+                bottle_neck_features, record_alignments=output_att_ws)
         ## Post-processing
         mel_outputs_postnet = self.postnet(mel_outputs.transpose(1, 2)).transpose(1, 2)
         mel_outputs_postnet = mel_outputs + mel_outputs_postnet
         # outputs = mel_outputs_postnet[0]
         
-        return mel_outputs[0], mel_outputs_postnet[0], alignments[0]
+        if alignments is not None:
+            alignments = alignments[0]
+        return mel_outputs[0], mel_outputs_postnet[0], alignments
@@ -171,7 +171,8 @@ class MelDecoderMOLv2(AbsMelDecoder):
         
         # (B, num_mels, T_dec)
         mel_outputs, predicted_stop, alignments = self.decoder(
-            decoder_inputs, speech, feature_lengths//int(self.encoder_down_factor))
+            decoder_inputs, speech, feature_lengths//int(self.encoder_down_factor),
+            record_alignments=output_att_ws)
         ## Post-processing
         mel_outputs_postnet = self.postnet(mel_outputs.transpose(1, 2)).transpose(1, 2)
         mel_outputs_postnet = mel_outputs + mel_outputs_postnet
@@ -184,13 +185,13 @@ class MelDecoderMOLv2(AbsMelDecoder):
 
         # return mel_outputs, mel_outputs_postnet
 
-    def inference(
+    def encode_inputs(
         self,
         bottle_neck_features: torch.Tensor,
         logf0_uv: torch.Tensor = None,
         spembs: torch.Tensor = None,
-        use_stop_tokens: bool = True,
     ):
+        """Compute the decoder memory (B, T_in//encoder_down_factor, encoder_dim)."""
         decoder_inputs = self.bnf_prenet(bottle_neck_features.transpose(1, 2)).transpose(1, 2)
         logf0_uv = self.pitch_convs(logf0_uv.transpose(1, 2)).transpose(1, 2)
         decoder_inputs = decoder_inputs + logf0_uv
@@ -208,15 +209,90 @@ class MelDecoderMOLv2(AbsMelDecoder):
                     spembs).unsqueeze(1).expand(-1, decoder_inputs.size(1), -1)
             bottle_neck_features = torch.cat([decoder_inputs, spk_embeds], dim=-1)
             bottle_neck_features = self.reduce_proj(bottle_neck_features)
+        else:
+            bottle_neck_features = decoder_inputs
+        return bottle_neck_features
 
-        ## Decoder
+    def inference(
+        self,
+        bottle_neck_features: torch.Tensor,
+        logf0_uv: torch.Tensor = None,
+        spembs: torch.Tensor = None,
+        use_stop_tokens: bool = True,
+        output_att_ws: bool = False,
+        decoder_step: torch.nn.Module = None,
+    ):
+        """
+        decoder_step: optional (scripted / compiled) DecoderStep of self.decoder,
+            see Decoder.make_step. Alignments are not recorded when it is used.
+        """
         if bottle_neck_features.size(0) > 1:
-            mel_outputs, alignments = self.decoder.inference_batched(bottle_neck_features)
+            # Rows are consecutive chunks, concatenate them
+            mel_outputs, mel_outputs_postnet, mel_lengths = self.inference_batched(
+                bottle_neck_features, logf0_uv, spembs)
+            mel_outputs = torch.cat(
+                [mel[:l] for mel, l in zip(mel_outputs, mel_lengths.tolist())], dim=0)
+            mel_outputs_postnet = torch.cat(
+                [mel[:l] for mel, l in zip(mel_outputs_postnet, mel_lengths.tolist())], dim=0)
+            return mel_outputs, mel_outputs_postnet, None
+
+        bottle_neck_features = self.encode_inputs(bottle_neck_features, logf0_uv, spembs)
+
+        ## Decoder
+        if decoder_step is not None:
+            mel_outputs = self.decoder.inference_functional(bottle_neck_features, decoder_step)
+            alignments = None
         else:
-            mel_outputs, alignments = self.decoder.inference(bottle_neck_features,)
+            mel_outputs, alignments = self.decoder.inference(
+                bottle_neck_features, record_alignments=output_att_ws)
         ## Post-processing
         mel_outputs_postnet = self.postnet(mel_outputs.transpose(1, 2)).transpose(1, 2)
         mel_outputs_postnet = mel_outputs + mel_outputs_postnet
         # outputs = mel_outputs_postnet[0]
         
-        return mel_outputs[0], mel_outputs_postnet[0], alignments[0]
+        if alignments is not None:
+            alignments = alignments[0]
+        return mel_outputs[0], mel_outputs_postnet[0], alignments
+
+    def inference_batched(
+        self,
+        bottle_neck_features: torch.Tensor,
+        logf0_uv: torch.Tensor = None,
+        spembs: torch.Tensor = None,
+        feature_lengths: torch.Tensor = None,
+    ):
+        """Decode a zero-padded batch, e.g. chunks of many songs, at once.
+        Args:
+            bottle_neck_features: (B, T_in, input_dim)
+            logf0_uv: (B, T_in, 2)
+            spembs: (B, spk_embed_dim)
+            feature_lengths: (B, ) valid input frames, None if all are T_in.
+        Returns:
+            mel_outputs, mel_outputs_postnet: (B, T_max, num_mels), zero-padded.
+            mel_lengths: (B, )
+        """
+        B = bottle_neck_features.size(0)
+        if feature_lengths is None:
+            feature_lengths = [bottle_neck_features.size(1)] * B
+        else:
+            feature_lengths = feature_lengths.tolist()
+        # Encode each row on its own: instance norm must not see the padding
+        memory = [
+            self.encode_inputs(
+                bottle_neck_features[i:i+1, :feature_lengths[i]],
+                logf0_uv[i:i+1, :feature_lengths[i]],
+                None if spembs is None else spembs[i:i+1],
+            )[0]
+            for i in range(B)
+        ]
+        memory_lengths = torch.LongTensor([m.size(0) for m in memory])
+        memory = torch.nn.utils.rnn.pad_sequence(memory, batch_first=True)
+
+        ## Decoder
+        mel_outputs, mel_lengths = self.decoder.inference_batched(memory, memory_lengths)
+        ## Post-processing, also per row as the padding would leak through the postnet
+        mel_outputs_postnet = torch.zeros_like(mel_outputs)
+        for i, l in enumerate(mel_lengths.tolist()):
+            mel = mel_outputs[i:i+1, :l]
+            mel_outputs_postnet[i, :l] = mel[0] + self.postnet(mel.transpose(1, 2)).transpose(1, 2)[0]
+        return mel_outputs, mel_outputs_postnet, mel_lengths
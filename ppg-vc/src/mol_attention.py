@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import Optional, Tuple
 
 
 class MOLAttention(nn.Module):
@@ -13,11 +14,17 @@ class MOLAttention(nn.Module):
         query_dim,
         r=1,
         M=5,
+        window_size=None,
+        leak_tolerance=1e-3,
     ):
         """
         Args:
             query_dim: attention_rnn_dim.
             M: number of mixtures.
+            window_size: if set, inference only evaluates a band of this many
+                encoder frames around the mixture means, see window_step.
+            leak_tolerance: largest fraction of the attention mass allowed
+                outside the band before falling back to the full width.
         """
         super().__init__()
         if r < 1:
@@ -36,6 +43,11 @@ class MOLAttention(nn.Module):
             nn.Linear(256, 3*M, bias=True)
         )
         self.mu_prev = None
+        self.window_size = window_size
+        self.leak_tolerance = leak_tolerance
+        # Prefix sums of the memory for window_step, and its full-width fallbacks
+        self.memory_cumsum = None
+        self.num_fallbacks = 0
         self.initialize_bias()
 
     def initialize_bias(self):
@@ -65,13 +77,20 @@ class MOLAttention(nn.Module):
         self.J = torch.arange(0, T_enc + 2.0).to(device) + 0.5  # NOTE: for discretize usage
         # self.J = memory.new_tensor(np.arange(T_enc), dtype=torch.float)
         self.mu_prev = torch.zeros(B, self.M).to(device)
+        self.memory_cumsum = None
+        self.num_fallbacks = 0
 
-    def forward(self, att_rnn_h, memory, memory_pitch=None, mask=None):
-        """
-        att_rnn_h: attetion rnn hidden state.
-        memory: encoder outputs (B, T_enc, D).
-        mask: binary mask for padded data (B, T_enc).
-        """
+    def select_states(self, index):
+        """Keep only the rows `index` of mu_prev, see Decoder.select_decoder_states."""
+        self.mu_prev = self.mu_prev[index]
+        self.memory_cumsum = None
+
+    def mixture_params(
+        self,
+        att_rnn_h: torch.Tensor,
+        mu_prev: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Mixture weights, scales and means (B, M) of the current step."""
         # [B, 3M]
         mixture_params = self.query_layer(att_rnn_h)
         
@@ -91,19 +110,48 @@ class MOLAttention(nn.Module):
         w = torch.softmax(w_hat, dim=-1) + self.eps
         sigma = F.softplus(sigma_hat) + self.eps
         Delta = F.softplus(Delta_hat)
-        mu_cur = self.mu_prev + Delta
+        mu_cur = mu_prev + Delta
         # print("w:", w)
-        j = self.J[:memory.size(1) + 1]
+        return w, sigma, mu_cur
 
-        # Attention weights
+    def cdf(
+        self,
+        w: torch.Tensor,
+        sigma: torch.Tensor,
+        mu_cur: torch.Tensor,
+        j: torch.Tensor,
+    ) -> torch.Tensor:
+        """Mixture CDF at positions j, (N, ) or (B, 1, N); returns (B, N)."""
         # CDF of logistic distribution
         phi_t = w.unsqueeze(-1) * (1 / (1 + torch.sigmoid(
             (mu_cur.unsqueeze(-1) - j) / sigma.unsqueeze(-1))))
         # print("phi_t:", phi_t)
-        
+        return torch.sum(phi_t, dim=1)
+
+    def step(
+        self,
+        att_rnn_h: torch.Tensor,
+        memory: torch.Tensor,
+        mu_prev: torch.Tensor,
+        j: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Stateless attention step, TorchScript compatible.
+        Args:
+            att_rnn_h: attetion rnn hidden state (B, query_dim).
+            memory: encoder outputs (B, T_enc, D).
+            mu_prev: mixture means of the previous step (B, M).
+            j: encoder positions (T_enc + 1), i.e. self.J[:T_enc + 1].
+            mask: binary mask for padded data (B, T_enc).
+        Returns:
+            context (B, D), alpha_t (B, T_enc) and mu_cur (B, M).
+        """
+        w, sigma, mu_cur = self.mixture_params(att_rnn_h, mu_prev)
+
+        # Attention weights
         # Discretize attention weights
         # (B, T_enc + 1)
-        alpha_t = torch.sum(phi_t, dim=1)
+        alpha_t = self.cdf(w, sigma, mu_cur, j)
         alpha_t = alpha_t[:, 1:] - alpha_t[:, :-1]
         alpha_t[alpha_t == 0] = self.eps
         # print("alpha_t: ", alpha_t.size())
@@ -112,6 +160,93 @@ class MOLAttention(nn.Module):
             alpha_t.data.masked_fill_(mask, self.score_mask_value)
 
         context = torch.bmm(alpha_t.unsqueeze(1), memory).squeeze(1)
+        return context, alpha_t, mu_cur
+
+    @torch.jit.ignore
+    def window_step(self, att_rnn_h, memory, mask=None):
+        """Attention step over a band of window_size encoder frames.
+        The band is centred on the mixture means, so the cost of a step does
+        not depend on T_enc. Frames outside the band keep the eps weight of
+        the full computation through prefix sums of the memory. If more than
+        leak_tolerance of the attention mass of any row lies outside the
+        band, the step falls back to the full width.
+        Returns:
+            context (B, D), alpha_band (B, W), index (B, W) the encoder frames
+            of the band and mu_cur (B, M). After a fallback, alpha_band is the
+            full alpha_t (B, T_enc) and index is None.
+        """
+        B, T_enc, D = memory.size()
+        W = min(self.window_size, T_enc)
+        w, sigma, mu_cur = self.mixture_params(att_rnn_h, self.mu_prev)
+
+        # (B, ) first frame of the band
+        center = 0.5 * (mu_cur.min(dim=1)[0] + mu_cur.max(dim=1)[0])
+        start = (center.floor().long() - W // 2).clamp(0, T_enc - W)
+        # (B, W) band frames
+        index = start.unsqueeze(1) + torch.arange(W, device=memory.device)
+        # CDF at the band edges and at both ends of the full range
+        j = torch.cat([
+            index.float() + 0.5,
+            (start + W).float().unsqueeze(1) + 0.5,
+            self.J[[0, T_enc]].unsqueeze(0).expand(B, -1),
+        ], dim=1)
+        phi = self.cdf(w, sigma, mu_cur, j.unsqueeze(1))
+        inside = phi[:, W] - phi[:, 0]
+        total = phi[:, W + 2] - phi[:, W + 1]
+        if torch.any(total - inside > self.leak_tolerance * total):
+            self.num_fallbacks += 1
+            context, alpha_t, mu_cur = self.step(
+                att_rnn_h, memory, self.mu_prev, self.J[:T_enc + 1], mask)
+            return context, alpha_t, None, mu_cur
+
+        # (B, W)
+        alpha_band = phi[:, 1:W + 1] - phi[:, :W]
+        alpha_band[alpha_band == 0] = self.eps
+        if mask is not None:
+            alpha_band.data.masked_fill_(mask.gather(1, index), self.score_mask_value)
+        memory_band = memory.gather(1, index.unsqueeze(-1).expand(-1, -1, D))
+        context = torch.bmm(alpha_band.unsqueeze(1), memory_band).squeeze(1)
+
+        # eps weights of the frames outside the band
+        if self.memory_cumsum is None:
+            if mask is not None:
+                memory = memory.masked_fill(mask.unsqueeze(-1), 0.0)
+            self.memory_cumsum = F.pad(memory.cumsum(dim=1), (0, 0, 1, 0))
+        band_sum = self.memory_cumsum.gather(
+            1, (start + W).view(B, 1, 1).expand(-1, -1, D)).squeeze(1) \
+            - self.memory_cumsum.gather(1, start.view(B, 1, 1).expand(-1, -1, D)).squeeze(1)
+        context = context + self.eps * (self.memory_cumsum[:, -1] - band_sum)
+
+        return context, alpha_band, index, mu_cur
+
+    def expand_band(self, alpha_band, index, T_enc, mask=None):
+        """Full-width alpha_t (B, T_enc) of a window_step band."""
+        alpha_t = alpha_band.new_full((alpha_band.size(0), T_enc), self.eps)
+        if mask is not None:
+            alpha_t.masked_fill_(mask, self.score_mask_value)
+        alpha_t.scatter_(1, index, alpha_band)
+        return alpha_t
+
+    @torch.jit.ignore
+    def forward(self, att_rnn_h, memory, memory_pitch=None, mask=None,
+                return_alignments=True):
+        """
+        att_rnn_h: attetion rnn hidden state.
+        memory: encoder outputs (B, T_enc, D).
+        mask: binary mask for padded data (B, T_enc).
+        return_alignments: if False, alpha_t may be None, which saves an
+            O(T_enc) expansion of the window_step band per step.
+        """
+        if self.window_size is not None and not self.training:
+            context, alpha_t, index, mu_cur = self.window_step(att_rnn_h, memory, mask)
+            if index is not None:
+                if return_alignments or memory_pitch is not None:
+                    alpha_t = self.expand_band(alpha_t, index, memory.size(1), mask)
+                else:
+                    alpha_t = None
+        else:
+            j = self.J[:memory.size(1) + 1]
+            context, alpha_t, mu_cur = self.step(att_rnn_h, memory, self.mu_prev, j, mask)
         if memory_pitch is not None:
             context_pitch = torch.bmm(alpha_t.unsqueeze(1), memory_pitch).squeeze(1)
 
@@ -120,4 +255,3 @@ class MOLAttention(nn.Module):
         if memory_pitch is not None:
             return context, context_pitch, alpha_t
         return context, alpha_t
-
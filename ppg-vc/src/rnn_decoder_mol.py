@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from typing import List, Tuple
 from .mol_attention import MOLAttention
 from .basic_layers import Linear, Conv1d
 from .vc_utils import get_mask_from_lengths
@@ -21,6 +22,76 @@ class DecoderPrenet(nn.Module):
         return x
 
 
+class DecoderStep(nn.Module):
+    """One inference step of a Decoder as a pure function of its inputs.
+
+    The recurrent states are passed in and returned instead of being kept as
+    module attributes, so the whole step can be scripted or compiled, e.g.
+    `torch.jit.script(decoder.make_step())`. Shares the weights of `decoder`,
+    see Decoder.inference_functional.
+    """
+    def __init__(self, decoder):
+        super().__init__()
+        self.num_mels = decoder.num_mels
+        self.concat_context_to_last = decoder.concat_context_to_last
+        self.prenet = decoder.prenet
+        self.attention_rnn = decoder.attention_rnn
+        self.attention_layer = decoder.attention_layer
+        self.decoder_rnn_layers = decoder.decoder_rnn_layers
+        self.linear_projection = decoder.linear_projection
+        self.stop_layer = decoder.stop_layer
+
+    def forward(
+        self,
+        decoder_input: torch.Tensor,
+        memory: torch.Tensor,
+        j: torch.Tensor,
+        attention_hidden: torch.Tensor,
+        attention_cell: torch.Tensor,
+        decoder_hiddens: List[torch.Tensor],
+        decoder_cells: List[torch.Tensor],
+        attention_context: torch.Tensor,
+        mu_prev: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor,
+               List[torch.Tensor], List[torch.Tensor], torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            decoder_input: (B, num_mels) last frame of the previous step.
+            memory: (B, T_enc, D_enc) Encoder outputs.
+            j: (T_enc + 1, ) encoder positions of the attention.
+            The rest are the states returned by the previous step, see
+            Decoder.init_step_states.
+        Returns:
+            mel_output (B, r*num_mels), stop_output (B, 1) and the new states.
+        """
+        decoder_input = self.prenet(decoder_input)
+
+        # Attention RNN and attention
+        cell_input = torch.cat((decoder_input, attention_context), -1)
+        attention_hidden, attention_cell = self.attention_rnn(
+            cell_input, (attention_hidden, attention_cell))
+        attention_context, _, mu_prev = self.attention_layer.step(
+            attention_hidden, memory, mu_prev, j)
+
+        # Decoder RNN
+        decoder_rnn_output = torch.cat((attention_hidden, attention_context), -1)
+        new_hiddens: List[torch.Tensor] = []
+        new_cells: List[torch.Tensor] = []
+        for i, layer in enumerate(self.decoder_rnn_layers):
+            hidden, cell = layer(decoder_rnn_output, (decoder_hiddens[i], decoder_cells[i]))
+            new_hiddens.append(hidden)
+            new_cells.append(cell)
+            decoder_rnn_output = hidden
+        if self.concat_context_to_last:
+            decoder_rnn_output = torch.cat(
+                (decoder_rnn_output, attention_context), dim=1)
+
+        mel_output = self.linear_projection(decoder_rnn_output)
+        stop_output = self.stop_layer(decoder_rnn_output)
+        return (mel_output, stop_output, attention_hidden, attention_cell,
+                new_hiddens, new_cells, attention_context, mu_prev)
+
+
 class Decoder(nn.Module):
     """Mixture of Logistic (MoL) attention-based RNN Decoder."""
     def __init__(
@@ -161,35 +232,12 @@ class Decoder(nn.Module):
         decoder_inputs = decoder_inputs[:,:,-self.num_mels:]
         return decoder_inputs
         
-    def parse_decoder_outputs(self, mel_outputs, alignments, stop_outputs):
-        """ Prepares decoder outputs for output
-        Args:
-            mel_outputs:
-            alignments:
-        """
-        # (T_out//r, B, T_enc) -> (B, T_out//r, T_enc)
-        alignments = torch.stack(alignments).transpose(0, 1)
-        # (T_out//r, B) -> (B, T_out//r)
-        if stop_outputs is not None:
-            if alignments.size(0) == 1:
-                stop_outputs = torch.stack(stop_outputs).unsqueeze(0)
-            else:
-                stop_outputs = torch.stack(stop_outputs).transpose(0, 1)
-            stop_outputs = stop_outputs.contiguous()
-        # (T_out//r, B, num_mels*r) -> (B, T_out//r, num_mels*r)
-        mel_outputs = torch.stack(mel_outputs).transpose(0, 1).contiguous()
-        # decouple frames per step
-        # (B, T_out, num_mels)
-        mel_outputs = mel_outputs.view(
-            mel_outputs.size(0), -1, self.num_mels)
-        return mel_outputs, alignments, stop_outputs     
-    
-    def attend(self, decoder_input):
+    def attend(self, decoder_input, return_alignments=True):
         cell_input = torch.cat((decoder_input, self.attention_context), -1)
         self.attention_hidden, self.attention_cell = self.attention_rnn(
             cell_input, (self.attention_hidden, self.attention_cell))
         self.attention_context, attention_weights = self.attention_layer(
-            self.attention_hidden, self.memory, None, self.mask)
+            self.attention_hidden, self.memory, None, self.mask, return_alignments)
         
         decoder_rnn_input = torch.cat(
             (self.attention_hidden, self.attention_context), -1)
@@ -206,15 +254,16 @@ class Decoder(nn.Module):
                     self.decoder_hiddens[i-1], (self.decoder_hiddens[i], self.decoder_cells[i]))
         return self.decoder_hiddens[-1]
     
-    def forward(self, memory, mel_inputs, memory_lengths):
+    def forward(self, memory, mel_inputs, memory_lengths, record_alignments=True):
         """ Decoder forward pass for training
         Args:
             memory: (B, T_enc, enc_dim) Encoder outputs
             decoder_inputs: (B, T, num_mels) Decoder inputs for teacher forcing.
             memory_lengths: (B, ) Encoder output lengths for attention masking.
+            record_alignments: whether to keep the attention weights of every step.
         Returns:
             mel_outputs: (B, T, num_mels) mel outputs from the decoder
-            alignments: (B, T//r, T_enc) attention weights.
+            alignments: (B, T//r, T_enc) attention weights, None if not recorded.
         """
         # [1, B, num_mels]
         go_frame = self.get_go_frame(memory).unsqueeze(0)
@@ -233,16 +282,24 @@ class Decoder(nn.Module):
         self.attention_layer.init_states(memory)
         # self.attention_layer_pitch.init_states(memory_pitch)
 
-        mel_outputs, alignments = [], []
+        # Outputs are written step by step into preallocated buffers
+        B, n_steps = memory.size(0), decoder_inputs.size(0) - 1
+        # (B, T//r, r*num_mels)
+        mel_outputs = memory.new_zeros(B, n_steps, self.frames_per_step*self.num_mels)
+        if record_alignments:
+            alignments = memory.new_zeros(B, n_steps, self.memory.size(1))
+        else:
+            alignments = None
         if self.use_stop_tokens:
-            stop_outputs = []
+            stop_outputs = memory.new_zeros(B, n_steps)
         else:
             stop_outputs = None
-        while len(mel_outputs) < decoder_inputs.size(0) - 1:
-            decoder_input = decoder_inputs[len(mel_outputs)]
-            # decoder_input_pitch = decoder_inputs_pitch[len(mel_outputs)]
+        for step in range(n_steps):
+            decoder_input = decoder_inputs[step]
+            # decoder_input_pitch = decoder_inputs_pitch[step]
 
-            decoder_rnn_input, context, attention_weights = self.attend(decoder_input)
+            decoder_rnn_input, context, attention_weights = self.attend(
+                decoder_input, record_alignments)
 
             decoder_rnn_output = self.decode(decoder_rnn_input)
             if self.concat_context_to_last:    
@@ -252,25 +309,29 @@ class Decoder(nn.Module):
             mel_output = self.linear_projection(decoder_rnn_output)
             if self.use_stop_tokens:
                 stop_output = self.stop_layer(decoder_rnn_output)
-                stop_outputs += [stop_output.squeeze()]
-            mel_outputs += [mel_output.squeeze(1)] #? perhaps don't need squeeze
-            alignments += [attention_weights]
+                stop_outputs[:, step] = stop_output.squeeze(1)
+            mel_outputs[:, step] = mel_output
+            if record_alignments:
+                alignments[:, step] = attention_weights
             # alignments_pitch += [attention_weights_pitch]   
 
-        mel_outputs, alignments, stop_outputs = self.parse_decoder_outputs(
-            mel_outputs, alignments, stop_outputs)
+        # decouple frames per step
+        # (B, T, num_mels)
+        mel_outputs = mel_outputs.view(B, -1, self.num_mels)
         if stop_outputs is None:
             return mel_outputs, alignments
         else:
             return mel_outputs, stop_outputs, alignments
 
-    def inference(self, memory, stop_threshold=0.5):
+    def inference(self, memory, stop_threshold=0.5, record_alignments=False):
         """ Decoder inference
         Args:
             memory: (1, T_enc, D_enc) Encoder outputs
+            record_alignments: whether to keep the attention weights of every
+                step, they take O(T_enc^2) memory.
         Returns:
-            mel_outputs: mel outputs from the decoder
-            alignments: sequence of attention weights from the decoder
+            mel_outputs: (1, T, num_mels) mel outputs from the decoder
+            alignments: (1, T//r, T_enc) attention weights, None if not recorded.
         """
         # [1, num_mels]
         decoder_input = self.get_go_frame(memory)
@@ -279,14 +340,22 @@ class Decoder(nn.Module):
 
         self.attention_layer.init_states(memory)
         
-        mel_outputs, alignments = [], []
         # NOTE(sx): heuristic 
         max_decoder_step = memory.size(1)*self.encoder_down_factor//self.frames_per_step 
         min_decoder_step = memory.size(1)*self.encoder_down_factor // self.frames_per_step - 5
+        # Outputs are written step by step into preallocated buffers
+        B, n_buffer = memory.size(0), max(max_decoder_step, 1)
+        mel_outputs = memory.new_zeros(B, n_buffer, self.frames_per_step*self.num_mels)
+        if record_alignments:
+            alignments = memory.new_zeros(B, n_buffer, memory.size(1))
+        else:
+            alignments = None
+        step = 0
         while True:
             decoder_input = self.prenet(decoder_input)
 
-            decoder_input_final, context, alignment = self.attend(decoder_input)
+            decoder_input_final, context, alignment = self.attend(
+                decoder_input, record_alignments)
 
             #mel_output, stop_output, alignment = self.decode(decoder_input)
             decoder_rnn_output = self.decode(decoder_input_final)
@@ -297,78 +366,185 @@ class Decoder(nn.Module):
             mel_output = self.linear_projection(decoder_rnn_output)
             stop_output = self.stop_layer(decoder_rnn_output)
             
-            mel_outputs += [mel_output.squeeze(1)]
-            alignments += [alignment]
+            mel_outputs[:, step] = mel_output
+            if record_alignments:
+                alignments[:, step] = alignment
+            step += 1
             
-            if torch.sigmoid(stop_output.data) > stop_threshold and len(mel_outputs) >= min_decoder_step:
+            if torch.sigmoid(stop_output.data) > stop_threshold and step >= min_decoder_step:
                 break
-            if len(mel_outputs) >= max_decoder_step:
+            if step >= max_decoder_step:
                 print("Warning! Decoding steps reaches max decoder steps.")
                 break
 
             decoder_input = mel_output[:,-self.num_mels:]
 
+        # decouple frames per step
+        # (1, T, num_mels)
+        mel_outputs = mel_outputs[:, :step].reshape(B, -1, self.num_mels)
+        if record_alignments:
+            alignments = alignments[:, :step]
+        return mel_outputs, alignments
 
-        mel_outputs, alignments, _  = self.parse_decoder_outputs(
-            mel_outputs, alignments, None)
+    def make_step(self):
+        """Return a DecoderStep sharing the weights of this decoder.
+        It is not registered as a submodule, which would duplicate the
+        parameters in the state dict.
+        """
+        return DecoderStep(self)
 
-        return mel_outputs, alignments
+    def init_step_states(self, memory):
+        """Initial states of a DecoderStep, in its argument order."""
+        B = memory.size(0)
+        device = memory.device
+        decoder_hiddens = [
+            torch.zeros((B, self.decoder_rnn_dim), device=device)
+            for _ in range(self.num_decoder_rnn_layer)]
+        decoder_cells = [
+            torch.zeros((B, self.decoder_rnn_dim), device=device)
+            for _ in range(self.num_decoder_rnn_layer)]
+        return (
+            torch.zeros((B, self.attention_rnn_dim), device=device),
+            torch.zeros((B, self.attention_rnn_dim), device=device),
+            decoder_hiddens,
+            decoder_cells,
+            torch.zeros((B, self.enc_dim), device=device),
+            torch.zeros((B, self.attention_layer.M), device=device),
+        )
 
-    def inference_batched(self, memory, stop_threshold=0.5):
-        """ Decoder inference
+    def inference_functional(self, memory, step=None, stop_threshold=0.5):
+        """ Decoder inference driven by a DecoderStep, same outputs as inference.
         Args:
-            memory: (B, T_enc, D_enc) Encoder outputs
+            memory: (1, T_enc, D_enc) Encoder outputs
+            step: a DecoderStep of this decoder, or its scripted / compiled
+                version; None to use a fresh eager one.
         Returns:
-            mel_outputs: mel outputs from the decoder
-            alignments: sequence of attention weights from the decoder
+            mel_outputs: (1, T, num_mels) mel outputs from the decoder
         """
+        if step is None:
+            step = self.make_step()
+        B, T_enc = memory.size(0), memory.size(1)
+        j = torch.arange(0, T_enc + 1.0, device=memory.device) + 0.5
+        states = self.init_step_states(memory)
         # [1, num_mels]
         decoder_input = self.get_go_frame(memory)
 
-        self.initialize_decoder_states(memory, mask=None)
+        # NOTE(sx): heuristic 
+        max_decoder_step = T_enc*self.encoder_down_factor//self.frames_per_step 
+        min_decoder_step = max_decoder_step - 5
+        mel_outputs = memory.new_zeros(
+            B, max(max_decoder_step, 1), self.frames_per_step*self.num_mels)
+        n_steps = 0
+        while True:
+            mel_output, stop_output, *states = step(decoder_input, memory, j, *states)
+            mel_outputs[:, n_steps] = mel_output
+            n_steps += 1
 
-        self.attention_layer.init_states(memory)
+            if torch.sigmoid(stop_output.data) > stop_threshold and n_steps >= min_decoder_step:
+                break
+            if n_steps >= max_decoder_step:
+                print("Warning! Decoding steps reaches max decoder steps.")
+                break
+
+            decoder_input = mel_output[:,-self.num_mels:]
+
+        # decouple frames per step
+        # (1, T, num_mels)
+        return mel_outputs[:, :n_steps].reshape(B, -1, self.num_mels)
+
+    def select_decoder_states(self, index):
+        """Keep only the rows `index` of the decoding states, e.g. to drop
+        finished rows from a batch.
+        Args:
+            index: (B',) LongTensor of rows to keep.
+        """
+        self.attention_hidden = self.attention_hidden[index]
+        self.attention_cell = self.attention_cell[index]
+        self.decoder_hiddens = [h[index] for h in self.decoder_hiddens]
+        self.decoder_cells = [c[index] for c in self.decoder_cells]
+        self.attention_context = self.attention_context[index]
+        self.memory = self.memory[index]
+        if self.mask is not None:
+            self.mask = self.mask[index]
+        self.attention_layer.select_states(index)
+
+    def inference_batched(self, memory, memory_lengths=None, stop_threshold=0.5):
+        """ Batched decoder inference with per-row early stopping.
+        A row is finished once its stop token fires (or it reaches its maximum
+        number of steps), and is then dropped from the decoding batch.
+        Args:
+            memory: (B, T_enc, D_enc) Encoder outputs, zero-padded.
+            memory_lengths: (B, ) Encoder output lengths, None if all rows are
+                T_enc long.
+        Returns:
+            mel_outputs: (B, T_max, num_mels) zero-padded mel outputs.
+            mel_lengths: (B, ) number of valid frames of each row.
+        """
+        B, T_enc = memory.size(0), memory.size(1)
+        device = memory.device
+        if memory_lengths is None:
+            memory_lengths = torch.full((B,), T_enc, dtype=torch.long, device=device)
+            mask = None
+        else:
+            memory_lengths = memory_lengths.to(device)
+            mask = torch.arange(T_enc, device=device).unsqueeze(0) >= memory_lengths.unsqueeze(1)
+        # NOTE(sx): heuristic, per row
+        max_decoder_steps = (memory_lengths*self.encoder_down_factor // self.frames_per_step).clamp(min=1)
+        min_decoder_steps = max_decoder_steps - 5
         
-        mel_outputs, alignments = [], []
-        stop_outputs = []
-        # NOTE(sx): heuristic 
-        max_decoder_step = memory.size(1)*self.encoder_down_factor//self.frames_per_step 
-        min_decoder_step = memory.size(1)*self.encoder_down_factor // self.frames_per_step - 5
+        # [B, num_mels]
+        decoder_input = self.get_go_frame(memory)
+
+        self.initialize_decoder_states(memory, mask=mask)
+
+        self.attention_layer.init_states(memory)
+
+        # (B, T_max//r, r*num_mels)
+        mel_outputs = memory.new_zeros(
+            B, int(max_decoder_steps.max()), self.frames_per_step*self.num_mels)
+        mel_lengths = torch.zeros(B, dtype=torch.long, device=device)
+        # Batch rows which are still decoding
+        active = torch.arange(B, device=device)
+        step = 0
         while True:
             decoder_input = self.prenet(decoder_input)
 
-            decoder_input_final, context, alignment = self.attend(decoder_input)
+            decoder_input_final, context, _ = self.attend(
+                decoder_input, return_alignments=False)
 
-            #mel_output, stop_output, alignment = self.decode(decoder_input)
             decoder_rnn_output = self.decode(decoder_input_final)
             if self.concat_context_to_last:    
                 decoder_rnn_output = torch.cat(
                     (decoder_rnn_output, context), dim=1)
             
             mel_output = self.linear_projection(decoder_rnn_output)
-            # (B, 1)
-            stop_output = self.stop_layer(decoder_rnn_output)
-            stop_outputs += [stop_output.squeeze()]
-            # stop_outputs.append(stop_output) 
-
-            mel_outputs += [mel_output.squeeze(1)]
-            alignments += [alignment]
-            # print(stop_output.shape)
-            if torch.all(torch.sigmoid(stop_output.squeeze().data) > stop_threshold) \
-                    and len(mel_outputs) >= min_decoder_step:
-                break
-            if len(mel_outputs) >= max_decoder_step:
-                print("Warning! Decoding steps reaches max decoder steps.")
-                break
+            # (B', )
+            stop_output = self.stop_layer(decoder_rnn_output).squeeze(1)
 
-            decoder_input = mel_output[:,-self.num_mels:]
+            mel_outputs[active, step] = mel_output
+            step += 1
+            
+            finished = (torch.sigmoid(stop_output.data) > stop_threshold) \
+                & (step >= min_decoder_steps[active])
+            finished = finished | (step >= max_decoder_steps[active])
+            if finished.any():
+                mel_lengths[active[finished]] = step
+                keep = torch.nonzero(~finished).squeeze(1)
+                if keep.numel() == 0:
+                    break
+                active = active[keep]
+                self.select_decoder_states(keep)
+                mel_output = mel_output[keep]
+                # Shorter rows may be gone, stop attending over their padding
+                T_active = int(memory_lengths[active].max())
+                if T_active < self.memory.size(1):
+                    self.memory = self.memory[:, :T_active]
+                    self.mask = self.mask[:, :T_active]
 
+            decoder_input = mel_output[:,-self.num_mels:]
 
-        mel_outputs, alignments, stop_outputs = self.parse_decoder_outputs(
-            mel_outputs, alignments, stop_outputs)
-        mel_outputs_stacked = []
-        for mel, stop_logit in zip(mel_outputs, stop_outputs):
-            idx = np.argwhere(torch.sigmoid(stop_logit.cpu()) > stop_threshold)[0][0].item()
-            mel_outputs_stacked.append(mel[:idx,:])
-        mel_outputs = torch.cat(mel_outputs_stacked, dim=0).unsqueeze(0)
-        return mel_outputs, alignments
+        # decouple frames per step
+        # (B, T_max, num_mels)
+        mel_outputs = mel_outputs.view(B, -1, self.num_mels)
+        mel_outputs = mel_outputs[:, :int(mel_lengths.max())*self.frames_per_step]
+        return mel_outputs, mel_lengths*self.frames_per_step
@@ -126,12 +126,40 @@ class BiRnnPpg2MelModel(torch.nn.Module):
         x = self.reduce_proj(x)
 
         if ppg_lengths is not None:
-            x = torch.nn.utils.rnn.pack_padded_sequence(x, ppg_lengths,
+            x = torch.nn.utils.rnn.pack_padded_sequence(x, ppg_lengths.cpu(),
                                                        batch_first=True,
                                                        enforce_sorted=False)
         x, _ = self.rnn(x)
         if ppg_lengths is not None:
-            x, _ = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
+            x, _ = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True,
+                                                          total_length=T)
         x = self.hidden2out_layers(x)
         
         return x
+
+    def inference_batched(
+        self,
+        ppg: torch.Tensor,
+        logf0_uv: torch.Tensor,
+        spembs: torch.Tensor = None,
+        ppg_lengths: torch.Tensor = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Non-autoregressive inference on a zero-padded batch.
+        Every row gives the same mels as converting it on its own, as the
+        padding is packed away from the RNN.
+        Args:
+            ppg (tensor): [B, T, D_ppg]
+            logf0_uv (tensor): [B, T, 2]
+            spembs (tensor): [B, spk_embed_dim] d-vectors, or [B,] speaker ids.
+            ppg_lengths (tensor): [B,], None if all rows are T long.
+        Returns:
+            mel_outputs (tensor): [B, T, output_size], zero after each row's length.
+            mel_lengths (tensor): [B,]
+        """
+        B, T, _ = ppg.size()
+        if ppg_lengths is None:
+            ppg_lengths = torch.full((B,), T, dtype=torch.long, device=ppg.device)
+        mel_outputs = self(ppg, ppg_lengths, logf0_uv, spembs)
+        mask = torch.arange(T, device=ppg.device).unsqueeze(0) < ppg_lengths.to(ppg.device).unsqueeze(1)
+        mel_outputs = mel_outputs.masked_fill(~mask.unsqueeze(-1), 0.0)
+        return mel_outputs, ppg_lengths
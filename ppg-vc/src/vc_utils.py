@@ -17,7 +17,7 @@ def lcm(a, b):
 def get_mask_from_lengths(lengths, max_len=None):
     if max_len is None:
         max_len = torch.max(lengths).item()
-    ids = torch.arange(0, max_len, out=torch.cuda.LongTensor(max_len))
+    ids = torch.arange(0, max_len, device=lengths.device)
     mask = (ids < lengths.unsqueeze(1)).bool()
     return mask
 
@@ -0,0 +1,84 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RefFeatureCache(object):
+    """On-disk and in-memory LRU cache of reference speaker features.
+
+    Stores the speaker d-vector and the log-F0 mean/std of a reference recording.
+    Entries are keyed by a hash of the encoded audio bytes and of the speaker
+    encoder checkpoint, so a repeated target skips the encoder load, VAD, mel
+    extraction and harvest entirely.
+    """
+    def __init__(
+        self,
+        cache_dir="ppg-vc/cache/ref_feats",
+        weights_fpath="speaker_encoder/ckpt/pretrained_bak_5805000.pt",
+        max_items=64,
+    ):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.ckpt_hash = self._hash_file("ppg-vc/" + weights_fpath)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _hash_file(fpath):
+        h = hashlib.sha1()
+        with open(fpath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def key(self, audio_bytes):
+        h = hashlib.sha1(self.ckpt_hash.encode("ascii"))
+        h.update(audio_bytes)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _remember(self, key, feats):
+        with self._lock:
+            self._items[key] = feats
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get(self, audio_bytes):
+        """Return (spk_dvec, lf0_mean, lf0_std) or None on a miss."""
+        key = self.key(audio_bytes)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        if self.cache_dir is None or not os.path.isfile(self._path(key)):
+            return None
+        with np.load(self._path(key)) as data:
+            feats = (
+                data["spk_dvec"],
+                float(data["lf0_mean"]),
+                float(data["lf0_std"]),
+            )
+        self._remember(key, feats)
+        return feats
+
+    def put(self, audio_bytes, feats):
+        key = self.key(audio_bytes)
+        self._remember(key, feats)
+        if self.cache_dir is None:
+            return
+
+        spk_dvec, lf0_mean, lf0_std = feats
+        # Write to a temporary file first so concurrent readers never see a partial entry.
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, spk_dvec=spk_dvec, lf0_mean=lf0_mean, lf0_std=lf0_std)
+        os.replace(tmp_path, self._path(key))
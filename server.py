@@ -0,0 +1,165 @@
+"""Long-lived conversion server with warm models.
+
+All models are loaded once per worker and requests are served over HTTP:
+
+    POST /convert   JSON body {"source": <base64 audio>, "target": <base64 audio>}
+                    -> 16 kHz WAV bytes of the converted song
+    GET  /health    -> JSON with the queue size and limits
+
+Requests wait in a bounded queue and at most `num_workers` conversions run at
+the same time. When the queue is full the server answers 503 right away.
+
+Usage (from the repository root):
+    python server.py --gpu 0 --port 8502 --max_queue 8 --num_workers 1
+"""
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import soundfile as sf
+
+from pipeline import MusicVoiceConversionPipeline, CONVERT_SR
+
+
+class ConversionJob(object):
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ConversionWorker(threading.Thread):
+    """Owns one pipeline and serves jobs from the shared queue.
+
+    Each worker has its own models because the seq2seq decoder keeps its
+    recurrent state on the module, so one pipeline must not be shared between
+    concurrent conversions.
+    """
+
+    def __init__(self, jobs, pipeline_kwargs):
+        super(ConversionWorker, self).__init__(daemon=True)
+        self.jobs = jobs
+        self.pipeline = MusicVoiceConversionPipeline(**pipeline_kwargs)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                mixed = self.pipeline.convert(job.source, job.target)
+                buf = io.BytesIO()
+                sf.write(buf, mixed, samplerate=CONVERT_SR, format='WAV', subtype='PCM_16')
+                job.result = buf.getvalue()
+            except Exception as e:
+                job.error = e
+            finally:
+                job.done.set()
+                self.jobs.task_done()
+
+
+class ConversionServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, pipeline_kwargs, max_queue=8, num_workers=1, timeout=600):
+        super(ConversionServer, self).__init__(address, ConversionRequestHandler)
+        self.max_queue = max_queue
+        self.num_workers = num_workers
+        self.job_timeout = timeout
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.workers = [
+            ConversionWorker(self.jobs, pipeline_kwargs) for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, source, target):
+        """Queue a conversion, raising queue.Full when the server is saturated."""
+        job = ConversionJob(source, target)
+        self.jobs.put_nowait(job)
+        return job
+
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+
+    def _send(self, code, body, content_type='application/json'):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send(404, {'error': 'not found'})
+            return
+        self._send(200, {
+            'queued': self.server.jobs.qsize(),
+            'max_queue': self.server.max_queue,
+            'num_workers': self.server.num_workers,
+        })
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self._send(404, {'error': 'not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+            source = base64.b64decode(payload['source'])
+            target = base64.b64decode(payload['target'])
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': 'bad request: {}'.format(e)})
+            return
+
+        try:
+            job = self.server.submit(source, target)
+        except queue.Full:
+            self._send(503, {'error': 'server busy, try again later'})
+            return
+
+        if not job.done.wait(self.server.job_timeout):
+            self._send(504, {'error': 'conversion timed out'})
+            return
+        if job.error is not None:
+            self._send(500, {'error': str(job.error)})
+            return
+        self._send(200, job.result, content_type='audio/wav')
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--host', type=str, default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8502)
+    p.add_argument('--gpu', '-g', type=int, default=-1)
+    p.add_argument('--max_queue', type=int, default=8)
+    p.add_argument('--num_workers', type=int, default=1)
+    p.add_argument('--timeout', type=float, default=600)
+    p.add_argument('--tta', '-t', action='store_true')
+    p.add_argument('--postprocess', '-p', action='store_true')
+    args = p.parse_args()
+
+    pipeline_kwargs = dict(gpu=args.gpu, tta=args.tta, postprocess=args.postprocess)
+    server = ConversionServer(
+        (args.host, args.port), pipeline_kwargs,
+        max_queue=args.max_queue, num_workers=args.num_workers, timeout=args.timeout)
+    print('serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
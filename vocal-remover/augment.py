@@ -1,78 +1,77 @@
 import argparse
+import multiprocessing
 import os
-import subprocess
+from functools import partial
 
 import librosa
 import numpy as np
-import soundfile as sf
 from tqdm import tqdm
 
 from lib import dataset
 from lib import spec_utils
 
 
-if __name__ == '__main__':
-    p = argparse.ArgumentParser()
-    p.add_argument('--sr', '-r', type=int, default=44100)
-    p.add_argument('--hop_length', '-l', type=int, default=1024)
-    p.add_argument('--n_fft', '-f', type=int, default=2048)
-    p.add_argument('--pitch', '-p', type=int, default=-1)
-    p.add_argument('--mixtures', '-m', required=True)
-    p.add_argument('--instruments', '-i', required=True)
-    args = p.parse_args()
+def pitch_shift(wave, sr, n_steps):
+    # phase vocoder time stretch followed by resampling, per channel
+    return np.asarray([
+        librosa.effects.pitch_shift(channel, sr, n_steps, res_type='kaiser_fast')
+        for channel in wave
+    ])
 
-    input_i = 'input_i_{}.wav'.format(args.pitch)
-    input_v = 'input_v_{}.wav'.format(args.pitch)
-    output_i = 'output_i_{}.wav'.format(args.pitch)
-    output_v = 'output_v_{}.wav'.format(args.pitch)
-    cmd_i = 'soundstretch {} {} -pitch={}'.format(input_i, output_i, args.pitch)
-    cmd_v = 'soundstretch {} {} -pitch={}'.format(input_v, output_v, args.pitch)
-    cache_suffix = '_pitch{}.npy'.format(args.pitch)
 
-    cache_dir = 'sr{}_hl{}_nf{}'.format(args.sr, args. hop_length, args.n_fft)
-    mix_cache_dir = os.path.join(args.mixtures, cache_dir)
-    inst_cache_dir = os.path.join(args.instruments, cache_dir)
-    os.makedirs(mix_cache_dir, exist_ok=True)
-    os.makedirs(inst_cache_dir, exist_ok=True)
+def augment_pair(pair, sr, hop_length, n_fft, pitch, cache_suffix):
+    mix_path, inst_path = pair
+    mix_cache_path, inst_cache_path = spec_utils.get_cache_paths(
+        mix_path, inst_path, sr, hop_length, n_fft
+    )
+    mix_cache_path = mix_cache_path[:-len('.npy')] + cache_suffix
+    inst_cache_path = inst_cache_path[:-len('.npy')] + cache_suffix
 
-    filelist = dataset.make_pair(args.mixtures, args.instruments)
-    for mix_path, inst_path in tqdm(filelist):
-        mix_basename = os.path.splitext(os.path.basename(mix_path))[0]
-        mix_cache_path = os.path.join(mix_cache_dir, mix_basename + cache_suffix)
+    if os.path.exists(mix_cache_path) and os.path.exists(inst_cache_path):
+        return
 
-        inst_basename = os.path.splitext(os.path.basename(inst_path))[0]
-        inst_cache_path = os.path.join(inst_cache_dir, inst_basename + cache_suffix)
+    X, _ = librosa.load(
+        mix_path, sr, False, dtype=np.float32, res_type='kaiser_fast')
+    y, _ = librosa.load(
+        inst_path, sr, False, dtype=np.float32, res_type='kaiser_fast')
 
-        if os.path.exists(mix_cache_path) and os.path.exists(inst_cache_path):
-            continue
+    X, y = spec_utils.align_wave_head_and_tail(X, y, sr)
+    v = X - y
 
-        X, _ = librosa.load(
-            mix_path, args.sr, False, dtype=np.float32, res_type='kaiser_fast')
-        y, _ = librosa.load(
-            inst_path, args.sr, False, dtype=np.float32, res_type='kaiser_fast')
+    y = pitch_shift(y, sr, pitch)
+    v = pitch_shift(v, sr, pitch)
 
-        X, y = spec_utils.align_wave_head_and_tail(X, y, args.sr)
-        v = X - y
+    X = y + v
 
-        sf.write(input_i, y.T, args.sr)
-        sf.write(input_v, v.T, args.sr)
-        subprocess.call(cmd_i, stderr=subprocess.DEVNULL)
-        subprocess.call(cmd_v, stderr=subprocess.DEVNULL)
+    spec = spec_utils.wave_to_spectrogram(X, hop_length, n_fft)
+    spec_utils.save_atomic(mix_cache_path, spec)
 
-        y, _ = librosa.load(
-            output_i, args.sr, False, dtype=np.float32, res_type='kaiser_fast')
-        v, _ = librosa.load(
-            output_v, args.sr, False, dtype=np.float32, res_type='kaiser_fast')
+    spec = spec_utils.wave_to_spectrogram(y, hop_length, n_fft)
+    spec_utils.save_atomic(inst_cache_path, spec)
 
-        X = y + v
 
-        spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
-        np.save(mix_cache_path, spec)
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--hop_length', '-l', type=int, default=1024)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--pitch', '-p', type=int, default=-1)
+    p.add_argument('--mixtures', '-m', required=True)
+    p.add_argument('--instruments', '-i', required=True)
+    p.add_argument('--num_workers', '-w', type=int, default=multiprocessing.cpu_count())
+    args = p.parse_args()
 
-        spec = spec_utils.wave_to_spectrogram(y, args.hop_length, args.n_fft)
-        np.save(inst_cache_path, spec)
+    worker = partial(
+        augment_pair,
+        sr=args.sr,
+        hop_length=args.hop_length,
+        n_fft=args.n_fft,
+        pitch=args.pitch,
+        cache_suffix='_pitch{}.npy'.format(args.pitch)
+    )
 
-        os.remove(input_i)
-        os.remove(input_v)
-        os.remove(output_i)
-        os.remove(output_v)
+    # no temporary files, so several runs (e.g. one per pitch) can share the dataset
+    filelist = dataset.make_pair(args.mixtures, args.instruments)
+    with multiprocessing.Pool(args.num_workers) as pool:
+        for _ in tqdm(pool.imap_unordered(worker, filelist), total=len(filelist)):
+            pass
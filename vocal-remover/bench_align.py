@@ -0,0 +1,61 @@
+import argparse
+import time
+
+import librosa
+import numpy as np
+
+from lib import dataset
+from lib import spec_utils
+
+
+def synthetic_pairs(n_pairs, sr, seconds=10):
+    rng = np.random.RandomState(0)
+    for _ in range(n_pairs):
+        delay = rng.randint(0, sr // 10)
+        y = rng.randn(2, sr * seconds).astype(np.float32) * 0.1
+        v = rng.randn(2, sr * seconds).astype(np.float32) * 0.05
+        X = np.pad(y + v, ((0, 0), (delay, 0)), mode='constant')
+        yield X, y
+
+
+def file_pairs(mix_dir, inst_dir, sr):
+    for mix_path, inst_path in dataset.make_pair(mix_dir, inst_dir):
+        X, _ = librosa.load(
+            mix_path, sr, False, dtype=np.float32, res_type='kaiser_fast')
+        y, _ = librosa.load(
+            inst_path, sr, False, dtype=np.float32, res_type='kaiser_fast')
+        yield X, y
+
+
+def main():
+    p = argparse.ArgumentParser(description='per-pair time of align_wave_head_and_tail')
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--mixtures', '-m', type=str, default=None)
+    p.add_argument('--instruments', '-i', type=str, default=None)
+    p.add_argument('--n_pairs', '-n', type=int, default=3)
+    p.add_argument('--methods', type=str, nargs='+', default=['direct', 'fft', 'coarse'])
+    args = p.parse_args()
+
+    if args.mixtures is not None:
+        pairs = list(file_pairs(args.mixtures, args.instruments, args.sr))[:args.n_pairs]
+    else:
+        pairs = list(synthetic_pairs(args.n_pairs, args.sr))
+
+    results = {}
+    for method in args.methods:
+        elapsed = 0
+        results[method] = []
+        for X, y in pairs:
+            start = time.perf_counter()
+            X_aligned, y_aligned = spec_utils.align_wave_head_and_tail(X, y, args.sr, method)
+            elapsed += time.perf_counter() - start
+            results[method].append(X.shape[1] - X_aligned.shape[1] - (y.shape[1] - y_aligned.shape[1]))
+        print('{:>8}: {:.3f} s/pair'.format(method, elapsed / len(pairs)))
+
+    reference = results[args.methods[0]]
+    for method in args.methods[1:]:
+        print('{:>8}: same alignment as {}: {}'.format(method, args.methods[0], results[method] == reference))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import multiprocessing
+import os
+from functools import partial
+
+from tqdm import tqdm
+
+from lib import dataset
+from lib import spec_utils
+
+
+def build_pair(pair, sr, hop_length, n_fft, align_method, cache_format):
+    X_path, y_path = pair
+    X, y, X_cache_path, y_cache_path = spec_utils.cache_or_load(
+        X_path, y_path, sr, hop_length, n_fft, align_method, cache_format
+    )
+
+    return X_cache_path, spec_utils.make_manifest_entry(X, y, y_cache_path)
+
+
+def list_pairs(dataset_dir):
+    if os.path.isdir(os.path.join(dataset_dir, 'mixtures')):
+        return dataset.make_pair(
+            os.path.join(dataset_dir, 'mixtures'),
+            os.path.join(dataset_dir, 'instruments')
+        )
+
+    filelist = []
+    for subdir in ['training', 'validation']:
+        filelist += dataset.make_pair(
+            os.path.join(dataset_dir, subdir, 'mixtures'),
+            os.path.join(dataset_dir, subdir, 'instruments')
+        )
+
+    return filelist
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--dataset', '-d', required=True)
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--hop_length', '-H', type=int, default=1024)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--num_workers', '-w', type=int, default=multiprocessing.cpu_count())
+    p.add_argument('--align_method', type=str, choices=['direct', 'fft', 'coarse'], default='fft')
+    p.add_argument('--cache_format', type=str, choices=['complex64', 'float16'], default='complex64')
+    p.add_argument('--save_every', type=int, default=16)
+    args = p.parse_args()
+
+    manifests = {}
+    todo = []
+    for X_path, y_path in list_pairs(args.dataset):
+        X_cache_path, y_cache_path = spec_utils.get_cache_paths(
+            X_path, y_path, args.sr, args.hop_length, args.n_fft, args.cache_format
+        )
+        manifest_path = spec_utils.get_manifest_path(X_cache_path)
+        if manifest_path not in manifests:
+            manifests[manifest_path] = spec_utils.load_manifest(manifest_path)
+
+        if spec_utils.lookup_manifest(manifests[manifest_path], X_cache_path, y_cache_path) is None:
+            todo.append((X_path, y_path))
+    print('{} pairs to cache'.format(len(todo)))
+
+    worker = partial(
+        build_pair,
+        sr=args.sr,
+        hop_length=args.hop_length,
+        n_fft=args.n_fft,
+        align_method=args.align_method,
+        cache_format=args.cache_format
+    )
+
+    # only this process writes the manifests
+    updated = set()
+    with multiprocessing.Pool(args.num_workers) as pool:
+        results = pool.imap_unordered(worker, todo)
+        for i, (X_cache_path, entry) in enumerate(tqdm(results, total=len(todo))):
+            manifest_path = spec_utils.get_manifest_path(X_cache_path)
+            manifests[manifest_path][os.path.basename(X_cache_path)] = entry
+            updated.add(manifest_path)
+
+            if (i + 1) % args.save_every == 0:
+                for manifest_path in updated:
+                    spec_utils.save_manifest(manifest_path, manifests[manifest_path])
+                updated = set()
+
+    for manifest_path in updated:
+        spec_utils.save_manifest(manifest_path, manifests[manifest_path])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 import argparse
+import copy
+import itertools
 import os
+import time
 
 import librosa
 import numpy as np
@@ -13,6 +16,17 @@ from lib import spec_utils
 from lib import utils
 
 
+def crop_view(X, cropsize, step=1):
+    """Read-only strided view of shape (channels, bins, crops, cropsize) of
+    the crops of X starting every `step` frames, nothing is copied."""
+    n_crop = (X.shape[2] - cropsize) // step + 1
+    stride_channel, stride_bin, stride_frame = X.strides
+    return np.lib.stride_tricks.as_strided(
+        X, shape=(X.shape[0], X.shape[1], n_crop, cropsize),
+        strides=(stride_channel, stride_bin, stride_frame * step, stride_frame),
+        writeable=False)
+
+
 class Separator(object):
 
     def __init__(self, model, device, batchsize, cropsize, postprocess=False):
@@ -22,34 +36,76 @@ class Separator(object):
         self.batchsize = batchsize
         self.cropsize = cropsize
         self.postprocess = postprocess
+        self._batch_buffer = None
+        self.reference_model = None
+        self.channels_last = False
+        self.bf16 = False
+
+    def set_inference_mode(self, fuse_bn=True, channels_last=True, bf16=False):
+        """Opt-in faster inference on a copy of the model.
+
+        Folds the BatchNorm layers into the conv weights, uses channels-last
+        memory format and optionally bf16 autocast (e.g. on CPU). The fp32
+        model is kept as `reference_model` for `compare_with_reference`.
+        """
+        if bf16 and not hasattr(torch, 'autocast'):
+            raise RuntimeError('bf16 inference needs torch.autocast (torch >= 1.10)')
+        if self.reference_model is None:
+            self.reference_model = self.model
+        model = copy.deepcopy(self.reference_model).eval()
+        if fuse_bn:
+            model.fuse_bn()
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.model = model
+        self.channels_last = channels_last
+        self.bf16 = bf16
+
+    def _predict_mask(self, X_batch):
+        if self.channels_last:
+            X_batch = X_batch.contiguous(memory_format=torch.channels_last)
+        if self.bf16:
+            with torch.autocast(torch.device(self.device).type, dtype=torch.bfloat16):
+                pred = self.model.predict_mask(X_batch)
+        else:
+            pred = self.model.predict_mask(X_batch)
+
+        return pred.float()
+
+    def _get_batch_buffer(self, shape):
+        # Reused across calls (e.g. by separate_stream); pinned so that the
+        # host to device copy can be asynchronous.
+        if self._batch_buffer is None or self._batch_buffer.shape != shape:
+            pin_memory = torch.device(self.device).type == 'cuda'
+            self._batch_buffer = torch.empty(shape, dtype=torch.float32, pin_memory=pin_memory)
 
-    def _separate(self, X_mag_pad, roi_size):
-        X_dataset = []
+        return self._batch_buffer
+
+    def _separate(self, X_mag_pad, roi_size, progress=True):
+        n_channel, n_bin = X_mag_pad.shape[:2]
         patches = (X_mag_pad.shape[2] - 2 * self.offset) // roi_size
-        for i in range(patches):
-            start = i * roi_size
-            X_mag_crop = X_mag_pad[:, :, start:start + self.cropsize]
-            X_dataset.append(X_mag_crop)
 
-        X_dataset = np.asarray(X_dataset)
+        # Overlapping crops as a strided view of shape (2, bins, patches, cropsize)
+        X_dataset = crop_view(X_mag_pad, self.cropsize, roi_size)[:, :, :patches]
+
+        X_batch_buf = self._get_batch_buffer((self.batchsize, n_channel, n_bin, self.cropsize))
+        X_batch_np = X_batch_buf.numpy()
+        mask = np.empty((n_channel, n_bin, patches, roi_size), dtype=np.float32)
 
         self.model.eval()
         with torch.no_grad():
-            mask = []
             # To reduce the overhead, dataloader is not used.
-            for i in tqdm(range(0, patches, self.batchsize)):
-                X_batch = X_dataset[i: i + self.batchsize]
-                X_batch = torch.from_numpy(X_batch).to(self.device)
+            for i in tqdm(range(0, patches, self.batchsize), disable=not progress):
+                n = min(self.batchsize, patches - i)
+                X_batch_np[:n] = X_dataset[:, :, i:i + n].transpose(2, 0, 1, 3)
+                X_batch = X_batch_buf[:n].to(self.device, non_blocking=True)
 
-                pred = self.model.predict_mask(X_batch)
+                pred = self._predict_mask(X_batch)
 
-                pred = pred.detach().cpu().numpy()
-                pred = np.concatenate(pred, axis=2)
-                mask.append(pred)
+                # (n, 2, bins, roi) -> mask[:, :, i:i + n]
+                mask[:, :, i:i + n] = pred.permute(1, 2, 0, 3).cpu().numpy()
 
-            mask = np.concatenate(mask, axis=2)
-
-        return mask
+        return mask.reshape(n_channel, n_bin, patches * roi_size)
 
     def _preprocess(self, X_spec):
         X_mag = np.abs(X_spec)
@@ -66,44 +122,233 @@ class Separator(object):
 
         return y_spec, v_spec
 
-    def separate(self, X_spec):
-        X_mag, X_phase = self._preprocess(X_spec)
-
+    def _mask(self, X_mag, progress=True):
         n_frame = X_mag.shape[2]
         pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
         X_mag_pad = np.pad(X_mag, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
         X_mag_pad /= X_mag_pad.max()
 
-        mask = self._separate(X_mag_pad, roi_size)
-        mask = mask[:, :, :n_frame]
+        mask = self._separate(X_mag_pad, roi_size, progress)
+
+        return mask[:, :, :n_frame]
+
+    def separate(self, X_spec):
+        X_mag, X_phase = self._preprocess(X_spec)
+
+        mask = self._mask(X_mag)
 
         y_spec, v_spec = self._postprocess(mask, X_mag, X_phase)
 
         return y_spec, v_spec
 
+    def compare_with_reference(self, X_spec):
+        """Mask error and run time of the inference mode against the fp32 model."""
+        if self.reference_model is None:
+            raise ValueError('set_inference_mode must be called first')
+        X_mag, _ = self._preprocess(X_spec)
+
+        start = time.perf_counter()
+        mask = self._mask(X_mag, progress=False)
+        elapsed = time.perf_counter() - start
+
+        fast_state = self.model, self.channels_last, self.bf16
+        self.model, self.channels_last, self.bf16 = self.reference_model, False, False
+        try:
+            start = time.perf_counter()
+            mask_ref = self._mask(X_mag, progress=False)
+            elapsed_ref = time.perf_counter() - start
+        finally:
+            self.model, self.channels_last, self.bf16 = fast_state
+
+        error = np.abs(mask - mask_ref)
+
+        return {
+            'max_abs_error': float(error.max()),
+            'mean_abs_error': float(error.mean()),
+            'time': elapsed,
+            'reference_time': elapsed_ref,
+        }
+
     def separate_tta(self, X_spec):
         X_mag, X_phase = self._preprocess(X_spec)
 
         n_frame = X_mag.shape[2]
         pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
-        X_mag_pad = np.pad(X_mag, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
-        X_mag_pad /= X_mag_pad.max()
-
-        mask = self._separate(X_mag_pad, roi_size)
-
         pad_l += roi_size // 2
         pad_r += roi_size // 2
         X_mag_pad = np.pad(X_mag, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
         X_mag_pad /= X_mag_pad.max()
 
-        mask_tta = self._separate(X_mag_pad, roi_size)
-        mask_tta = mask_tta[:, :, roi_size // 2:]
-        mask = (mask[:, :, :n_frame] + mask_tta[:, :, :n_frame]) * 0.5
+        mask = self._separate_tta(X_mag_pad, roi_size, n_frame)
 
         y_spec, v_spec = self._postprocess(mask, X_mag, X_phase)
 
         return y_spec, v_spec
 
+    def _separate_tta(self, X_mag_pad, roi_size, n_frame):
+        """Predict the plain and the half-ROI shifted crops in the same batches.
+
+        `X_mag_pad` is padded by half an ROI more on each side than for
+        `_separate`, so the shifted crops start at 0 and the plain crops at
+        roi_size // 2. Both masks are accumulated into one array and averaged.
+        """
+        n_channel, n_bin = X_mag_pad.shape[:2]
+        shift = roi_size // 2
+        patches_tta = (X_mag_pad.shape[2] - 2 * self.offset) // roi_size
+        patches = (X_mag_pad.shape[2] - 2 * shift - 2 * self.offset) // roi_size
+        starts = np.sort(np.concatenate([
+            np.arange(patches_tta) * roi_size,
+            np.arange(patches) * roi_size + shift,
+        ]), kind='stable')
+
+        X_dataset = crop_view(X_mag_pad, self.cropsize)
+
+        X_batch_buf = self._get_batch_buffer((self.batchsize, n_channel, n_bin, self.cropsize))
+        X_batch_np = X_batch_buf.numpy()
+        mask = np.zeros((n_channel, n_bin, n_frame), dtype=np.float32)
+
+        self.model.eval()
+        with torch.no_grad():
+            for i in tqdm(range(0, len(starts), self.batchsize)):
+                batch_starts = starts[i:i + self.batchsize]
+                n = len(batch_starts)
+                X_batch_np[:n] = X_dataset[:, :, batch_starts].transpose(2, 0, 1, 3)
+                X_batch = X_batch_buf[:n].to(self.device, non_blocking=True)
+
+                pred = self._predict_mask(X_batch).cpu().numpy()
+
+                for pred_crop, start in zip(pred, batch_starts):
+                    # first output frame of the crop in the unpadded spectrogram
+                    s = start - shift
+                    lo, hi = max(s, 0), min(s + roi_size, n_frame)
+                    if lo < hi:
+                        mask[:, :, lo:hi] += pred_crop[:, :, lo - s:hi - s]
+
+        mask *= 0.5
+
+        return mask
+
+    def separate_stream(self, spec_blocks, mag_max=None):
+        """Separate a spectrogram given as an iterable of (2, bins, frames) blocks.
+
+        Yields (y_spec, v_spec) blocks as soon as the ROI windows covering them
+        are predicted, so memory depends on cropsize and batchsize only.
+        `mag_max` is the maximum magnitude of the whole spectrogram used for
+        normalization, as in `separate`. If None, the running maximum of the
+        frames seen so far is used instead. With postprocess, merge_artifacts
+        is applied block by block (spec_utils.StreamingArtifactMerger).
+        """
+        _, _, roi_size = dataset.make_padding(self.cropsize, self.cropsize, self.offset)
+        merger = spec_utils.StreamingArtifactMerger() if self.postprocess else None
+        X_spec_buf = None
+        X_mag_buf = None
+        running_max = 0
+        n_frame = 0
+        n_done = 0
+        for X_spec in itertools.chain(spec_blocks, [None]):
+            final = X_spec is None
+            if final:
+                if X_spec_buf is None:
+                    return
+                _, pad_r, _ = dataset.make_padding(n_frame, self.cropsize, self.offset)
+                X_mag_buf = np.pad(X_mag_buf, ((0, 0), (0, 0), (0, pad_r)), mode='constant')
+            elif X_spec.shape[2] == 0:
+                continue
+            else:
+                X_mag = np.abs(X_spec)
+                running_max = max(running_max, X_mag.max())
+                n_frame += X_spec.shape[2]
+                if X_spec_buf is None:
+                    X_spec_buf = X_spec
+                    X_mag_buf = np.pad(X_mag, ((0, 0), (0, 0), (self.offset, 0)), mode='constant')
+                else:
+                    X_spec_buf = np.concatenate([X_spec_buf, X_spec], axis=2)
+                    X_mag_buf = np.concatenate([X_mag_buf, X_mag], axis=2)
+
+            patches = (X_mag_buf.shape[2] - 2 * self.offset) // roi_size
+            if not final:
+                # wait for full batches
+                patches -= patches % self.batchsize
+                if patches <= 0:
+                    continue
+
+            width = patches * roi_size
+            norm = mag_max if mag_max is not None else running_max
+            mask = self._separate(
+                X_mag_buf[:, :, :width + 2 * self.offset] / norm, roi_size, progress=False)
+            mask = mask[:, :, :min(width, n_frame - n_done)]
+            X_mag_buf = X_mag_buf[:, :, width:]
+            n_done += mask.shape[2]
+
+            if merger is not None:
+                # the merger may hold back frames of a possible artifact run
+                mask = merger.process(mask, final)
+
+            n_out = mask.shape[2]
+            X_out = X_spec_buf[:, :, :n_out]
+            X_spec_buf = X_spec_buf[:, :, n_out:]
+            if n_out > 0:
+                yield mask * X_out, (1 - mask) * X_out
+
+    def separate_wave_stream(self, wave_blocks, hop_length, n_fft, mag_max=None):
+        """Separate stereo wave blocks and yield (instruments, vocals) wave blocks.
+
+        Wraps `separate_stream` with an incremental STFT and overlap-add iSTFT.
+        """
+        stft = spec_utils.StreamingSTFT(hop_length, n_fft)
+        y_istft = spec_utils.StreamingISTFT(hop_length)
+        v_istft = spec_utils.StreamingISTFT(hop_length)
+
+        def spec_blocks():
+            for wave in wave_blocks:
+                yield stft.process(wave)
+            yield stft.flush()
+
+        for y_spec, v_spec in self.separate_stream(spec_blocks(), mag_max):
+            yield y_istft.process(y_spec), v_istft.process(v_spec)
+        yield y_istft.flush(), v_istft.flush()
+
+
+def compute_mag_max(wave_blocks, hop_length, n_fft):
+    """Maximum STFT magnitude of a wave given as blocks, without keeping the spectrogram."""
+    stft = spec_utils.StreamingSTFT(hop_length, n_fft)
+    mag_max = 0
+    for wave in itertools.chain(wave_blocks, [None]):
+        X_spec = stft.flush() if wave is None else stft.process(wave)
+        if X_spec.shape[2] > 0:
+            mag_max = max(mag_max, np.abs(X_spec).max())
+
+    return mag_max
+
+
+def resample_blocks(blocks, orig_sr, sr):
+    resampler = spec_utils.StreamingResampler(orig_sr, sr)
+    for X in blocks:
+        yield resampler.process(X)
+    yield resampler.flush()
+
+
+def read_wave_blocks(path, sr, block_seconds=10):
+    """Read a stereo wave in blocks, mono is duplicated to stereo.
+
+    Other sample rates than `sr` are resampled block by block (polyphase
+    filter instead of the kaiser_fast of librosa.load), so memory does not
+    depend on the length of the wave.
+    """
+    orig_sr = sf.info(path).samplerate
+    blocks = sf.blocks(path, blocksize=orig_sr * block_seconds, dtype='float32', always_2d=True)
+    blocks = (block.T for block in blocks)
+    if orig_sr != sr:
+        blocks = resample_blocks(blocks, orig_sr, sr)
+
+    for X in blocks:
+        if X.shape[1] == 0:
+            continue
+        if X.shape[0] == 1:
+            # mono to stereo
+            X = np.concatenate([X, X])
+        yield X
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -118,6 +363,13 @@ def main():
     p.add_argument('--output_image', '-I', action='store_true')
     p.add_argument('--postprocess', '-p', action='store_true')
     p.add_argument('--tta', '-t', action='store_true')
+    p.add_argument('--stream', '-s', action='store_true')
+    p.add_argument('--stft_backend', type=str, default='librosa', choices=['librosa', 'torch'],
+                   help='torch runs the STFT on the device')
+    p.add_argument('--fuse_bn', action='store_true')
+    p.add_argument('--channels_last', action='store_true')
+    p.add_argument('--bf16', action='store_true', help='bf16 autocast, needs torch >= 1.10')
+    p.add_argument('--report_mask_error', action='store_true')
     p.add_argument('--output_dir', '-o', type=str, default="")
     args = p.parse_args()
 
@@ -130,6 +382,10 @@ def main():
         model.to(device)
     print('done')
 
+    if args.stream:
+        separate_file_stream(model, device, args)
+        return
+
     print('loading wave source...', end=' ')
     X, sr = librosa.load(
         args.input, args.sr, False, dtype=np.float32, res_type='kaiser_fast')
@@ -141,10 +397,17 @@ def main():
         X = np.asarray([X, X])
 
     print('stft of wave source...', end=' ')
-    X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
+    X_spec = spec_utils.wave_to_spectrogram(
+        X, args.hop_length, args.n_fft, backend=args.stft_backend, device=device)
     print('done')
 
     sp = Separator(model, device, args.batchsize, args.cropsize, args.postprocess)
+    if args.fuse_bn or args.channels_last or args.bf16:
+        sp.set_inference_mode(args.fuse_bn, args.channels_last, args.bf16)
+        if args.report_mask_error:
+            report = sp.compare_with_reference(X_spec)
+            print('mask error against fp32: max {max_abs_error:.6f}, mean {mean_abs_error:.6f}; '
+                  'time {time:.2f}s vs {reference_time:.2f}s'.format(**report))
 
     if args.tta:
         y_spec, v_spec = sp.separate_tta(X_spec)
@@ -162,12 +425,14 @@ def main():
     os.system("rm TMP/source_singer.wav")
 
     print('inverse stft of instruments...', end=' ')
-    wave = spec_utils.spectrogram_to_wave(y_spec, hop_length=args.hop_length)
+    wave = spec_utils.spectrogram_to_wave(
+        y_spec, hop_length=args.hop_length, backend=args.stft_backend, device=device)
     print('done')
     sf.write('TMP/source_music.wav'.format(output_dir, basename), wave.T, sr)
 
     print('inverse stft of vocals...', end=' ')
-    wave = spec_utils.spectrogram_to_wave(v_spec, hop_length=args.hop_length)
+    wave = spec_utils.spectrogram_to_wave(
+        v_spec, hop_length=args.hop_length, backend=args.stft_backend, device=device)
     print('done')
     sf.write('TMP/source_singer.wav'.format(output_dir, basename), wave.T, sr)
 
@@ -181,5 +446,23 @@ def main():
         utils.imwrite('{}{}_Vocals.jpg'.format(output_dir, basename), image)
 
 
+def separate_file_stream(model, device, args):
+    sp = Separator(model, device, args.batchsize, args.cropsize, args.postprocess)
+
+    print('computing magnitude range...', end=' ')
+    mag_max = compute_mag_max(
+        read_wave_blocks(args.input, args.sr), args.hop_length, args.n_fft)
+    print('done')
+
+    os.makedirs('TMP', exist_ok=True)
+    blocks = sp.separate_wave_stream(
+        read_wave_blocks(args.input, args.sr), args.hop_length, args.n_fft, mag_max)
+    with sf.SoundFile('TMP/source_music.wav', 'w', args.sr, 2) as inst_file, \
+            sf.SoundFile('TMP/source_singer.wav', 'w', args.sr, 2) as vocal_file:
+        for inst, vocal in tqdm(blocks):
+            inst_file.write(inst.T)
+            vocal_file.write(vocal.T)
+
+
 if __name__ == '__main__':
     main()
@@ -14,13 +14,16 @@ except ModuleNotFoundError:
 
 class VocalRemoverTrainingSet(torch.utils.data.Dataset):
 
-    def __init__(self, training_set, cropsize, reduction_rate, reduction_weight, mixup_rate, mixup_alpha):
+    def __init__(self, training_set, cropsize, reduction_rate, reduction_weight, mixup_rate, mixup_alpha,
+                 batch_aug=False):
         self.training_set = training_set
         self.cropsize = cropsize
         self.reduction_rate = reduction_rate
         self.reduction_weight = reduction_weight
         self.mixup_rate = mixup_rate
         self.mixup_alpha = mixup_alpha
+        # augmentation is done by BatchAugmentation after collation
+        self.batch_aug = batch_aug
 
     def __len__(self):
         return len(self.training_set)
@@ -29,11 +32,11 @@ class VocalRemoverTrainingSet(torch.utils.data.Dataset):
         X_mmap = np.load(X_path, mmap_mode='r')
         y_mmap = np.load(y_path, mmap_mode='r')
 
-        start = np.random.randint(0, X_mmap.shape[2] - self.cropsize)
+        start = np.random.randint(0, X_mmap.shape[-1] - self.cropsize)
         end = start + self.cropsize
 
-        X_crop = np.array(X_mmap[:, :, start:end], copy=True)
-        y_crop = np.array(y_mmap[:, :, start:end], copy=True)
+        X_crop = spec_utils.load_cache_crop(X_mmap, start, end)
+        y_crop = spec_utils.load_cache_crop(y_mmap, start, end)
 
         return X_crop, y_crop
 
@@ -77,6 +80,10 @@ class VocalRemoverTrainingSet(torch.utils.data.Dataset):
         X_path, y_path, coef = self.training_set[idx]
 
         X, y = self.do_crop(X_path, y_path)
+        if self.batch_aug:
+            # real tensors only, the pinned torch has no complex support
+            return np.abs(X), np.angle(X), np.abs(y), np.angle(y), np.float32(coef)
+
         X /= coef
         y /= coef
 
@@ -91,6 +98,75 @@ class VocalRemoverTrainingSet(torch.utils.data.Dataset):
         return X_mag, y_mag
 
 
+class BatchAugmentation(object):
+    """Batched torch version of the VocalRemoverTrainingSet augmentation.
+
+    Takes the magnitudes, phases and coefs of a collated batch (see
+    `batch_aug`) on the training device and returns the augmented
+    magnitudes. Each row gets the same random augmentation as in `do_aug`;
+    mixup partners are other rows of the batch instead of freshly loaded
+    crops.
+    """
+
+    def __init__(self, reduction_rate, reduction_weight, mixup_rate, mixup_alpha, device):
+        self.reduction_rate = reduction_rate
+        self.reduction_weight = torch.as_tensor(reduction_weight, device=device)
+        self.mixup_rate = mixup_rate
+        self.beta = torch.distributions.Beta(
+            torch.tensor(float(mixup_alpha), device=device),
+            torch.tensor(float(mixup_alpha), device=device)
+        )
+        self.device = device
+
+    def _rand(self, n):
+        return torch.rand(n, 1, 1, 1, device=self.device)
+
+    def aggressively_remove_vocal(self, X_mag, y_mag):
+        v_mag = X_mag - y_mag
+        v_mag *= v_mag > y_mag
+
+        return torch.clamp(y_mag - v_mag * self.reduction_weight, min=0)
+
+    def mixup(self, lam, mag, phase, perm):
+        """Magnitude of lam * Z + (1 - lam) * Z[perm], Z = mag * exp(1j * phase)."""
+        real = mag * torch.cos(phase)
+        imag = mag * torch.sin(phase)
+        real = lam * real + (1 - lam) * real[perm]
+        imag = lam * imag + (1 - lam) * imag[perm]
+
+        return torch.sqrt(real ** 2 + imag ** 2)
+
+    def __call__(self, X_mag, X_phase, y_mag, y_phase, coef):
+        n = len(X_mag)
+        coef = coef.view(n, 1, 1, 1)
+        X_mag = X_mag / coef
+        y_mag = y_mag / coef
+
+        reduce = self._rand(n) < self.reduction_rate
+        if reduce.any():
+            y_mag = torch.where(reduce, self.aggressively_remove_vocal(X_mag, y_mag), y_mag)
+
+        # swap channel
+        swap = self._rand(n) < 0.5
+        X_mag, X_phase, y_mag, y_phase = [
+            torch.where(swap, t.flip(1), t) for t in (X_mag, X_phase, y_mag, y_phase)
+        ]
+
+        # inst
+        inst = self._rand(n) < 0.01
+        X_mag = torch.where(inst, y_mag, X_mag)
+        X_phase = torch.where(inst, y_phase, X_phase)
+
+        mixup = self._rand(n) < self.mixup_rate
+        if mixup.any():
+            perm = torch.randperm(n, device=self.device)
+            lam = self.beta.sample((n, 1, 1, 1))
+            X_mag = torch.where(mixup, self.mixup(lam, X_mag, X_phase, perm), X_mag)
+            y_mag = torch.where(mixup, self.mixup(lam, y_mag, y_phase, perm), y_mag)
+
+        return X_mag, y_mag
+
+
 class VocalRemoverValidationSet(torch.utils.data.Dataset):
 
     def __init__(self, patch_list):
@@ -175,19 +251,37 @@ def make_padding(width, cropsize, offset):
     return left, right, roi_size
 
 
-def make_training_set(filelist, sr, hop_length, n_fft):
+def make_training_set(filelist, sr, hop_length, n_fft, cache_format='complex64'):
     ret = []
+    manifests = {}
+    updated = set()
     for X_path, y_path in tqdm(filelist):
-        X, y, X_cache_path, y_cache_path = spec_utils.cache_or_load(
-            X_path, y_path, sr, hop_length, n_fft
+        X_cache_path, y_cache_path = spec_utils.get_cache_paths(
+            X_path, y_path, sr, hop_length, n_fft, cache_format
         )
-        coef = np.max([np.abs(X).max(), np.abs(y).max()])
-        ret.append([X_cache_path, y_cache_path, coef])
+        manifest_path = spec_utils.get_manifest_path(X_cache_path)
+        if manifest_path not in manifests:
+            manifests[manifest_path] = spec_utils.load_manifest(manifest_path)
+        manifest = manifests[manifest_path]
+
+        # pairs in the manifest (e.g. from build_cache.py) are not even opened
+        entry = spec_utils.lookup_manifest(manifest, X_cache_path, y_cache_path)
+        if entry is None:
+            X, y, _, _ = spec_utils.cache_or_load(
+                X_path, y_path, sr, hop_length, n_fft, cache_format=cache_format
+            )
+            entry = spec_utils.make_manifest_entry(X, y, y_cache_path)
+            manifest[os.path.basename(X_cache_path)] = entry
+            updated.add(manifest_path)
+        ret.append([X_cache_path, y_cache_path, entry['coef']])
+
+    for manifest_path in updated:
+        spec_utils.save_manifest(manifest_path, manifests[manifest_path])
 
     return ret
 
 
-def make_validation_set(filelist, cropsize, sr, hop_length, n_fft, offset):
+def make_validation_set(filelist, cropsize, sr, hop_length, n_fft, offset, cache_format='complex64'):
     patch_list = []
     patch_dir = 'cs{}_sr{}_hl{}_nf{}_of{}'.format(cropsize, sr, hop_length, n_fft, offset)
     os.makedirs(patch_dir, exist_ok=True)
@@ -195,7 +289,8 @@ def make_validation_set(filelist, cropsize, sr, hop_length, n_fft, offset):
     for X_path, y_path in tqdm(filelist):
         basename = os.path.splitext(os.path.basename(X_path))[0]
 
-        X, y, _, _ = spec_utils.cache_or_load(X_path, y_path, sr, hop_length, n_fft)
+        X, y, _, _ = spec_utils.cache_or_load(
+            X_path, y_path, sr, hop_length, n_fft, cache_format=cache_format)
         coef = np.max([np.abs(X).max(), np.abs(y).max()])
         X, y = X / coef, y / coef
 
@@ -1,10 +1,26 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from lib import spec_utils
 
 
+def fuse_linear_bn_eval(linear, bn):
+    """Linear layer equal to `linear` followed by `bn` in eval mode.
+
+    torch.nn.utils.fusion only has it from torch 1.10 on.
+    """
+    scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+    bias = linear.bias if linear.bias is not None else torch.zeros_like(bn.running_mean)
+
+    fused = nn.Linear(linear.in_features, linear.out_features)
+    fused.weight = nn.Parameter(linear.weight * scale.unsqueeze(1))
+    fused.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+
+    return fused
+
+
 class Conv2DBNActiv(nn.Module):
 
     def __init__(self, nin, nout, ksize=3, stride=1, pad=1, dilation=1, activ=nn.ReLU):
@@ -25,6 +41,12 @@ class Conv2DBNActiv(nn.Module):
     def __call__(self, x):
         return self.conv(x)
 
+    def fuse_bn(self):
+        """Fold the BatchNorm into the conv weights (inference only)."""
+        if len(self.conv) == 3:
+            conv, bn, activ = self.conv
+            self.conv = nn.Sequential(fuse_conv_bn_eval(conv, bn), activ)
+
 
 # class SeperableConv2DBNActiv(nn.Module):
 
@@ -158,3 +180,9 @@ class LSTMModule(nn.Module):
         h = h.permute(1, 2, 3, 0)
 
         return h
+
+    def fuse_bn(self):
+        """Fold the BatchNorm of the dense layer into the linear weights (inference only)."""
+        if len(self.dense) == 3:
+            linear, bn, activ = self.dense
+            self.dense = nn.Sequential(fuse_linear_bn_eval(linear, bn), activ)
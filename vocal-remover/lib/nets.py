@@ -129,3 +129,16 @@ class CascadedNet(nn.Module):
             assert pred_mag.size()[3] > 0
 
         return pred_mag
+
+    def fuse_bn(self):
+        """Fold all BatchNorm layers into the preceding conv/linear weights.
+
+        The fused model has different state_dict keys and can not be trained,
+        so apply it to a copy used for inference.
+        """
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, (layers.Conv2DBNActiv, layers.LSTMModule)):
+                module.fuse_bn()
+
+        return self
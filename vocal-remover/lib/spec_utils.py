@@ -1,8 +1,11 @@
+import json
 import os
 
 import librosa
 import numpy as np
 import soundfile as sf
+import torch
+from scipy import signal
 
 
 def crop_center(h1, h2):
@@ -23,7 +26,7 @@ def crop_center(h1, h2):
     return h1
 
 
-def wave_to_spectrogram(wave, hop_length, n_fft):
+def wave_to_spectrogram_librosa(wave, hop_length, n_fft, device=None):
     wave_left = np.asfortranarray(wave[0])
     wave_right = np.asfortranarray(wave[1])
 
@@ -72,43 +75,165 @@ def aggressively_remove_vocal(X, y, weight):
     return y_mag * np.exp(1.j * np.angle(y))
 
 
+def _find_runs(flags):
+    """(start, end) indices of the runs of True in a 1-D bool array, end inclusive."""
+    idx = np.where(flags)[0]
+    if len(idx) == 0:
+        return idx, idx
+
+    breaks = np.where(np.diff(idx) != 1)[0]
+    start_idx = np.insert(idx[breaks + 1], 0, idx[0])
+    end_idx = np.append(idx[breaks], idx[-1])
+
+    return start_idx, end_idx
+
+
+def _fade_artifact(weight, s, e, old_e, fade_size, offset=0):
+    """Write the envelope of the artifact run [s, e] into the per-frame `weight`,
+    whose first element is frame `offset`."""
+    if old_e is not None and s - old_e < fade_size:
+        s = old_e - fade_size * 2
+
+    if s != 0:
+        weight[s - offset:s - offset + fade_size] = np.linspace(0, 1, fade_size)
+    else:
+        s -= fade_size
+
+    # e is the last frame of the run, so the fade-out always fits
+    weight[e - offset - fade_size:e - offset] = np.linspace(1, 0, fade_size)
+    weight[max(s + fade_size - offset, 0):e - offset - fade_size] = 1
+
+
+def _apply_artifact_weight(y_mask, weight):
+    # y_mask += weight * (1 - y_mask), only on the frames with artifacts
+    frames = np.nonzero(weight)[0]
+    if len(frames) > 0:
+        y_mask[:, :, frames] += weight[frames] * (1 - y_mask[:, :, frames])
+
+
 def merge_artifacts(y_mask, thres=0.05, min_range=64, fade_size=32):
     if min_range < fade_size * 2:
         raise ValueError('min_range must be >= fade_size * 2')
 
-    idx = np.where(y_mask.min(axis=(0, 1)) > thres)[0]
-    start_idx = np.insert(idx[np.where(np.diff(idx) != 1)[0] + 1], 0, idx[0])
-    end_idx = np.append(idx[np.where(np.diff(idx) != 1)[0]], idx[-1])
+    start_idx, end_idx = _find_runs(y_mask.min(axis=(0, 1)) > thres)
     artifact_idx = np.where(end_idx - start_idx > min_range)[0]
-    weight = np.zeros_like(y_mask)
-    if len(artifact_idx) > 0:
-        start_idx = start_idx[artifact_idx]
-        end_idx = end_idx[artifact_idx]
-        old_e = None
-        for s, e in zip(start_idx, end_idx):
-            if old_e is not None and s - old_e < fade_size:
-                s = old_e - fade_size * 2
+    weight = np.zeros(y_mask.shape[2], dtype=y_mask.dtype)
+    old_e = None
+    for s, e in zip(start_idx[artifact_idx], end_idx[artifact_idx]):
+        _fade_artifact(weight, s, e, old_e, fade_size)
+        old_e = e
 
-            if s != 0:
-                weight[:, :, s:s + fade_size] = np.linspace(0, 1, fade_size)
-            else:
-                s -= fade_size
-
-            if e != y_mask.shape[2]:
-                weight[:, :, e - fade_size:e] = np.linspace(1, 0, fade_size)
-            else:
-                e += fade_size
-
-            weight[:, :, s + fade_size:e - fade_size] = 1
-            old_e = e
-
-    v_mask = 1 - y_mask
-    y_mask += weight * v_mask
+    _apply_artifact_weight(y_mask, weight)
 
     return y_mask
 
 
-def align_wave_head_and_tail(a, b, sr):
+class StreamingArtifactMerger(object):
+    """Block-wise merge_artifacts for streaming separation.
+
+    `process` takes consecutive mask blocks and returns the frames whose
+    weight can no longer change, so the output lags behind the input by the
+    current artifact candidate run (plus 2 * fade_size). Call `flush` at the
+    end. The concatenated outputs match merge_artifacts of the whole mask.
+    """
+
+    def __init__(self, thres=0.05, min_range=64, fade_size=32):
+        if min_range < fade_size * 2:
+            raise ValueError('min_range must be >= fade_size * 2')
+
+        self.thres = thres
+        self.min_range = min_range
+        self.fade_size = fade_size
+        self.pending = None
+        self.flags = np.zeros(0, dtype=bool)
+        self.weight = None
+        self.pos = 0
+        self.scan = 0
+        self.old_e = None
+
+    def process(self, y_mask, final=False):
+        if self.pending is None:
+            self.pending = y_mask
+            self.weight = np.zeros(0, dtype=y_mask.dtype)
+        else:
+            self.pending = np.concatenate([self.pending, y_mask], axis=2)
+        self.flags = np.concatenate([self.flags, y_mask.min(axis=(0, 1)) > self.thres])
+        self.weight = np.concatenate([self.weight, np.zeros(y_mask.shape[2], dtype=self.weight.dtype)])
+        n_seen = self.pos + len(self.flags)
+
+        start_idx, end_idx = _find_runs(self.flags[self.scan - self.pos:])
+        start_idx += self.scan
+        end_idx += self.scan
+        self.scan = n_seen
+        if not final and len(start_idx) > 0 and end_idx[-1] == n_seen - 1:
+            # the last run may continue in the next block
+            self.scan = start_idx[-1]
+            start_idx, end_idx = start_idx[:-1], end_idx[:-1]
+
+        for s, e in zip(start_idx, end_idx):
+            if e - s > self.min_range:
+                _fade_artifact(self.weight, s, e, self.old_e, self.fade_size, self.pos)
+                self.old_e = e
+
+        frontier = n_seen
+        if not final:
+            frontier = self.scan
+            if self.old_e is not None and self.scan < self.old_e + self.fade_size:
+                # a run starting soon would pull its fade-in back before old_e
+                frontier = min(frontier, self.old_e - self.fade_size * 2)
+        n_out = max(frontier - self.pos, 0)
+
+        y_mask = self.pending[:, :, :n_out]
+        _apply_artifact_weight(y_mask, self.weight[:n_out])
+
+        self.pending = self.pending[:, :, n_out:]
+        self.flags = self.flags[n_out:]
+        self.weight = self.weight[n_out:]
+        self.pos += n_out
+
+        return y_mask
+
+    def flush(self):
+        if self.pending is None:
+            return None
+
+        return self.process(self.pending[:, :, :0], final=True)
+
+
+def _correlation_peak(a, b, method='fft', decimation=8):
+    """Index of the maximum of np.correlate(a, b, 'full').
+
+    'direct' is the O(N^2) np.correlate, 'fft' uses scipy's FFT correlation,
+    and 'coarse' finds the peak on signals decimated by `decimation` and
+    refines it at full rate within a few decimated samples.
+    """
+    if method == 'direct':
+        return np.argmax(np.correlate(a, b, 'full'))
+    elif method == 'fft':
+        return np.argmax(signal.correlate(a, b, mode='full', method='fft'))
+    elif method != 'coarse':
+        raise ValueError('unknown correlation method: {}'.format(method))
+
+    a_coarse = signal.resample_poly(a, 1, decimation)
+    b_coarse = signal.resample_poly(b, 1, decimation)
+    peak = np.argmax(signal.correlate(a_coarse, b_coarse, mode='full', method='fft'))
+    # lag of a against b: corr[k] = sum_n a[n + k - (len(b) - 1)] * b[n]
+    lag = (peak - (len(b_coarse) - 1)) * decimation
+
+    best_lag, best_corr = None, -np.inf
+    for m in range(lag - 2 * decimation, lag + 2 * decimation + 1):
+        if m <= -len(b) or m >= len(a):
+            continue
+        a_seg = a[max(m, 0):len(b) + m]
+        b_seg = b[max(-m, 0):len(a) - m]
+        corr = np.dot(a_seg, b_seg)
+        if corr > best_corr:
+            best_lag, best_corr = m, corr
+
+    return best_lag + len(b) - 1
+
+
+def align_wave_head_and_tail(a, b, sr, method='fft'):
     a, _ = librosa.effects.trim(a)
     b, _ = librosa.effects.trim(b)
 
@@ -119,7 +244,7 @@ def align_wave_head_and_tail(a, b, sr):
     b_mono -= b_mono.mean()
 
     offset = len(a_mono) - 1
-    delay = np.argmax(np.correlate(a_mono, b_mono, 'full')) - offset
+    delay = _correlation_peak(a_mono, b_mono, method) - offset
 
     if delay > 0:
         a = a[:, delay:]
@@ -134,7 +259,27 @@ def align_wave_head_and_tail(a, b, sr):
     return a, b
 
 
-def cache_or_load(mix_path, inst_path, sr, hop_length, n_fft):
+def encode_compact(spec):
+    """(2, bins, frames) complex spectrogram -> (2, 2, bins, frames) float16 [magnitude, phase]."""
+    return np.asarray([np.abs(spec), np.angle(spec)], dtype=np.float16)
+
+
+def decode_compact(data):
+    mag = data[0].astype(np.float32)
+    phase = data[1].astype(np.float32)
+
+    return (mag * np.exp(1.j * phase)).astype(np.complex64)
+
+
+def load_cache_crop(cache, start, end):
+    """Complex crop of a (memory-mapped) cached spectrogram in either format."""
+    if cache.ndim == 4:
+        return decode_compact(cache[:, :, :, start:end])
+
+    return np.array(cache[:, :, start:end], copy=True)
+
+
+def get_cache_paths(mix_path, inst_path, sr, hop_length, n_fft, cache_format='complex64'):
     mix_basename = os.path.splitext(os.path.basename(mix_path))[0]
     inst_basename = os.path.splitext(os.path.basename(inst_path))[0]
 
@@ -144,30 +289,93 @@ def cache_or_load(mix_path, inst_path, sr, hop_length, n_fft):
     os.makedirs(mix_cache_dir, exist_ok=True)
     os.makedirs(inst_cache_dir, exist_ok=True)
 
-    mix_cache_path = os.path.join(mix_cache_dir, mix_basename + '.npy')
-    inst_cache_path = os.path.join(inst_cache_dir, inst_basename + '.npy')
+    # the compact format stores float16 magnitude and phase, half the size of complex64
+    ext = '.f16.npy' if cache_format == 'float16' else '.npy'
+    mix_cache_path = os.path.join(mix_cache_dir, mix_basename + ext)
+    inst_cache_path = os.path.join(inst_cache_dir, inst_basename + ext)
+
+    return mix_cache_path, inst_cache_path
+
+
+def save_atomic(path, array):
+    # concurrent readers and interrupted runs never see a partial file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def cache_or_load(mix_path, inst_path, sr, hop_length, n_fft, align_method='fft', cache_format='complex64'):
+    mix_cache_path, inst_cache_path = get_cache_paths(
+        mix_path, inst_path, sr, hop_length, n_fft, cache_format)
 
     if os.path.exists(mix_cache_path) and os.path.exists(inst_cache_path):
         X = np.load(mix_cache_path)
         y = np.load(inst_cache_path)
+        if cache_format == 'float16':
+            X = decode_compact(X)
+            y = decode_compact(y)
     else:
         X, _ = librosa.load(
             mix_path, sr, False, dtype=np.float32, res_type='kaiser_fast')
         y, _ = librosa.load(
             inst_path, sr, False, dtype=np.float32, res_type='kaiser_fast')
 
-        X, y = align_wave_head_and_tail(X, y, sr)
+        X, y = align_wave_head_and_tail(X, y, sr, align_method)
 
         X = wave_to_spectrogram(X, hop_length, n_fft)
         y = wave_to_spectrogram(y, hop_length, n_fft)
 
-        np.save(mix_cache_path, X)
-        np.save(inst_cache_path, y)
+        if cache_format == 'float16':
+            save_atomic(mix_cache_path, encode_compact(X))
+            save_atomic(inst_cache_path, encode_compact(y))
+        else:
+            save_atomic(mix_cache_path, X)
+            save_atomic(inst_cache_path, y)
 
     return X, y, mix_cache_path, inst_cache_path
 
 
-def spectrogram_to_wave(spec, hop_length=1024):
+def get_manifest_path(mix_cache_path):
+    return os.path.join(os.path.dirname(mix_cache_path), 'manifest.json')
+
+
+def load_manifest(manifest_path):
+    """Manifest of a cache directory: {mix cache file name: {'y', 'coef', 'shape'}}."""
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+
+def lookup_manifest(manifest, mix_cache_path, inst_cache_path):
+    """Manifest entry of a cached pair, or None if it is missing or stale."""
+    entry = manifest.get(os.path.basename(mix_cache_path))
+    if entry is None or entry['y'] != inst_cache_path:
+        return None
+    if not os.path.exists(mix_cache_path) or not os.path.exists(inst_cache_path):
+        return None
+
+    return entry
+
+
+def make_manifest_entry(X, y, inst_cache_path):
+    return {
+        'y': inst_cache_path,
+        'coef': float(np.max([np.abs(X).max(), np.abs(y).max()])),
+        'shape': list(X.shape),
+    }
+
+
+def spectrogram_to_wave_librosa(spec, hop_length=1024, device=None):
     if spec.ndim == 2:
         wave = librosa.istft(spec, hop_length=hop_length)
     elif spec.ndim == 3:
@@ -181,6 +389,286 @@ def spectrogram_to_wave(spec, hop_length=1024):
     return wave
 
 
+# torch.istft takes (..., 2) real spectrograms before 1.8, complex ones after
+TORCH_COMPLEX_ISTFT = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (1, 8)
+
+
+def wave_to_spectrogram_torch(wave, hop_length, n_fft, device=None):
+    """Batched STFT with the channels as the batch, same output as the librosa backend.
+
+    `wave` may be a numpy array or a tensor. Numpy input returns a complex
+    numpy spectrogram; tensor input returns a real (..., 2) tensor, as
+    torch.stft without return_complex, and stays on its device.
+    """
+    is_numpy = isinstance(wave, np.ndarray)
+    wave = torch.as_tensor(wave, device=device)
+    window = torch.hann_window(n_fft, dtype=wave.dtype, device=wave.device)
+    spec = torch.stft(
+        wave, n_fft, hop_length=hop_length, window=window,
+        center=True, pad_mode='reflect', return_complex=False)
+
+    if not is_numpy:
+        return spec
+
+    spec = spec.cpu().numpy()
+    return spec.view(np.result_type(spec.dtype, np.complex64))[..., 0]
+
+
+def spectrogram_to_wave_torch(spec, hop_length=1024, device=None):
+    """Batched iSTFT counterpart of wave_to_spectrogram_torch.
+
+    `spec` is a complex numpy spectrogram or a real (..., 2) tensor.
+    """
+    is_numpy = isinstance(spec, np.ndarray)
+    if is_numpy:
+        spec = np.stack([spec.real, spec.imag], axis=-1)
+    spec = torch.as_tensor(spec, device=device)
+    n_fft = 2 * (spec.size()[-3] - 1)
+    window = torch.hann_window(n_fft, dtype=spec.dtype, device=spec.device)
+    if TORCH_COMPLEX_ISTFT:
+        spec = torch.view_as_complex(spec.contiguous())
+    wave = torch.istft(spec, n_fft, hop_length=hop_length, window=window, center=True)
+
+    return wave.cpu().numpy() if is_numpy else wave
+
+
+STFT_BACKENDS = {
+    'librosa': (wave_to_spectrogram_librosa, spectrogram_to_wave_librosa),
+    'torch': (wave_to_spectrogram_torch, spectrogram_to_wave_torch),
+}
+
+
+def register_stft_backend(name, stft_fn, istft_fn):
+    """Add an STFT backend; the functions take the same arguments as the librosa backend."""
+    STFT_BACKENDS[name] = (stft_fn, istft_fn)
+
+
+def wave_to_spectrogram(wave, hop_length, n_fft, backend='librosa', device=None):
+    if backend not in STFT_BACKENDS:
+        raise ValueError('unknown stft backend: {}'.format(backend))
+
+    return STFT_BACKENDS[backend][0](wave, hop_length, n_fft, device=device)
+
+
+def spectrogram_to_wave(spec, hop_length=1024, backend='librosa', device=None):
+    if backend not in STFT_BACKENDS:
+        raise ValueError('unknown stft backend: {}'.format(backend))
+
+    return STFT_BACKENDS[backend][1](spec, hop_length, device=device)
+
+
+class StreamingResampler(object):
+    """Incremental version of signal.resample_poly along the last axis.
+
+    Feed (channels, samples) wave blocks of any length to `process` and call
+    `flush` at the end. The concatenated outputs match resample_poly of the
+    whole wave: each block is resampled with enough neighbouring samples to
+    cover the filter, which is all that is kept between calls.
+    """
+
+    def __init__(self, orig_sr, target_sr):
+        gcd = np.gcd(orig_sr, target_sr)
+        self.up = target_sr // gcd
+        self.down = orig_sr // gcd
+        # half filter length of resample_poly in input samples, rounded up to
+        # a multiple of `down` so that it maps to whole output samples
+        half_len = 10 * max(self.up, self.down) // self.up + 1
+        self.context = -(-half_len // self.down) * self.down
+        self.buffer = None
+        self.buffer_start = 0
+        self.done = 0
+
+    def _resample(self, stop=None):
+        start = max(self.done - self.context, 0)
+        end = self.buffer_start + self.buffer.shape[1]
+        if stop is not None:
+            end = stop + self.context
+        y = signal.resample_poly(
+            self.buffer[:, start - self.buffer_start:end - self.buffer_start],
+            self.up, self.down, axis=1)
+        lo = (self.done - start) * self.up // self.down
+        hi = None if stop is None else (stop - start) * self.up // self.down
+
+        return y[:, lo:hi].astype(np.float32)
+
+    def process(self, wave):
+        wave = np.asarray(wave, dtype=np.float32)
+        if self.buffer is None:
+            self.buffer = wave[:, :0]
+        self.buffer = np.concatenate([self.buffer, wave], axis=1)
+
+        end = self.buffer_start + self.buffer.shape[1]
+        stop = (end - self.context) // self.down * self.down
+        if stop <= self.done:
+            return self.buffer[:, :0]
+
+        y = self._resample(stop)
+        self.done = stop
+        drop = self.done - self.context - self.buffer_start
+        if drop > 0:
+            self.buffer = self.buffer[:, drop:]
+            self.buffer_start += drop
+
+        return y
+
+    def flush(self):
+        if self.buffer is None:
+            return np.zeros((2, 0), dtype=np.float32)
+        if self.buffer_start + self.buffer.shape[1] == self.done:
+            return self.buffer[:, :0]
+
+        y = self._resample()
+        self.done = self.buffer_start + self.buffer.shape[1]
+
+        return y
+
+
+class StreamingSTFT(object):
+    """Incremental version of wave_to_spectrogram.
+
+    Feed stereo wave blocks of any length to `process` and call `flush` at the
+    end. The concatenated outputs match wave_to_spectrogram of the whole wave
+    (centered frames, reflect padding, hann window), while only about one
+    frame of samples is kept between calls.
+    """
+
+    def __init__(self, hop_length, n_fft):
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+        self.window = librosa.filters.get_window('hann', n_fft, fftbins=True)
+        self.started = False
+        self.pending = np.zeros((2, 0), dtype=np.float32)
+        self.buffer = np.zeros((2, 0), dtype=np.float32)
+        self.tail = np.zeros((2, 0), dtype=np.float32)
+
+    def _empty(self):
+        return np.zeros((2, self.n_fft // 2 + 1, 0), dtype=np.complex64)
+
+    def _frames(self):
+        n_samples = self.buffer.shape[1]
+        if n_samples < self.n_fft:
+            return self._empty()
+
+        n_frames = 1 + (n_samples - self.n_fft) // self.hop_length
+        idx = np.arange(self.n_fft)[None, :] + self.hop_length * np.arange(n_frames)[:, None]
+        frames = self.buffer[:, idx] * self.window
+        spec = np.fft.rfft(frames, axis=2).transpose(0, 2, 1).astype(np.complex64)
+        self.buffer = self.buffer[:, n_frames * self.hop_length:]
+
+        return spec
+
+    def process(self, wave):
+        pad = self.n_fft // 2
+        wave = np.asarray(wave, dtype=np.float32)
+        if not self.started:
+            # reflect padding of the head needs pad + 1 samples
+            self.pending = np.concatenate([self.pending, wave], axis=1)
+            if self.pending.shape[1] <= pad:
+                return self._empty()
+            wave = self.pending
+            self.pending = None
+            self.buffer = wave[:, 1:pad + 1][:, ::-1]
+            self.started = True
+
+        self.tail = np.concatenate([self.tail, wave], axis=1)[:, -(pad + 1):]
+        self.buffer = np.concatenate([self.buffer, wave], axis=1)
+
+        return self._frames()
+
+    def flush(self):
+        pad = self.n_fft // 2
+        if not self.started:
+            if self.pending.shape[1] == 0:
+                return self._empty()
+            return wave_to_spectrogram(self.pending, self.hop_length, self.n_fft)
+
+        self.buffer = np.concatenate([self.buffer, self.tail[:, -(pad + 1):-1][:, ::-1]], axis=1)
+        spec = self._frames()
+        self.buffer = np.zeros((2, 0), dtype=np.float32)
+
+        return spec
+
+
+class StreamingISTFT(object):
+    """Incremental overlap-add version of spectrogram_to_wave.
+
+    Feed spectrogram blocks of shape (..., bins, frames) to `process` and call
+    `flush` at the end. Samples are returned as soon as no later frame overlaps
+    them, and the concatenated outputs match spectrogram_to_wave.
+    """
+
+    def __init__(self, hop_length=1024):
+        self.hop_length = hop_length
+        self.n_fft = None
+        self.window_sq = None
+        self.acc = None
+        self.norm = None
+        self.pos = 0
+        self.emitted = 0
+        self.n_frames = 0
+
+    def _emit(self, end):
+        if end <= self.emitted:
+            return np.zeros(self.acc.shape[:-1] + (0,), dtype=np.float32)
+
+        wave = self.acc[..., self.emitted - self.pos:end - self.pos]
+        norm = self.norm[self.emitted - self.pos:end - self.pos]
+        nonzero = norm > np.finfo(norm.dtype).tiny
+        wave[..., nonzero] /= norm[nonzero]
+
+        self.acc = self.acc[..., end - self.pos:]
+        self.norm = self.norm[end - self.pos:]
+        self.pos = self.emitted = end
+
+        return wave.astype(np.float32)
+
+    def process(self, spec):
+        if self.n_fft is None:
+            self.n_fft = 2 * (spec.shape[-2] - 1)
+            window = librosa.filters.get_window('hann', self.n_fft, fftbins=True)
+            self.window = window
+            self.window_sq = window ** 2
+            self.acc = np.zeros(spec.shape[:-2] + (0,))
+            self.norm = np.zeros(0)
+            self.pos = self.emitted = self.n_fft // 2
+
+        n_frames = spec.shape[-1]
+        if n_frames == 0:
+            return np.zeros(self.acc.shape[:-1] + (0,), dtype=np.float32)
+
+        frames = np.fft.irfft(np.swapaxes(spec, -1, -2), n=self.n_fft, axis=-1) * self.window
+        first = self.n_frames * self.hop_length
+        size = first + (n_frames - 1) * self.hop_length + self.n_fft - self.pos
+        if size > self.acc.shape[-1]:
+            grow = size - self.acc.shape[-1]
+            self.acc = np.concatenate([self.acc, np.zeros(self.acc.shape[:-1] + (grow,))], axis=-1)
+            self.norm = np.concatenate([self.norm, np.zeros(grow)])
+
+        for i in range(n_frames):
+            s = first + i * self.hop_length - self.pos
+            if s < 0:
+                # the head is trimmed anyway (center=True)
+                self.acc[..., :s + self.n_fft] += frames[..., i, -s:]
+                self.norm[:s + self.n_fft] += self.window_sq[-s:]
+            else:
+                self.acc[..., s:s + self.n_fft] += frames[..., i, :]
+                self.norm[s:s + self.n_fft] += self.window_sq
+        self.n_frames += n_frames
+
+        # samples before the next frame are final
+        end = min(
+            self.n_frames * self.hop_length,
+            (self.n_frames - 1) * self.hop_length + self.n_fft // 2)
+
+        return self._emit(end)
+
+    def flush(self):
+        if self.n_fft is None:
+            return np.zeros((2, 0), dtype=np.float32)
+
+        return self._emit((self.n_frames - 1) * self.hop_length + self.n_fft // 2)
+
+
 if __name__ == "__main__":
     import cv2
     import sys
@@ -35,14 +35,18 @@ def setup_logger(name, logfile='LOGFILENAME.log'):
     return logger
 
 
-def train_epoch(dataloader, model, device, optimizer, accumulation_steps):
+def train_epoch(dataloader, model, device, optimizer, accumulation_steps, batch_aug=None):
     model.train()
     sum_loss = 0
     crit = nn.L1Loss()
 
-    for itr, (X_batch, y_batch) in enumerate(dataloader):
-        X_batch = X_batch.to(device)
-        y_batch = y_batch.to(device)
+    for itr, batch in enumerate(dataloader):
+        if batch_aug is not None:
+            X_batch, y_batch = batch_aug(*[t.to(device, non_blocking=True) for t in batch])
+        else:
+            X_batch, y_batch = batch
+            X_batch = X_batch.to(device)
+            y_batch = y_batch.to(device)
 
         pred, aux = model(X_batch)
 
@@ -115,6 +119,8 @@ def main():
     p.add_argument('--mixup_rate', '-M', type=float, default=0.0)
     p.add_argument('--mixup_alpha', '-a', type=float, default=1.0)
     p.add_argument('--pretrained_model', '-P', type=str, default=None)
+    p.add_argument('--cache_format', type=str, choices=['complex64', 'float16'], default='complex64')
+    p.add_argument('--batch_aug', action='store_true')
     p.add_argument('--debug', action='store_true')
     args = p.parse_args()
 
@@ -183,7 +189,8 @@ def main():
         filelist=train_filelist,
         sr=args.sr,
         hop_length=args.hop_length,
-        n_fft=args.n_fft
+        n_fft=args.n_fft,
+        cache_format=args.cache_format
     )
 
     train_dataset = dataset.VocalRemoverTrainingSet(
@@ -192,14 +199,26 @@ def main():
         reduction_rate=args.reduction_rate,
         reduction_weight=reduction_weight,
         mixup_rate=args.mixup_rate,
-        mixup_alpha=args.mixup_alpha
+        mixup_alpha=args.mixup_alpha,
+        batch_aug=args.batch_aug
     )
 
+    batch_aug = None
+    if args.batch_aug:
+        batch_aug = dataset.BatchAugmentation(
+            reduction_rate=args.reduction_rate,
+            reduction_weight=reduction_weight,
+            mixup_rate=args.mixup_rate,
+            mixup_alpha=args.mixup_alpha,
+            device=device
+        )
+
     train_dataloader = torch.utils.data.DataLoader(
         dataset=train_dataset,
         batch_size=args.batchsize,
         shuffle=True,
-        num_workers=args.num_workers
+        num_workers=args.num_workers,
+        pin_memory=args.batch_aug
     )
 
     patch_list = dataset.make_validation_set(
@@ -208,7 +227,8 @@ def main():
         sr=args.sr,
         hop_length=args.hop_length,
         n_fft=args.n_fft,
-        offset=model.offset
+        offset=model.offset,
+        cache_format=args.cache_format
     )
 
     val_dataset = dataset.VocalRemoverValidationSet(
@@ -226,7 +246,8 @@ def main():
     best_loss = np.inf
     for epoch in range(args.epoch):
         logger.info('# epoch {}'.format(epoch))
-        train_loss = train_epoch(train_dataloader, model, device, optimizer, args.accumulation_steps)
+        train_loss = train_epoch(
+            train_dataloader, model, device, optimizer, args.accumulation_steps, batch_aug)
         val_loss = validate_epoch(val_dataloader, model, device)
 
         logger.info(